@@ -29,6 +29,7 @@
 #include <rte_ethdev.h>
 #include <rte_ether.h>
 #include <rte_interrupts.h>
+#include <rte_ip.h>
 #include <rte_launch.h>
 #include <rte_lcore.h>
 #include <rte_log.h>
@@ -40,7 +41,10 @@
 #include <rte_per_lcore.h>
 #include <rte_prefetch.h>
 #include <rte_random.h>
+#include <rte_ring.h>
+#include <rte_spinlock.h>
 #include <rte_string_fns.h>
+#include <rte_thash.h>
 
 #include <weaver.h>
 
@@ -54,6 +58,7 @@ static int mac_updating = 1;
 #define MAX_PKT_BURST 32
 #define BURST_TX_DRAIN_US 100 /* TX drain every ~100us */
 #define MEMPOOL_CACHE_SIZE 256
+#define SW_RING_SIZE 4096
 
 /*
  * Configurable number of RX/TX ring descriptors
@@ -81,21 +86,83 @@ static struct port_pair_params port_pair_params_array[RTE_MAX_ETHPORTS / 2];
 static struct port_pair_params *port_pair_params;
 static uint16_t nb_port_pair_params;
 
-static unsigned int l2fwd_rx_queue_per_lcore = 1;
+/*
+ * Flow sharding
+ *
+ * Every enabled lcore is a worker with its own WV_Runtime, so flow tables and
+ * timers are never shared between cores. Each port gets one RX queue per
+ * worker and the NIC spreads packets with RSS. The RSS key is a repeated
+ * 16-bit pattern, which makes the Toeplitz hash symmetric: (src, dst) and
+ * (dst, src) give the same value, so both directions of a flow land on the
+ * same worker.
+ *
+ * Ports without RSS (e.g. --vdev=net_pcap0 or net_null0) are read by worker 0
+ * only, which computes the same symmetric hash in software and hands every
+ * packet to the owning worker through a ring.
+ */
+static unsigned int nb_workers = 0;
+
+/* force software distribution even if the NIC supports RSS */
+static int sw_rss = 0;
+
+/* hash on TCP/UDP ports as well as IP addresses. Off by default: fragments
+ * carry no ports, so hashing on them would split IP reassembly across
+ * workers */
+static int rss_l4 = 0;
+
+#define RSS_KEY_MAX_LEN 52
+static uint8_t rss_symmetric_key[RSS_KEY_MAX_LEN] = {
+  0x6d, 0x5a, 0x6d, 0x5a, 0x6d, 0x5a, 0x6d, 0x5a, 0x6d, 0x5a, 0x6d, 0x5a, 0x6d,
+  0x5a, 0x6d, 0x5a, 0x6d, 0x5a, 0x6d, 0x5a, 0x6d, 0x5a, 0x6d, 0x5a, 0x6d, 0x5a,
+  0x6d, 0x5a, 0x6d, 0x5a, 0x6d, 0x5a, 0x6d, 0x5a, 0x6d, 0x5a, 0x6d, 0x5a, 0x6d,
+  0x5a, 0x6d, 0x5a, 0x6d, 0x5a, 0x6d, 0x5a, 0x6d, 0x5a, 0x6d, 0x5a, 0x6d, 0x5a,
+};
+
+/* ports distributed in software instead of by the NIC */
+static uint8_t sw_rss_port[RTE_MAX_ETHPORTS];
+
+/* TX queues are per worker unless the device has fewer queues than workers,
+ * in which case workers share them under a lock */
+static uint16_t nb_tx_queues[RTE_MAX_ETHPORTS];
+static rte_spinlock_t tx_lock[RTE_MAX_ETHPORTS][RTE_MAX_LCORE];
+
+/* Per-port statistics struct */
+struct l2fwd_port_statistics {
+  uint64_t tx;
+  uint64_t rx;
+  uint64_t dropped;
+} __rte_cache_aligned;
+
+#define PERF_AVG_NUM 5
 
 #define MAX_RX_QUEUE_PER_LCORE 16
-#define MAX_TX_QUEUE_PER_PORT 16
+struct lcore_rx_queue {
+  uint16_t port_id;
+  uint16_t queue_id;
+};
+
 struct lcore_queue_conf {
-  unsigned n_rx_port;
-  unsigned rx_port_list[MAX_RX_QUEUE_PER_LCORE];
+  unsigned worker_id;
+  unsigned n_rx_queue;
+  struct lcore_rx_queue rx_queue_list[MAX_RX_QUEUE_PER_LCORE];
+  struct rte_eth_dev_tx_buffer *tx_buffer[RTE_MAX_ETHPORTS];
+  struct rte_ring *sw_ring;
+  WV_Runtime *runtime;
+  struct l2fwd_port_statistics port_statistics[RTE_MAX_ETHPORTS];
+  unsigned long long pkt_vol;
+  struct timeval milestone;
+  double throughputs[PERF_AVG_NUM];
+  double peak_throught;
 } __rte_cache_aligned;
 struct lcore_queue_conf lcore_queue_conf[RTE_MAX_LCORE];
 
-static struct rte_eth_dev_tx_buffer *tx_buffer[RTE_MAX_ETHPORTS];
+/* worker id -> lcore id */
+static unsigned worker_lcore[RTE_MAX_LCORE];
 
 static struct rte_eth_conf port_conf = {
   .rxmode =
     {
+      .mq_mode = ETH_MQ_RX_NONE,
       .split_hdr_size = 0,
     },
   .txmode =
@@ -106,22 +173,19 @@ static struct rte_eth_conf port_conf = {
 
 struct rte_mempool *l2fwd_pktmbuf_pool = NULL;
 
-/* Per-port statistics struct */
-struct l2fwd_port_statistics {
-  uint64_t tx;
-  uint64_t rx;
-  uint64_t dropped;
-} __rte_cache_aligned;
-struct l2fwd_port_statistics port_statistics[RTE_MAX_ETHPORTS];
-
 #define MAX_TIMER_PERIOD 86400 /* 1 day max */
 /* A tsc-based timer responsible for triggering statistics printout */
 static uint64_t timer_period = 10; /* default period is 10 seconds */
 
+/* TSC cycles per microsecond, for the coarse clock that drives flow expiry */
+static uint64_t tsc_per_us;
+
 /* Print out statistics on packets dropped */
 static void print_stats(void) {
   uint64_t total_packets_dropped, total_packets_tx, total_packets_rx;
-  unsigned portid;
+  uint64_t port_tx, port_rx, port_dropped;
+  unsigned portid, worker_id;
+  struct l2fwd_port_statistics *stats;
 
   total_packets_dropped = 0;
   total_packets_tx = 0;
@@ -139,18 +203,25 @@ static void print_stats(void) {
     /* skip disabled ports */
     if ((l2fwd_enabled_port_mask & (1 << portid)) == 0)
       continue;
+    port_tx = port_rx = port_dropped = 0;
+    for (worker_id = 0; worker_id < nb_workers; worker_id++) {
+      stats = &lcore_queue_conf[worker_lcore[worker_id]].port_statistics[portid];
+      port_tx += stats->tx;
+      port_rx += stats->rx;
+      port_dropped += stats->dropped;
+    }
     printf(
       "\nStatistics for port %u ------------------------------"
       "\nPackets sent: %24" PRIu64 "\nPackets received: %20" PRIu64
       "\nPackets dropped: %21" PRIu64,
       portid,
-      port_statistics[portid].tx,
-      port_statistics[portid].rx,
-      port_statistics[portid].dropped);
+      port_tx,
+      port_rx,
+      port_dropped);
 
-    total_packets_dropped += port_statistics[portid].dropped;
-    total_packets_tx += port_statistics[portid].tx;
-    total_packets_rx += port_statistics[portid].rx;
+    total_packets_dropped += port_dropped;
+    total_packets_tx += port_tx;
+    total_packets_rx += port_rx;
   }
   printf(
     "\nAggregate statistics ==============================="
@@ -164,35 +235,19 @@ static void print_stats(void) {
   fflush(stdout);
 }
 
-/* DPDKUser */
-typedef struct {
-  WV_Runtime *runtime;
-  unsigned port;
-} DPDKUser;
-
-DPDKUser *dpdk_user;
-
-unsigned long pkt_id = 0;
-unsigned long long pkt_vol = 0;
-struct timeval now;
-struct timeval milestone;
-#define PERF_AVG_NUM 5
-double throughputs[PERF_AVG_NUM];
-double peak_throught = -1;
-
-static void print_avg_throughput() {
+static void print_avg_throughput(struct lcore_queue_conf *qconf) {
   double total = 0.0;
   int i;
   int r = 0;
   for (i = 0; i < PERF_AVG_NUM; i++) {
-    if (throughputs[i] <= 0) {
-      peak_throught = -1;
+    if (qconf->throughputs[i] <= 0) {
+      qconf->peak_throught = -1;
       continue;
     }
     r++;
-    total += throughputs[i];
-    if (throughputs[i] > peak_throught) {
-      peak_throught = throughputs[i];
+    total += qconf->throughputs[i];
+    if (qconf->throughputs[i] > qconf->peak_throught) {
+      qconf->peak_throught = qconf->throughputs[i];
     }
   }
   const unsigned id = rte_lcore_id();
@@ -201,7 +256,7 @@ static void print_avg_throughput() {
     id,
     (double)total / r,
     r,
-    peak_throught);
+    qconf->peak_throught);
 }
 
 static void l2fwd_mac_updating(struct rte_mbuf *m, unsigned dest_portid) {
@@ -218,9 +273,18 @@ static void l2fwd_mac_updating(struct rte_mbuf *m, unsigned dest_portid) {
   rte_ether_addr_copy(&l2fwd_ports_eth_addr[dest_portid], &eth->s_addr);
 }
 
-static void l2fwd_simple_forward(struct rte_mbuf *m, unsigned portid) {
+/* TX queue a worker sends on, and whether it is shared with other workers */
+static inline uint16_t
+l2fwd_tx_queue(struct lcore_queue_conf *qconf, unsigned port, int *shared) {
+  *shared = nb_tx_queues[port] < nb_workers;
+  return qconf->worker_id % nb_tx_queues[port];
+}
+
+static void l2fwd_simple_forward(
+  struct lcore_queue_conf *qconf, struct rte_mbuf *m, unsigned portid) {
   unsigned dst_port;
-  int sent;
+  int sent, shared;
+  uint16_t queue_id;
   struct rte_eth_dev_tx_buffer *buffer;
 
   dst_port = l2fwd_dst_ports[portid];
@@ -228,24 +292,115 @@ static void l2fwd_simple_forward(struct rte_mbuf *m, unsigned portid) {
   if (mac_updating)
     l2fwd_mac_updating(m, dst_port);
 
-  buffer = tx_buffer[dst_port];
-  sent = rte_eth_tx_buffer(dst_port, 0, buffer, m);
+  buffer = qconf->tx_buffer[dst_port];
+  queue_id = l2fwd_tx_queue(qconf, dst_port, &shared);
+  if (unlikely(shared))
+    rte_spinlock_lock(&tx_lock[dst_port][queue_id]);
+  sent = rte_eth_tx_buffer(dst_port, queue_id, buffer, m);
+  if (unlikely(shared))
+    rte_spinlock_unlock(&tx_lock[dst_port][queue_id]);
   if (sent)
-    port_statistics[dst_port].tx += sent;
+    qconf->port_statistics[dst_port].tx += sent;
+}
+
+static void l2fwd_tx_flush(struct lcore_queue_conf *qconf, unsigned portid) {
+  int sent, shared;
+  uint16_t queue_id;
+  struct rte_eth_dev_tx_buffer *buffer = qconf->tx_buffer[portid];
+
+  if (buffer->length == 0)
+    return;
+  queue_id = l2fwd_tx_queue(qconf, portid, &shared);
+  if (unlikely(shared))
+    rte_spinlock_lock(&tx_lock[portid][queue_id]);
+  sent = rte_eth_tx_buffer_flush(portid, queue_id, buffer);
+  if (unlikely(shared))
+    rte_spinlock_unlock(&tx_lock[portid][queue_id]);
+  if (sent)
+    qconf->port_statistics[portid].tx += sent;
+}
+
+/* Symmetric software RSS: the same Toeplitz hash the NIC would compute with
+ * rss_symmetric_key, over IPv4 addresses (and ports with --rss-l4). Non-IPv4
+ * packets all go to worker 0. */
+static unsigned l2fwd_sw_rss_worker(struct rte_mbuf *m) {
+  struct rte_ether_hdr *eth;
+  struct rte_ipv4_hdr *ip;
+  struct rte_ipv4_tuple tuple;
+  uint32_t ihl, tuple_len;
+  const uint16_t *ports;
+
+  if (nb_workers == 1)
+    return 0;
+  if (rte_pktmbuf_data_len(m) < sizeof(*eth) + sizeof(*ip))
+    return 0;
+  eth = rte_pktmbuf_mtod(m, struct rte_ether_hdr *);
+  if (eth->ether_type != rte_cpu_to_be_16(RTE_ETHER_TYPE_IPV4))
+    return 0;
+  ip = (struct rte_ipv4_hdr *)(eth + 1);
+
+  tuple.src_addr = rte_be_to_cpu_32(ip->src_addr);
+  tuple.dst_addr = rte_be_to_cpu_32(ip->dst_addr);
+  tuple_len = RTE_THASH_V4_L3_LEN;
+
+  ihl = (ip->version_ihl & RTE_IPV4_HDR_IHL_MASK) * RTE_IPV4_IHL_MULTIPLIER;
+  if (rss_l4 &&
+      (ip->next_proto_id == IPPROTO_TCP || ip->next_proto_id == IPPROTO_UDP) &&
+      (ip->fragment_offset &
+       rte_cpu_to_be_16(RTE_IPV4_HDR_MF_FLAG | RTE_IPV4_HDR_OFFSET_MASK)) == 0 &&
+      rte_pktmbuf_data_len(m) >= sizeof(*eth) + ihl + 4) {
+    ports = (const uint16_t *)((const uint8_t *)ip + ihl);
+    tuple.sport = rte_be_to_cpu_16(ports[0]);
+    tuple.dport = rte_be_to_cpu_16(ports[1]);
+    tuple_len = RTE_THASH_V4_L4_LEN;
+  }
+
+  return rte_softrss((uint32_t *)&tuple, tuple_len, rss_symmetric_key) %
+         nb_workers;
+}
+
+static inline void l2fwd_process_burst(
+  struct lcore_queue_conf *qconf,
+  struct rte_mbuf **pkts,
+  unsigned nb_pkts,
+  uint64_t now_us) {
+  WV_ByteSlice packets[MAX_PKT_BURST];
+  WV_U64 ts[MAX_PKT_BURST];
+  WV_U8 statuses[MAX_PKT_BURST];
+  unsigned j;
+
+  if (nb_pkts == 0)
+    return;
+
+  for (j = 0; j < nb_pkts; j++) {
+    rte_prefetch0(rte_pktmbuf_mtod(pkts[j], void *));
+    packets[j].cursor = rte_pktmbuf_mtod(pkts[j], unsigned char *);
+    packets[j].length = rte_pktmbuf_pkt_len(pkts[j]);
+    // packets of a burst are received at the same time
+    ts[j] = now_us;
+    qconf->pkt_vol += packets[j].length;
+  }
+
+  WV_ProcessBurstTs(packets, ts, nb_pkts, statuses, qconf->runtime);
+
+  for (j = 0; j < nb_pkts; j++) {
+    WV_ProfileRecord(WV_GetProfile(qconf->runtime), packets[j].length, statuses[j]);
+    l2fwd_simple_forward(qconf, pkts[j], pkts[j]->port);
+  }
 }
 
 /* main processing loop */
 static void l2fwd_main_loop(void) {
   struct rte_mbuf *pkts_burst[MAX_PKT_BURST];
+  struct rte_mbuf *own_burst[MAX_PKT_BURST];
   struct rte_mbuf *m;
-  int sent;
   unsigned lcore_id;
-  uint64_t prev_tsc, diff_tsc, cur_tsc, timer_tsc;
-  unsigned i, j, portid, nb_rx;
-  struct lcore_queue_conf *qconf;
+  uint64_t prev_tsc, diff_tsc, cur_tsc, timer_tsc, now_us;
+  unsigned i, j, portid, queueid, nb_rx, nb_own, worker_id;
+  struct lcore_queue_conf *qconf, *dst_qconf;
+  struct timeval now;
   const uint64_t drain_tsc =
     (rte_get_tsc_hz() + US_PER_S - 1) / US_PER_S * BURST_TX_DRAIN_US;
-  struct rte_eth_dev_tx_buffer *buffer;
 
   prev_tsc = 0;
   timer_tsc = 0;
@@ -253,25 +408,40 @@ static void l2fwd_main_loop(void) {
   lcore_id = rte_lcore_id();
   qconf = &lcore_queue_conf[lcore_id];
 
-  memset(throughputs, 0, sizeof(double) * PERF_AVG_NUM);
+  memset(qconf->throughputs, 0, sizeof(double) * PERF_AVG_NUM);
+  qconf->peak_throught = -1;
   int perf_index = 0;
 
-  if (qconf->n_rx_port == 0) {
+  if (qconf->n_rx_queue == 0 && qconf->sw_ring == NULL) {
     RTE_LOG(INFO, L2FWD, "lcore %u has nothing to do\n", lcore_id);
     return;
   }
 
-  RTE_LOG(INFO, L2FWD, "entering main loop on lcore %u\n", lcore_id);
-
-  for (i = 0; i < qconf->n_rx_port; i++) {
-
-    portid = qconf->rx_port_list[i];
-    RTE_LOG(INFO, L2FWD, " -- lcoreid=%u portid=%u\n", lcore_id, portid);
+  RTE_LOG(
+    INFO,
+    L2FWD,
+    "entering main loop on lcore %u (worker %u)\n",
+    lcore_id,
+    qconf->worker_id);
+
+  for (i = 0; i < qconf->n_rx_queue; i++) {
+
+    portid = qconf->rx_queue_list[i].port_id;
+    queueid = qconf->rx_queue_list[i].queue_id;
+    RTE_LOG(
+      INFO,
+      L2FWD,
+      " -- lcoreid=%u portid=%u rxqueueid=%u%s\n",
+      lcore_id,
+      portid,
+      queueid,
+      sw_rss_port[portid] ? " (software RSS)" : "");
   }
 
   while (!force_quit) {
 
     cur_tsc = rte_rdtsc();
+    now_us = cur_tsc / tsc_per_us;
 
     /*
      * TX burst queue drain
@@ -279,14 +449,10 @@ static void l2fwd_main_loop(void) {
     diff_tsc = cur_tsc - prev_tsc;
     if (unlikely(diff_tsc > drain_tsc)) {
 
-      for (i = 0; i < qconf->n_rx_port; i++) {
-
-        portid = l2fwd_dst_ports[qconf->rx_port_list[i]];
-        buffer = tx_buffer[portid];
-
-        sent = rte_eth_tx_buffer_flush(portid, 0, buffer);
-        if (sent)
-          port_statistics[portid].tx += sent;
+      RTE_ETH_FOREACH_DEV(portid) {
+        if ((l2fwd_enabled_port_mask & (1 << portid)) == 0)
+          continue;
+        l2fwd_tx_flush(qconf, portid);
       }
 
       /* if timer is enabled */
@@ -298,26 +464,21 @@ static void l2fwd_main_loop(void) {
         /* if timer has reached its timeout */
         if (unlikely(timer_tsc >= timer_period)) {
 
-          /* do this only on main core */
-          if (lcore_id == rte_get_main_lcore()) {
-            // print_stats();
-            gettimeofday(&now, NULL);
-            time_t s = now.tv_sec - milestone.tv_sec;
-            suseconds_t u = s * 1000000 + now.tv_usec - milestone.tv_usec;
-            double throughput =
-              (double)8000000 * pkt_vol / (u * 1000 * 1000 * 1000);
-            // printf("time: %luus, pkt: %lu, vol: %lld, ", u, pkt_id, pkt_vol);
-            throughputs[perf_index] = throughput;
-            print_avg_throughput();
-            // printf("Lcore %d, Throughput: %lfGbps\n", id, throughput);
-            milestone.tv_sec = now.tv_sec;
-            milestone.tv_usec = now.tv_usec;
-            pkt_id = 0;
-            pkt_vol = 0;
-            perf_index = (perf_index + 1) % PERF_AVG_NUM;
-            /* reset the timer */
-            timer_tsc = 0;
-          }
+          /* every worker reports its own share */
+          // print_stats();
+          gettimeofday(&now, NULL);
+          time_t s = now.tv_sec - qconf->milestone.tv_sec;
+          suseconds_t u = s * 1000000 + now.tv_usec - qconf->milestone.tv_usec;
+          double throughput =
+            (double)8000000 * qconf->pkt_vol / (u * 1000 * 1000 * 1000);
+          qconf->throughputs[perf_index] = throughput;
+          print_avg_throughput(qconf);
+          qconf->milestone.tv_sec = now.tv_sec;
+          qconf->milestone.tv_usec = now.tv_usec;
+          qconf->pkt_vol = 0;
+          perf_index = (perf_index + 1) % PERF_AVG_NUM;
+          /* reset the timer */
+          timer_tsc = 0;
         }
       }
 
@@ -327,43 +488,76 @@ static void l2fwd_main_loop(void) {
     /*
      * Read packet from RX queues
      */
-    for (i = 0; i < qconf->n_rx_port; i++) {
+    for (i = 0; i < qconf->n_rx_queue; i++) {
 
-      portid = qconf->rx_port_list[i];
-      nb_rx = rte_eth_rx_burst(portid, 0, pkts_burst, MAX_PKT_BURST);
+      portid = qconf->rx_queue_list[i].port_id;
+      queueid = qconf->rx_queue_list[i].queue_id;
+      nb_rx = rte_eth_rx_burst(portid, queueid, pkts_burst, MAX_PKT_BURST);
 
-      port_statistics[portid].rx += nb_rx;
+      qconf->port_statistics[portid].rx += nb_rx;
+
+      if (!sw_rss_port[portid]) {
+        l2fwd_process_burst(qconf, pkts_burst, nb_rx, now_us);
+        continue;
+      }
 
+      nb_own = 0;
       for (j = 0; j < nb_rx; j++) {
         m = pkts_burst[j];
-        pkt_vol += rte_pktmbuf_pkt_len(m);
-
-        unsigned char *pkt_buf = rte_pktmbuf_mtod(m, unsigned char *);
-        unsigned pkt_len = rte_pktmbuf_pkt_len(m);
-
-        WV_Runtime *runtime = dpdk_user->runtime;
-        WV_ByteSlice packet = {.cursor = pkt_buf, .length = pkt_len};
-        WV_U8 status = WV_ProcessPacket(packet, runtime);
-        WV_ProfileRecord(WV_GetProfile(runtime), pkt_len, status);
-
-        rte_prefetch0(rte_pktmbuf_mtod(m, void *));
-        l2fwd_simple_forward(m, portid);
+        worker_id = l2fwd_sw_rss_worker(m);
+        if (worker_id == qconf->worker_id) {
+          own_burst[nb_own++] = m;
+          continue;
+        }
+        dst_qconf = &lcore_queue_conf[worker_lcore[worker_id]];
+        if (unlikely(rte_ring_enqueue(dst_qconf->sw_ring, m) != 0)) {
+          qconf->port_statistics[portid].dropped++;
+          rte_pktmbuf_free(m);
+        }
       }
+      l2fwd_process_burst(qconf, own_burst, nb_own, now_us);
+    }
+
+    /*
+     * Read packets handed over by software RSS
+     */
+    if (qconf->sw_ring != NULL) {
+      nb_rx = rte_ring_dequeue_burst(
+        qconf->sw_ring, (void **)pkts_burst, MAX_PKT_BURST, NULL);
+      l2fwd_process_burst(qconf, pkts_burst, nb_rx, now_us);
     }
   }
 }
 
 static int l2fwd_launch_one_lcore(__rte_unused void *dummy) {
+  struct lcore_queue_conf *qconf = &lcore_queue_conf[rte_lcore_id()];
+
+  /* allocated here so that the runtime lives on this lcore's socket */
+  if (!(qconf->runtime = WV_AllocRuntime())) {
+    fprintf(
+      stderr, "runtime initialization fail on lcore %u\n", rte_lcore_id());
+    force_quit = true;
+    return -1;
+  }
+  gettimeofday(&qconf->milestone, NULL);
+  WV_ProfileStart(WV_GetProfile(qconf->runtime));
+
   l2fwd_main_loop();
+
+  WV_ProfileRecordPrint(WV_GetProfile(qconf->runtime));
+  if (WV_FreeRuntime(qconf->runtime)) {
+    fprintf(stderr, "runtime cleanup fail on lcore %u\n", rte_lcore_id());
+    return -1;
+  }
+  qconf->runtime = NULL;
   return 0;
 }
 
 /* display usage */
 static void l2fwd_usage(const char *prgname) {
   printf(
-    "%s [EAL options] -- -p PORTMASK [-q NQ]\n"
+    "%s [EAL options] -- -p PORTMASK\n"
     "  -p PORTMASK: hexadecimal bitmask of ports to configure\n"
-    "  -q NQ: number of queue (=ports) per lcore (default is 1)\n"
     "  -T PERIOD: statistics will be refreshed each PERIOD seconds (0 to "
     "disable, 10 default, 86400 maximum)\n"
     "  --[no-]mac-updating: Enable or disable MAC addresses updating (enabled "
@@ -373,7 +567,12 @@ static void l2fwd_usage(const char *prgname) {
     "       - The destination MAC address is replaced by "
     "02:00:00:00:00:TX_PORT_ID\n"
     "  --portmap: Configure forwarding port pair mapping\n"
-    "	      Default: alternate port pairs\n\n",
+    "	      Default: alternate port pairs\n"
+    "  --sw-rss: Distribute flows to lcores in software even if the NIC "
+    "supports RSS\n"
+    "      (always used for ports without RSS, e.g. net_pcap or net_null)\n"
+    "  --rss-l4: Hash on TCP/UDP ports as well as IP addresses\n"
+    "      (do not use with IP fragments, they would be split across lcores)\n\n",
     prgname);
 }
 
@@ -436,22 +635,6 @@ static int l2fwd_parse_port_pair_config(const char *q_arg) {
   return 0;
 }
 
-static unsigned int l2fwd_parse_nqueue(const char *q_arg) {
-  char *end = NULL;
-  unsigned long n;
-
-  /* parse hexadecimal string */
-  n = strtoul(q_arg, &end, 10);
-  if ((q_arg[0] == '\0') || (end == NULL) || (*end != '\0'))
-    return 0;
-  if (n == 0)
-    return 0;
-  if (n >= MAX_RX_QUEUE_PER_LCORE)
-    return 0;
-
-  return n;
-}
-
 static int l2fwd_parse_timer_period(const char *q_arg) {
   char *end = NULL;
   int n;
@@ -467,13 +650,14 @@ static int l2fwd_parse_timer_period(const char *q_arg) {
 }
 
 static const char short_options[] = "p:" /* portmask */
-                                    "q:" /* number of queues */
                                     "T:" /* timer period */
   ;
 
 #define CMD_LINE_OPT_MAC_UPDATING "mac-updating"
 #define CMD_LINE_OPT_NO_MAC_UPDATING "no-mac-updating"
 #define CMD_LINE_OPT_PORTMAP_CONFIG "portmap"
+#define CMD_LINE_OPT_SW_RSS "sw-rss"
+#define CMD_LINE_OPT_RSS_L4 "rss-l4"
 
 enum {
   /* long options mapped to a short option */
@@ -488,6 +672,8 @@ static const struct option lgopts[] = {
   {CMD_LINE_OPT_MAC_UPDATING, no_argument, &mac_updating, 1},
   {CMD_LINE_OPT_NO_MAC_UPDATING, no_argument, &mac_updating, 0},
   {CMD_LINE_OPT_PORTMAP_CONFIG, 1, 0, CMD_LINE_OPT_PORTMAP_NUM},
+  {CMD_LINE_OPT_SW_RSS, no_argument, &sw_rss, 1},
+  {CMD_LINE_OPT_RSS_L4, no_argument, &rss_l4, 1},
   {NULL, 0, 0, 0}};
 
 /* Parse the argument given in the command line of the application */
@@ -514,16 +700,6 @@ static int l2fwd_parse_args(int argc, char **argv) {
       }
       break;
 
-    /* nqueue */
-    case 'q':
-      l2fwd_rx_queue_per_lcore = l2fwd_parse_nqueue(optarg);
-      if (l2fwd_rx_queue_per_lcore == 0) {
-        printf("invalid queue number\n");
-        l2fwd_usage(prgname);
-        return -1;
-      }
-      break;
-
     /* timer period */
     case 'T':
       timer_secs = l2fwd_parse_timer_period(optarg);
@@ -545,6 +721,10 @@ static int l2fwd_parse_args(int argc, char **argv) {
       }
       break;
 
+    /* flag-only long options */
+    case 0:
+      break;
+
     default:
       l2fwd_usage(prgname);
       return -1;
@@ -669,10 +849,10 @@ int main(int argc, char **argv) {
   uint16_t nb_ports;
   uint16_t nb_ports_available = 0;
   uint16_t portid, last_port;
-  unsigned lcore_id, rx_lcore_id;
+  unsigned lcore_id, worker_id;
   unsigned nb_ports_in_mask = 0;
-  unsigned int nb_lcores = 0;
   unsigned int nb_mbufs;
+  uint16_t nb_rx_queues, queueid;
 
   /* init EAL */
   ret = rte_eal_init(argc, argv);
@@ -694,6 +874,7 @@ int main(int argc, char **argv) {
 
   /* convert to number of cycles */
   timer_period *= rte_get_timer_hz();
+  tsc_per_us = (rte_get_tsc_hz() + US_PER_S - 1) / US_PER_S;
 
   nb_ports = rte_eth_dev_count_avail();
   if (nb_ports == 0)
@@ -744,42 +925,17 @@ int main(int argc, char **argv) {
     }
   }
 
-  rx_lcore_id = 0;
-  qconf = NULL;
-
-  /* Initialize the port/queue configuration of each logical core */
-  RTE_ETH_FOREACH_DEV(portid) {
-    /* skip ports that are not enabled */
-    if ((l2fwd_enabled_port_mask & (1 << portid)) == 0)
-      continue;
-
-    /* get the lcore_id for this port */
-    while (rte_lcore_is_enabled(rx_lcore_id) == 0 ||
-           lcore_queue_conf[rx_lcore_id].n_rx_port ==
-             l2fwd_rx_queue_per_lcore) {
-      rx_lcore_id++;
-      if (rx_lcore_id >= RTE_MAX_LCORE)
-        rte_exit(EXIT_FAILURE, "Not enough cores\n");
-    }
-
-    if (qconf != &lcore_queue_conf[rx_lcore_id]) {
-      /* Assigned a new logical core in the loop above. */
-      qconf = &lcore_queue_conf[rx_lcore_id];
-      nb_lcores++;
-    }
-
-    qconf->rx_port_list[qconf->n_rx_port] = portid;
-    qconf->n_rx_port++;
-    printf(
-      "Lcore %u: RX port %u TX port %u\n",
-      rx_lcore_id,
-      portid,
-      l2fwd_dst_ports[portid]);
+  /* every enabled lcore (main included) is a worker */
+  RTE_LCORE_FOREACH(lcore_id) {
+    lcore_queue_conf[lcore_id].worker_id = nb_workers;
+    worker_lcore[nb_workers] = lcore_id;
+    nb_workers++;
   }
 
   nb_mbufs = RTE_MAX(
-    nb_ports *
-      (nb_rxd + nb_txd + MAX_PKT_BURST + nb_lcores * MEMPOOL_CACHE_SIZE),
+    nb_ports * nb_workers *
+        (nb_rxd + nb_txd + MAX_PKT_BURST + MEMPOOL_CACHE_SIZE) +
+      nb_workers * SW_RING_SIZE,
     8192U);
 
   /* create the mbuf pool */
@@ -821,7 +977,36 @@ int main(int argc, char **argv) {
 
     if (dev_info.tx_offload_capa & DEV_TX_OFFLOAD_MBUF_FAST_FREE)
       local_port_conf.txmode.offloads |= DEV_TX_OFFLOAD_MBUF_FAST_FREE;
-    ret = rte_eth_dev_configure(portid, 1, 1, &local_port_conf);
+
+    /* one RX queue per worker with symmetric RSS, or a single RX queue
+     * distributed in software */
+    uint64_t rss_hf = ETH_RSS_IP;
+    if (rss_l4)
+      rss_hf |= ETH_RSS_TCP | ETH_RSS_UDP;
+    rss_hf &= dev_info.flow_type_rss_offloads;
+    if (nb_workers > 1 && !sw_rss && rss_hf != 0 &&
+        dev_info.max_rx_queues >= nb_workers &&
+        dev_info.hash_key_size <= RSS_KEY_MAX_LEN) {
+      local_port_conf.rxmode.mq_mode = ETH_MQ_RX_RSS;
+      local_port_conf.rx_adv_conf.rss_conf.rss_key = rss_symmetric_key;
+      local_port_conf.rx_adv_conf.rss_conf.rss_key_len =
+        dev_info.hash_key_size ? dev_info.hash_key_size : 40;
+      local_port_conf.rx_adv_conf.rss_conf.rss_hf = rss_hf;
+      nb_rx_queues = nb_workers;
+      sw_rss_port[portid] = 0;
+    } else {
+      nb_rx_queues = 1;
+      sw_rss_port[portid] = nb_workers > 1;
+    }
+    nb_tx_queues[portid] = RTE_MIN(nb_workers, dev_info.max_tx_queues);
+    printf(
+      "%u RX queue(s)%s, %u TX queue(s)... ",
+      nb_rx_queues,
+      sw_rss_port[portid] ? " with software RSS" : "",
+      nb_tx_queues[portid]);
+
+    ret = rte_eth_dev_configure(
+      portid, nb_rx_queues, nb_tx_queues[portid], &local_port_conf);
     if (ret < 0)
       rte_exit(
         EXIT_FAILURE,
@@ -842,52 +1027,79 @@ int main(int argc, char **argv) {
       rte_exit(
         EXIT_FAILURE, "Cannot get MAC address: err=%d, port=%u\n", ret, portid);
 
-    /* init one RX queue */
+    /* init RX queues, queue i is polled by worker i */
     fflush(stdout);
     rxq_conf = dev_info.default_rxconf;
     rxq_conf.offloads = local_port_conf.rxmode.offloads;
-    ret = rte_eth_rx_queue_setup(
-      portid,
-      0,
-      nb_rxd,
-      rte_eth_dev_socket_id(portid),
-      &rxq_conf,
-      l2fwd_pktmbuf_pool);
-    if (ret < 0)
-      rte_exit(
-        EXIT_FAILURE, "rte_eth_rx_queue_setup:err=%d, port=%u\n", ret, portid);
+    for (queueid = 0; queueid < nb_rx_queues; queueid++) {
+      ret = rte_eth_rx_queue_setup(
+        portid,
+        queueid,
+        nb_rxd,
+        rte_eth_dev_socket_id(portid),
+        &rxq_conf,
+        l2fwd_pktmbuf_pool);
+      if (ret < 0)
+        rte_exit(
+          EXIT_FAILURE,
+          "rte_eth_rx_queue_setup:err=%d, port=%u, queue=%u\n",
+          ret,
+          portid,
+          queueid);
+
+      qconf = &lcore_queue_conf[worker_lcore[queueid]];
+      if (qconf->n_rx_queue == MAX_RX_QUEUE_PER_LCORE)
+        rte_exit(EXIT_FAILURE, "Too many RX queues per lcore\n");
+      qconf->rx_queue_list[qconf->n_rx_queue].port_id = portid;
+      qconf->rx_queue_list[qconf->n_rx_queue].queue_id = queueid;
+      qconf->n_rx_queue++;
+    }
 
-    /* init one TX queue on each port */
+    /* init TX queues */
     fflush(stdout);
     txq_conf = dev_info.default_txconf;
     txq_conf.offloads = local_port_conf.txmode.offloads;
-    ret = rte_eth_tx_queue_setup(
-      portid, 0, nb_txd, rte_eth_dev_socket_id(portid), &txq_conf);
-    if (ret < 0)
-      rte_exit(
-        EXIT_FAILURE, "rte_eth_tx_queue_setup:err=%d, port=%u\n", ret, portid);
-
-    /* Initialize TX buffers */
-    tx_buffer[portid] = rte_zmalloc_socket(
-      "tx_buffer",
-      RTE_ETH_TX_BUFFER_SIZE(MAX_PKT_BURST),
-      0,
-      rte_eth_dev_socket_id(portid));
-    if (tx_buffer[portid] == NULL)
-      rte_exit(
-        EXIT_FAILURE, "Cannot allocate buffer for tx on port %u\n", portid);
-
-    rte_eth_tx_buffer_init(tx_buffer[portid], MAX_PKT_BURST);
+    for (queueid = 0; queueid < nb_tx_queues[portid]; queueid++) {
+      ret = rte_eth_tx_queue_setup(
+        portid, queueid, nb_txd, rte_eth_dev_socket_id(portid), &txq_conf);
+      if (ret < 0)
+        rte_exit(
+          EXIT_FAILURE,
+          "rte_eth_tx_queue_setup:err=%d, port=%u, queue=%u\n",
+          ret,
+          portid,
+          queueid);
+      rte_spinlock_init(&tx_lock[portid][queueid]);
+    }
 
-    ret = rte_eth_tx_buffer_set_err_callback(
-      tx_buffer[portid],
-      rte_eth_tx_buffer_count_callback,
-      &port_statistics[portid].dropped);
-    if (ret < 0)
-      rte_exit(
-        EXIT_FAILURE,
-        "Cannot set error callback for tx buffer on port %u\n",
-        portid);
+    /* Initialize TX buffers, one per worker */
+    for (worker_id = 0; worker_id < nb_workers; worker_id++) {
+      lcore_id = worker_lcore[worker_id];
+      qconf = &lcore_queue_conf[lcore_id];
+      qconf->tx_buffer[portid] = rte_zmalloc_socket(
+        "tx_buffer",
+        RTE_ETH_TX_BUFFER_SIZE(MAX_PKT_BURST),
+        0,
+        rte_lcore_to_socket_id(lcore_id));
+      if (qconf->tx_buffer[portid] == NULL)
+        rte_exit(
+          EXIT_FAILURE,
+          "Cannot allocate buffer for tx on port %u, lcore %u\n",
+          portid,
+          lcore_id);
+
+      rte_eth_tx_buffer_init(qconf->tx_buffer[portid], MAX_PKT_BURST);
+
+      ret = rte_eth_tx_buffer_set_err_callback(
+        qconf->tx_buffer[portid],
+        rte_eth_tx_buffer_count_callback,
+        &qconf->port_statistics[portid].dropped);
+      if (ret < 0)
+        rte_exit(
+          EXIT_FAILURE,
+          "Cannot set error callback for tx buffer on port %u\n",
+          portid);
+    }
 
     ret = rte_eth_dev_set_ptypes(portid, RTE_PTYPE_UNKNOWN, NULL, 0);
     if (ret < 0)
@@ -919,7 +1131,11 @@ int main(int argc, char **argv) {
       l2fwd_ports_eth_addr[portid].addr_bytes[5]);
 
     /* initialize port stats */
-    memset(&port_statistics, 0, sizeof(port_statistics));
+    for (worker_id = 0; worker_id < nb_workers; worker_id++)
+      memset(
+        &lcore_queue_conf[worker_lcore[worker_id]].port_statistics[portid],
+        0,
+        sizeof(struct l2fwd_port_statistics));
   }
 
   if (!nb_ports_available) {
@@ -929,23 +1145,32 @@ int main(int argc, char **argv) {
 
   check_all_ports_link_status(l2fwd_enabled_port_mask);
 
-  /* initial Rubik runtime */
-  WV_Runtime *runtime;
-  if (!(runtime = WV_AllocRuntime())) {
-    fprintf(stderr, "runtime initialization fail\n");
-    return 1;
+  /* rings feeding workers from software RSS ports, each has worker 0 as its
+   * only producer */
+  RTE_ETH_FOREACH_DEV(portid) {
+    if ((l2fwd_enabled_port_mask & (1 << portid)) == 0 || !sw_rss_port[portid])
+      continue;
+    for (worker_id = 1; worker_id < nb_workers; worker_id++) {
+      char ring_name[RTE_RING_NAMESIZE];
+      lcore_id = worker_lcore[worker_id];
+      snprintf(ring_name, sizeof(ring_name), "sw_rss_%u", lcore_id);
+      lcore_queue_conf[lcore_id].sw_ring = rte_ring_create(
+        ring_name,
+        SW_RING_SIZE,
+        rte_lcore_to_socket_id(lcore_id),
+        RING_F_SP_ENQ | RING_F_SC_DEQ);
+      if (lcore_queue_conf[lcore_id].sw_ring == NULL)
+        rte_exit(
+          EXIT_FAILURE, "Cannot create software RSS ring for lcore %u\n", lcore_id);
+    }
+    break;
   }
 
   // #ifdef STRING_FINDER
   //   init_pcre();
   // #endif
 
-  DPDKUser user = {.runtime = runtime, .port = 0};
-  dpdk_user = &user;
-
-  gettimeofday(&milestone, NULL);
-  WV_ProfileStart(WV_GetProfile(runtime));
-
+  /* the Rubik runtime of each worker is allocated on its own lcore */
   ret = 0;
   /* launch per-lcore init on every lcore */
   rte_eal_mp_remote_launch(l2fwd_launch_one_lcore, NULL, CALL_MAIN);
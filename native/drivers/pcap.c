@@ -17,27 +17,95 @@ void ctrl_c_handler(int sig) {
     ctrl_c = 1;
 }
 
+#define MAX_BURST 64
+
 typedef struct {
     WV_Runtime *runtime;
     pcap_t *pcap;
+    WV_U32 burst;
+    WV_Byte *burst_buffer;
+    // range of capture time in the trace, and how far the current loop is shifted
+    WV_U64 ts_min, ts_max, ts_offset;
 } PcapUser;
 
+// capture time drives instance expiry, so replaying faster than real time
+// still expires flows as they were in the trace
+// every loop of replaying is shifted after the previous one, otherwise clock would stall
+// at the end of the trace, and nothing would expire since the second loop
+static inline WV_U64 pcap_ts(PcapUser *user, const struct pcap_pkthdr *pcap_header) {
+    WV_U64 ts = (WV_U64)pcap_header->ts.tv_sec * 1000000 + pcap_header->ts.tv_usec;
+    if (ts < user->ts_min) {
+        user->ts_min = ts;
+    }
+    if (ts > user->ts_max) {
+        user->ts_max = ts;
+    }
+    return ts + user->ts_offset;
+}
+
+static inline void pcap_next_loop(PcapUser *user) {
+    if (user->ts_min <= user->ts_max) {
+        user->ts_offset += user->ts_max - user->ts_min + 1000000 / WV_CONFIG_TimerHz;
+    }
+}
+
 void proc(WV_Byte *user, const struct pcap_pkthdr *pcap_header, const WV_Byte *pcap_data) {
     WV_Runtime *runtime = ((PcapUser *)user)->runtime;
-    WV_ByteSlice packet = { .cursor = pcap_data, .length = pcap_header->len };
-    WV_U8 status = WV_ProcessPacket(packet, runtime);
+    // only captured bytes are parsed for a truncated packet
+    WV_ByteSlice packet = { .cursor = pcap_data, .length = pcap_header->caplen };
+    WV_U8 status = WV_ProcessPacketTs(packet, pcap_ts((PcapUser *)user, pcap_header), runtime);
     WV_ProfileRecord(WV_GetProfile(runtime), pcap_header->len, status);
     if (ctrl_c) {
         pcap_breakloop(((PcapUser *)user)->pcap);
     }
 }
 
+// libpcap reuses its buffer for every read, so packets are copied into
+// burst_buffer to keep a whole burst alive until WV_ProcessBurstTs returns
+void proc_burst(PcapUser *user) {
+    WV_ByteSlice packets[MAX_BURST];
+    WV_U64 ts[MAX_BURST];
+    WV_U32 lengths[MAX_BURST];
+    WV_U8 statuses[MAX_BURST];
+    WV_U32 snaplen = pcap_snapshot(user->pcap);
+    struct pcap_pkthdr *pcap_header;
+    const WV_Byte *pcap_data;
+    int ret = 1;
+    while (ret == 1 && !ctrl_c) {
+        WV_U32 count = 0;
+        while (count < user->burst && (ret = pcap_next_ex(user->pcap, &pcap_header, &pcap_data)) == 1) {
+            WV_U32 caplen = pcap_header->caplen < snaplen ? pcap_header->caplen : snaplen;
+            WV_Byte *copy = user->burst_buffer + count * snaplen;
+            memcpy(copy, pcap_data, caplen);
+            packets[count].cursor = copy;
+            packets[count].length = caplen;
+            ts[count] = pcap_ts(user, pcap_header);
+            lengths[count] = pcap_header->len;
+            count += 1;
+        }
+        if (count == 0) {
+            break;
+        }
+        WV_ProcessBurstTs(packets, ts, count, statuses, user->runtime);
+        for (WV_U32 i = 0; i < count; i += 1) {
+            WV_ProfileRecord(WV_GetProfile(user->runtime), lengths[i], statuses[i]);
+        }
+    }
+}
+
 int main(int argc, char *argv[]) {
     char *pcap_filename = NULL;
     WV_U8 no_loop = 0;
+    WV_U32 burst = 1;
     for (int i = 1; i < argc; i += 1) {
         if (strcmp(argv[i], "--noloop") == 0) {
             no_loop = 1;
+        } else if (strcmp(argv[i], "--burst") == 0 && i + 1 < argc) {
+            burst = atoi(argv[++i]);
+            if (burst < 1 || burst > MAX_BURST) {
+                fprintf(stderr, "burst size should be in 1..%d\n", MAX_BURST);
+                return 1;
+            }
         } else {
             pcap_filename = argv[i];
         }
@@ -60,13 +128,29 @@ int main(int argc, char *argv[]) {
         return 1;
     }
 
-    PcapUser user = { .runtime = runtime, .pcap = pcap_packets };
+    PcapUser user = {
+        .runtime = runtime,
+        .pcap = pcap_packets,
+        .burst = burst,
+        .burst_buffer = NULL,
+        .ts_min = (WV_U64)-1,
+        .ts_max = 0,
+        .ts_offset = 0,
+    };
+    if (burst > 1 && !(user.burst_buffer = malloc(burst * pcap_snapshot(pcap_packets)))) {
+        fprintf(stderr, "burst buffer allocation fail\n");
+        return 1;
+    }
 
     signal(SIGINT, ctrl_c_handler);
     WV_Setup();
     WV_ProfileStart(WV_GetProfile(runtime));
     for (;;) {
-        pcap_loop(pcap_packets, -1, proc, (void *)&user);
+        if (burst > 1) {
+            proc_burst(&user);
+        } else {
+            pcap_loop(pcap_packets, -1, proc, (void *)&user);
+        }
         pcap_close(pcap_packets);
         if (ctrl_c || no_loop) {
             break;
@@ -76,7 +160,10 @@ int main(int argc, char *argv[]) {
             fprintf(stderr, "pcap_open_offline: %s\n", errbuf);
             return 1;
         }
+        user.pcap = pcap_packets;
+        pcap_next_loop(&user);
     }
+    free(user.burst_buffer);
 
     WV_ProfileRecordPrint(WV_GetProfile(runtime));
     if (WV_FreeRuntime(runtime)) {
@@ -0,0 +1,159 @@
+#ifndef WEAVER_RUNTIME_OATABLE_H
+#define WEAVER_RUNTIME_OATABLE_H
+
+#include "malloc.h"
+#include "types.h"
+#include <string.h>
+
+// Open addressing table with linear probing
+// every slot keeps the hash of its object inline as a fingerprint of key, so probing
+// only touches objects whose hashes are equal, and growing never touches objects
+// removing shifts following slots backward instead of leaving tombstones
+// a slot is empty if its data is NULL
+// the table doubles when load factor exceeds WV_CONFIG_OATableLoad percent, which
+// can be avoided by a large enough initial capacity
+
+#define WV_CONFIG_OATableLoad 75
+#define WV_CONFIG_OATableMinSize 16
+
+typedef int WV_OATableEq(const void* key, const void* object);
+
+typedef struct {
+    WV_U64 hash;
+    WV_Any data;
+} WV_OATableSlot;
+
+typedef struct {
+    WV_OATableSlot* slot;
+    WV_U64 mask;
+    WV_U64 count;
+} WV_OATable;
+
+static inline WV_U8 WV_OATableAlloc(WV_OATable* table, WV_U64 size)
+{
+    if (!(table->slot = WV_Malloc(sizeof(WV_OATableSlot) * size))) {
+        return 1;
+    }
+    memset(table->slot, 0, sizeof(WV_OATableSlot) * size);
+    table->mask = size - 1;
+    return 0;
+}
+
+// capacity is the expected count of objects, 0 for default
+static inline WV_U8 WV_InitOATable(WV_OATable* table, WV_U64 capacity)
+{
+    WV_U64 size = WV_CONFIG_OATableMinSize;
+    while (size * WV_CONFIG_OATableLoad < capacity * 100) {
+        size <<= 1;
+    }
+    table->count = 0;
+    return WV_OATableAlloc(table, size);
+}
+
+static inline WV_U8 WV_CleanOATable(WV_OATable* table)
+{
+    WV_Free(table->slot);
+    table->slot = NULL;
+    table->count = 0;
+    return 0;
+}
+
+static inline WV_U64 WV_OATableCount(WV_OATable* table)
+{
+    return table->count;
+}
+
+// home slot of hash, for prefetching
+static inline WV_OATableSlot* WV_OATableSlotOf(WV_OATable* table, WV_U64 hash)
+{
+    return &table->slot[hash & table->mask];
+}
+
+static inline void WV_OATablePlace(WV_OATable* table, WV_Any data, WV_U64 hash)
+{
+    WV_U64 i = hash & table->mask;
+    while (table->slot[i].data != NULL) {
+        i = (i + 1) & table->mask;
+    }
+    table->slot[i].hash = hash;
+    table->slot[i].data = data;
+}
+
+static inline WV_U8 WV_OATableGrow(WV_OATable* table)
+{
+    WV_OATableSlot* old_slot = table->slot;
+    WV_U64 old_size = table->mask + 1;
+    if (WV_OATableAlloc(table, old_size << 1)) {
+        table->slot = old_slot;
+        return 1;
+    }
+    for (WV_U64 i = 0; i < old_size; i += 1) {
+        if (old_slot[i].data != NULL) {
+            WV_OATablePlace(table, old_slot[i].data, old_slot[i].hash);
+        }
+    }
+    WV_Free(old_slot);
+    return 0;
+}
+
+static inline void WV_OATableInsert(WV_OATable* table, WV_Any data, WV_U64 hash)
+{
+    if ((table->count + 1) * 100 > (table->mask + 1) * WV_CONFIG_OATableLoad) {
+        WV_OATableGrow(table);
+    }
+    WV_OATablePlace(table, data, hash);
+    table->count += 1;
+}
+
+static inline WV_U64 WV_OATableFind(WV_OATable* table, WV_OATableEq* eq, const void* key, WV_U64 hash)
+{
+    WV_U64 i = hash & table->mask;
+    while (table->slot[i].data != NULL) {
+        if (table->slot[i].hash == hash && eq(key, table->slot[i].data) == 0) {
+            return i;
+        }
+        i = (i + 1) & table->mask;
+    }
+    return table->mask + 1;
+}
+
+static inline WV_Any WV_OATableSearch(WV_OATable* table, WV_OATableEq* eq, const void* key, WV_U64 hash)
+{
+    WV_U64 i = WV_OATableFind(table, eq, key, hash);
+    return i > table->mask ? NULL : table->slot[i].data;
+}
+
+// first object with the hash, which is probably the one searched later
+static inline WV_Any WV_OATableBucket(WV_OATable* table, WV_U64 hash)
+{
+    WV_U64 i = hash & table->mask;
+    while (table->slot[i].data != NULL) {
+        if (table->slot[i].hash == hash) {
+            return table->slot[i].data;
+        }
+        i = (i + 1) & table->mask;
+    }
+    return NULL;
+}
+
+static inline WV_Any WV_OATableRemove(WV_OATable* table, WV_OATableEq* eq, const void* key, WV_U64 hash)
+{
+    WV_U64 i = WV_OATableFind(table, eq, key, hash);
+    if (i > table->mask) {
+        return NULL;
+    }
+    WV_Any data = table->slot[i].data;
+    for (WV_U64 j = (i + 1) & table->mask; table->slot[j].data != NULL; j = (j + 1) & table->mask) {
+        // slot j may fill the hole only if its home is not in (i, j]
+        WV_U64 home = table->slot[j].hash & table->mask;
+        if (((j - home) & table->mask) >= ((j - i) & table->mask)) {
+            table->slot[i] = table->slot[j];
+            i = j;
+        }
+    }
+    table->slot[i].data = NULL;
+    table->count -= 1;
+    return data;
+}
+
+#endif
@@ -1,16 +1,28 @@
 #include "profile.h"
+#include <stddef.h>
 #include <stdio.h>
 #include <string.h>
 #include <time.h>
 
 WV_U8 WV_ProfileStart(WV_Profile* profile)
 {
-    memset(profile, 0, sizeof(WV_Profile));
+    // slabs are registered on runtime allocation, which is earlier than start
+    memset(profile, 0, offsetof(WV_Profile, slab_list));
     WV_F current = clock() / CLOCKS_PER_SEC;
     profile->last_record_sec = current;
     profile->next_checkpoint_sec = (WV_U32)current + 1;
 }
 
+WV_U8 WV_ProfileWatchSlab(WV_Profile* profile, WV_SlabStat* stat)
+{
+    if (profile->slab_count == WV_CONFIG_ProfileSlabCount) {
+        return 1;
+    }
+    profile->slab_list[profile->slab_count] = stat;
+    profile->slab_count += 1;
+    return 0;
+}
+
 WV_U8 WV_ProfileRecord(WV_Profile* profile, WV_U32 byte_length, WV_U8 status)
 {
     // TODO: use status
@@ -52,5 +64,10 @@ WV_U8 WV_ProfileRecordPrint(WV_Profile* profile)
     throughput_avg /= count;
 
     printf("checkpoint: %f ms, throughput: %f(%f) Gbps (last %d avg.)\n", current * 1000, throughput, throughput_avg, count);
+    for (WV_U8 i = 0; i < profile->slab_count; i += 1) {
+        WV_SlabStat* stat = profile->slab_list[i];
+        printf("  slab %s: %lu/%lu in use (peak %lu), %u chunks\n", stat->name,
+            (unsigned long)stat->used, (unsigned long)stat->capacity, (unsigned long)stat->peak, stat->chunk_count);
+    }
     return 0;
 }
\ No newline at end of file
@@ -3,6 +3,17 @@
 
 #include "types.h"
 
+#define WV_CONFIG_ProfileSlabCount 16
+
+// occupancy of a slab, updated by slab.h
+typedef struct {
+    const char* name;
+    WV_U64 capacity;
+    WV_U64 used;
+    WV_U64 peak;
+    WV_U32 chunk_count;
+} WV_SlabStat;
+
 typedef struct _WV_Profile {
     WV_U64 interval_byte_count;
     WV_U32 interval_packet_count;
@@ -10,10 +21,15 @@ typedef struct _WV_Profile {
     WV_F last_record_sec;
     WV_F last_10_throughput[10];
     WV_U8 record_count;
+    // registered slabs, kept by WV_ProfileStart
+    WV_SlabStat* slab_list[WV_CONFIG_ProfileSlabCount];
+    WV_U8 slab_count;
 } WV_Profile;
 
 WV_U8 WV_ProfileStart(WV_Profile *);
 
+WV_U8 WV_ProfileWatchSlab(WV_Profile *, WV_SlabStat *);
+
 WV_U8 WV_ProfileRecord(WV_Profile *, WV_U32, WV_U8);
 
 WV_U8 WV_ProfileRecordPrint(WV_Profile *);
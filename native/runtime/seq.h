@@ -7,14 +7,101 @@
 #include <stdlib.h>
 #include <string.h>
 
+// default limit of nodes (i.e. separated segments) of one sequence
 #define WV_CONFIG_SeqNodeCount 32
+// default limit of buffered data of one sequence, must be power of 2
 #define WV_CONFIG_SeqBufferSize (8 * (1 << 10))
+// smallest buffer, which doubles until it is large enough or reaches the limit
+#define WV_CONFIG_SeqChunkSize (2 * (1 << 10))
+#define WV_CONFIG_SeqPoolMinSize 256
+#define WV_CONFIG_SeqClassCount 20
+
+// buffer is a ring, data at offset x is stored at buffer[x & (capacity - 1)], so sliding
+// the window never moves data, and assembled data is delivered in place, as one slice
+// or two if it wraps around
+//
+// in-order data is never buffered (see WV_SeqEmptyAlign), so buffer is only allocated
+// when out-of-order data arrives, from a pool shared by all sequences of a runtime, and
+// it is returned to the pool by the first inserting after all buffered data is assembled
+//
+// received segments are kept as nodes of a treap ordered by offset, so locating,
+// inserting, merging and removing a segment cost O(log n) expected for n segments
+// nodes are allocated from the pool as well, only while there is any node
+// define WV_CONFIG_SeqCheck to verify all nodes after every operation, which costs O(n)
+
+// free memory of size WV_CONFIG_SeqPoolMinSize << class
+typedef struct _WV_SeqChunk {
+    struct _WV_SeqChunk* next;
+} WV_SeqChunk;
+
+typedef struct {
+    WV_SeqChunk* free_list[WV_CONFIG_SeqClassCount];
+    WV_U32 seed; // for priority of nodes
+} WV_SeqPool;
+
+static inline WV_U8 WV_InitSeqPool(WV_SeqPool* pool)
+{
+    memset(pool, 0, sizeof(WV_SeqPool));
+    pool->seed = 2463534242;
+    return 0;
+}
+
+static inline WV_U8 WV_CleanSeqPool(WV_SeqPool* pool)
+{
+    for (WV_U32 i = 0; i < WV_CONFIG_SeqClassCount; i += 1) {
+        while (pool->free_list[i] != NULL) {
+            WV_SeqChunk* chunk = pool->free_list[i];
+            pool->free_list[i] = chunk->next;
+            WV_Free(chunk);
+        }
+    }
+    return 0;
+}
+
+static inline WV_U32 WV_SeqPoolClass(WV_U32 size)
+{
+    WV_U32 class = 0;
+    while ((WV_U32)WV_CONFIG_SeqPoolMinSize << class < size) {
+        class += 1;
+    }
+    assert(class < WV_CONFIG_SeqClassCount);
+    return class;
+}
+
+static inline WV_Any WV_SeqPoolAlloc(WV_SeqPool* pool, WV_U32 size)
+{
+    WV_U32 class = WV_SeqPoolClass(size);
+    WV_SeqChunk* chunk = pool->free_list[class];
+    if (chunk == NULL) {
+        return WV_Malloc((WV_U64)WV_CONFIG_SeqPoolMinSize << class);
+    }
+    pool->free_list[class] = chunk->next;
+    return chunk;
+}
+
+static inline void WV_SeqPoolFree(WV_SeqPool* pool, WV_Any memory, WV_U32 size)
+{
+    WV_U32 class = WV_SeqPoolClass(size);
+    WV_SeqChunk* chunk = memory;
+    chunk->next = pool->free_list[class];
+    pool->free_list[class] = chunk;
+}
 
 typedef struct {
     WV_U32 left;
     WV_U32 right;
 } WV_SeqMeta;
 
+#define WV_SEQ_NIL 0xffff
+
+// segment [left, right), which never overlaps or touches another one
+typedef struct {
+    WV_U32 left;
+    WV_U32 right;
+    WV_U32 priority;
+    WV_U16 child[2];
+} WV_SeqNode;
+
 struct WV_Seq;
 
 // universal signature for event handlers
@@ -27,25 +114,39 @@ static WV_U8 default_handler(struct WV_Seq *_seq, WV_ByteSlice _payload) {
 
 struct WV_Seq {
     WV_Byte* buffer;
+    WV_U32 capacity; // 0 if buffer is not allocated
+    WV_U32 limit;
+    WV_SeqPool* pool;
     WV_U32 offset;
     WV_U8 set_offset;
-    WV_SeqMeta nodes[WV_CONFIG_SeqNodeCount], postfix;
-    WV_U8 used_count;
+    WV_SeqNode* node; // NULL if there is no node
+    WV_U16 node_limit;
+    WV_U16 node_top; // nodes starting from here are never used since allocated
+    WV_U16 free_node;
+    WV_U16 root;
+    WV_U16 used_count;
+    WV_SeqMeta postfix;
     WV_U8 pre_done, post_start;
     WV_SeqEventHandler on_buffer_exceed, on_overlap, on_retex, on_out_of_window;
 };
 
 typedef struct WV_Seq WV_Seq;
 
-static inline WV_U8 WV_InitSeq(WV_Seq* seq, WV_U8 use_data, WV_U32 zero_base)
+// limit is the most data that could be buffered, which must be power of 2
+// node_limit is the most segments that could be kept separated
+static inline WV_U8 WV_InitSeq(WV_Seq* seq, WV_SeqPool* pool, WV_U32 limit, WV_U16 node_limit, WV_U8 use_data, WV_U32 zero_base)
 {
-    if (use_data) {
-        seq->buffer = WV_Malloc(sizeof(WV_Byte) * WV_CONFIG_SeqBufferSize);
-    } else {
-        seq->buffer = NULL;
-    }
+    assert((limit & (limit - 1)) == 0);
+    assert(node_limit > 0 && node_limit < WV_SEQ_NIL);
+    seq->buffer = NULL;
+    seq->capacity = 0;
+    seq->limit = limit;
+    seq->pool = pool;
     seq->offset = 0;
     seq->set_offset = !zero_base;
+    seq->node = NULL;
+    seq->node_limit = node_limit;
+    seq->root = WV_SEQ_NIL;
     seq->used_count = 0;
     seq->postfix = (WV_SeqMeta){ .left = 0, .right = 0 };
     seq->pre_done = seq->post_start = 0;
@@ -53,59 +154,305 @@ static inline WV_U8 WV_InitSeq(WV_Seq* seq, WV_U8 use_data, WV_U32 zero_base)
     return 0;
 }
 
-static inline WV_U8 WV_CleanSeq(WV_Seq* seq, WV_U8 use_data)
+static inline void _SeqRelease(WV_Seq* seq)
+{
+    if (seq->capacity != 0) {
+        WV_SeqPoolFree(seq->pool, seq->buffer, seq->capacity);
+        seq->buffer = NULL;
+        seq->capacity = 0;
+    }
+}
+
+// return nodes to pool if there is no node
+static inline void _NodeRelease(WV_Seq* seq)
 {
-    if (use_data) {
-        WV_Free(seq->buffer);
+    if (seq->used_count == 0 && seq->node != NULL) {
+        WV_SeqPoolFree(seq->pool, seq->node, sizeof(WV_SeqNode) * seq->node_limit);
+        seq->node = NULL;
+        seq->root = WV_SEQ_NIL;
     }
+}
+
+static inline WV_U8 WV_CleanSeq(WV_Seq* seq, WV_U8 use_data)
+{
+    _SeqRelease(seq);
+    seq->used_count = 0;
+    _NodeRelease(seq);
     return 0;
 }
 
-static inline WV_U8 WV_SeqEmptyAlign(WV_Seq* seq, WV_U32 offset, WV_ByteSlice data, WV_U32 takeup_length)
+// return WV_SEQ_NIL if node_limit is reached or allocating fails
+static inline WV_U16 _NodeAlloc(WV_Seq* seq, WV_U32 left, WV_U32 right)
 {
-    // printf("EmptyAlign\n");
-    return seq->used_count == 0 && seq->offset == offset && data.length == takeup_length;
+    if (seq->node == NULL) {
+        if (!(seq->node = WV_SeqPoolAlloc(seq->pool, sizeof(WV_SeqNode) * seq->node_limit))) {
+            return WV_SEQ_NIL;
+        }
+        seq->node_top = 0;
+        seq->free_node = WV_SEQ_NIL;
+        seq->root = WV_SEQ_NIL;
+    }
+    WV_U16 n;
+    if (seq->free_node != WV_SEQ_NIL) {
+        n = seq->free_node;
+        seq->free_node = seq->node[n].child[0];
+    } else if (seq->node_top < seq->node_limit) {
+        n = seq->node_top;
+        seq->node_top += 1;
+    } else {
+        return WV_SEQ_NIL;
+    }
+    // xorshift
+    WV_U32 seed = seq->pool->seed;
+    seed ^= seed << 13;
+    seed ^= seed >> 17;
+    seed ^= seed << 5;
+    seq->pool->seed = seed;
+    seq->node[n] = (WV_SeqNode){ .left = left, .right = right, .priority = seed, .child = { WV_SEQ_NIL, WV_SEQ_NIL } };
+    seq->used_count += 1;
+    return n;
 }
 
-static inline WV_U8 _AssertNodes(WV_Seq* seq)
+// split tree t into nodes whose left < key and the others
+static inline void _NodeSplit(WV_Seq* seq, WV_U16 t, WV_U32 key, WV_U16* lo, WV_U16* hi)
 {
-    // printf("%u\n", seq->post_start);
-    for (WV_U8 i = 0; i < seq->used_count; i += 1) {
-        assert(seq->nodes[i].left < seq->nodes[i].right);
-        assert(seq->nodes[i].left >= seq->offset);
-        assert(seq->nodes[i].right - seq->offset <= WV_CONFIG_SeqBufferSize);
+    if (t == WV_SEQ_NIL) {
+        *lo = *hi = WV_SEQ_NIL;
+    } else if (seq->node[t].left < key) {
+        *lo = t;
+        _NodeSplit(seq, seq->node[t].child[1], key, &seq->node[t].child[1], hi);
+    } else {
+        *hi = t;
+        _NodeSplit(seq, seq->node[t].child[0], key, lo, &seq->node[t].child[0]);
     }
-    for (WV_U8 i = 1; i < seq->used_count; i += 1) {
-        assert(seq->nodes[i - 1].right < seq->nodes[i].left);
+}
+
+// every node of a is before every node of b
+static inline WV_U16 _NodeMerge(WV_Seq* seq, WV_U16 a, WV_U16 b)
+{
+    if (a == WV_SEQ_NIL) {
+        return b;
     }
-    // printf("%u\n", seq->post_start);
-    if (seq->post_start) {
-        assert(seq->postfix.left < seq->postfix.right);
-        // assert(seq->postfix.left >= seq->offset);
+    if (b == WV_SEQ_NIL) {
+        return a;
     }
-    if (seq->post_start && seq->used_count != 0) {
-        assert(seq->nodes[seq->used_count - 1].right <= seq->postfix.left);
+    if (seq->node[a].priority > seq->node[b].priority) {
+        seq->node[a].child[1] = _NodeMerge(seq, seq->node[a].child[1], b);
+        return a;
     }
-    return 0;
+    seq->node[b].child[0] = _NodeMerge(seq, a, seq->node[b].child[0]);
+    return b;
 }
 
-static inline WV_U8 _InsertNode(WV_Seq* seq, WV_U8 index)
+static inline void _NodeInsert(WV_Seq* seq, WV_U16 n)
 {
-    assert(seq->used_count < WV_CONFIG_SeqNodeCount - 1);
-    for (WV_U8 i = seq->used_count; i > index; i -= 1) {
-        seq->nodes[i] = seq->nodes[i - 1];
-    }
-    seq->used_count += 1;
-    return 0;
+    WV_U16 lo, hi;
+    _NodeSplit(seq, seq->root, seq->node[n].left, &lo, &hi);
+    seq->root = _NodeMerge(seq, _NodeMerge(seq, lo, n), hi);
 }
 
-static inline WV_U8 _RemoveNode(WV_Seq* seq, WV_U8 index)
+static inline WV_U16 _NodeErase(WV_Seq* seq, WV_U16 t, WV_U32 left)
 {
-    assert(seq->used_count > index);
-    for (WV_U8 i = index; i < seq->used_count; i += 1) {
-        seq->nodes[i] = seq->nodes[i + 1];
+    if (seq->node[t].left == left) {
+        return _NodeMerge(seq, seq->node[t].child[0], seq->node[t].child[1]);
     }
+    WV_U8 dir = left > seq->node[t].left;
+    seq->node[t].child[dir] = _NodeErase(seq, seq->node[t].child[dir], left);
+    return t;
+}
+
+static inline void _NodeFree(WV_Seq* seq, WV_U16 n)
+{
+    seq->node[n].child[0] = seq->free_node;
+    seq->free_node = n;
     seq->used_count -= 1;
+}
+
+static inline void _NodeRemove(WV_Seq* seq, WV_U16 n)
+{
+    seq->root = _NodeErase(seq, seq->root, seq->node[n].left);
+    _NodeFree(seq, n);
+}
+
+// free all nodes of tree t, which is detached already
+static inline void _NodeDrop(WV_Seq* seq, WV_U16 t)
+{
+    if (t != WV_SEQ_NIL) {
+        _NodeDrop(seq, seq->node[t].child[0]);
+        _NodeDrop(seq, seq->node[t].child[1]);
+        _NodeFree(seq, t);
+    }
+}
+
+// the first (dir = 0) or the last (dir = 1) node
+static inline WV_U16 _NodeEdge(WV_Seq* seq, WV_U8 dir)
+{
+    WV_U16 t = seq->used_count != 0 ? seq->root : WV_SEQ_NIL;
+    if (t != WV_SEQ_NIL) {
+        while (seq->node[t].child[dir] != WV_SEQ_NIL) {
+            t = seq->node[t].child[dir];
+        }
+    }
+    return t;
+}
+
+static inline WV_U16 _NodeFirst(WV_Seq* seq)
+{
+    return _NodeEdge(seq, 0);
+}
+
+static inline WV_U16 _NodeLast(WV_Seq* seq)
+{
+    return _NodeEdge(seq, 1);
+}
+
+// the last node whose left <= key
+static inline WV_U16 _NodeFloor(WV_Seq* seq, WV_U32 key)
+{
+    WV_U16 found = WV_SEQ_NIL;
+    for (WV_U16 t = seq->used_count != 0 ? seq->root : WV_SEQ_NIL; t != WV_SEQ_NIL;) {
+        if (seq->node[t].left <= key) {
+            found = t;
+            t = seq->node[t].child[1];
+        } else {
+            t = seq->node[t].child[0];
+        }
+    }
+    return found;
+}
+
+// the first node whose left > key
+static inline WV_U16 _NodeAfter(WV_Seq* seq, WV_U32 key)
+{
+    WV_U16 found = WV_SEQ_NIL;
+    for (WV_U16 t = seq->used_count != 0 ? seq->root : WV_SEQ_NIL; t != WV_SEQ_NIL;) {
+        if (seq->node[t].left > key) {
+            found = t;
+            t = seq->node[t].child[0];
+        } else {
+            t = seq->node[t].child[1];
+        }
+    }
+    return found;
+}
+
+// copy data into buffer at offset
+static inline void _RingWrite(WV_Seq* seq, WV_U32 offset, WV_ByteSlice data)
+{
+    WV_U32 pos = offset & (seq->capacity - 1);
+    WV_U32 first = seq->capacity - pos;
+    if (data.length <= first) {
+        WV_Memcpy(&seq->buffer[pos], data.cursor, data.length);
+    } else {
+        WV_Memcpy(&seq->buffer[pos], data.cursor, first);
+        WV_Memcpy(seq->buffer, data.cursor + first, data.length - first);
+    }
+}
+
+// data in buffer from offset, the second slice is empty if not wrapped
+static inline void _RingRead(WV_Seq* seq, WV_U32 offset, WV_U32 length, WV_ByteSlice iov[2])
+{
+    WV_U32 pos = offset & (seq->capacity - 1);
+    WV_U32 first = seq->capacity - pos;
+    if (length <= first) {
+        iov[0] = (WV_ByteSlice){ .cursor = &seq->buffer[pos], .length = length };
+        iov[1] = WV_EMPTY;
+    } else {
+        iov[0] = (WV_ByteSlice){ .cursor = &seq->buffer[pos], .length = first };
+        iov[1] = (WV_ByteSlice){ .cursor = seq->buffer, .length = length - first };
+    }
+}
+
+// copy stored data of tree t from buffer of seq into buffer of grown
+static inline void _RingMove(WV_Seq* seq, WV_Seq* grown, WV_U16 t)
+{
+    if (t == WV_SEQ_NIL) {
+        return;
+    }
+    _RingMove(seq, grown, seq->node[t].child[0]);
+    _RingMove(seq, grown, seq->node[t].child[1]);
+    WV_SeqNode* node = &seq->node[t];
+    if (node->left - seq->offset >= seq->capacity) {
+        // not stored yet, i.e. inserting node
+        return;
+    }
+    WV_U32 right = node->right - seq->offset <= seq->capacity ? node->right : seq->offset + seq->capacity;
+    WV_ByteSlice iov[2];
+    _RingRead(seq, node->left, right - node->left, iov);
+    _RingWrite(grown, node->left, iov[0]);
+    if (iov[1].length != 0) {
+        _RingWrite(grown, node->left + iov[0].length, iov[1]);
+    }
+}
+
+// make buffer hold data in [seq->offset, seq->offset + length), keeping buffered data
+// return the capacity, which is less than length if it exceeds limit or allocating fails
+static inline WV_U32 _SeqReserve(WV_Seq* seq, WV_U32 length)
+{
+    if (length <= seq->capacity || seq->capacity == seq->limit) {
+        return seq->capacity;
+    }
+    WV_U32 capacity = seq->capacity != 0 ? seq->capacity : WV_CONFIG_SeqChunkSize;
+    while (capacity < length && capacity < seq->limit) {
+        capacity <<= 1;
+    }
+    if (capacity > seq->limit) {
+        capacity = seq->limit;
+    }
+    WV_Byte* buffer = WV_SeqPoolAlloc(seq->pool, capacity);
+    if (buffer == NULL) {
+        return seq->capacity;
+    }
+    if (seq->capacity != 0) {
+        WV_Seq grown = *seq;
+        grown.buffer = buffer;
+        grown.capacity = capacity;
+        _RingMove(seq, &grown, seq->root);
+    }
+    _SeqRelease(seq);
+    seq->buffer = buffer;
+    seq->capacity = capacity;
+    return capacity;
+}
+
+static inline WV_U8 WV_SeqEmptyAlign(WV_Seq* seq, WV_U32 offset, WV_ByteSlice data, WV_U32 takeup_length)
+{
+    // printf("EmptyAlign\n");
+    return seq->used_count == 0 && seq->offset == offset && data.length == takeup_length;
+}
+
+#ifdef WV_CONFIG_SeqCheck
+// check nodes of tree t in order, return the count of them
+static inline WV_U16 _AssertTree(WV_Seq* seq, WV_U16 t, WV_U32* last_right)
+{
+    if (t == WV_SEQ_NIL) {
+        return 0;
+    }
+    WV_U16 count = _AssertTree(seq, seq->node[t].child[0], last_right);
+    WV_SeqNode* node = &seq->node[t];
+    assert(node->left < node->right);
+    assert(node->left >= seq->offset);
+    assert(node->right - seq->offset <= seq->limit);
+    assert(count == 0 || *last_right < node->left);
+    *last_right = node->right;
+    return count + 1 + _AssertTree(seq, node->child[1], last_right);
+}
+#endif
+
+static inline WV_U8 _AssertNodes(WV_Seq* seq)
+{
+#ifdef WV_CONFIG_SeqCheck
+    WV_U32 last_right = 0;
+    assert(_AssertTree(seq, seq->used_count != 0 ? seq->root : WV_SEQ_NIL, &last_right) == seq->used_count);
+#endif
+    // printf("%u\n", seq->post_start);
+    if (seq->post_start) {
+        assert(seq->postfix.left < seq->postfix.right);
+        // assert(seq->postfix.left >= seq->offset);
+    }
+    if (seq->post_start && seq->used_count != 0) {
+        assert(seq->node[_NodeLast(seq)].right <= seq->postfix.left);
+    }
     return 0;
 }
 
@@ -120,6 +467,10 @@ static inline WV_U8 WV_Insert(
 )
 {
     // printf("%u %u\n", takeup_length, data.length);
+    if (seq->used_count == 0) {
+        // nothing is buffered, and slices of last assembling are expired
+        _SeqRelease(seq);
+    }
     if (seq->set_offset) {
         seq->offset = offset;
         seq->set_offset = 0;
@@ -136,40 +487,39 @@ static inline WV_U8 WV_Insert(
     if (left != 0 || right != 0) {
         assert(left <= right);
 
-        while (seq->used_count > 0) {
-            if (seq->nodes[0].right <= left) {
-                _RemoveNode(seq, 0);
+        WV_U16 first;
+        while ((first = _NodeFirst(seq)) != WV_SEQ_NIL) {
+            if (seq->node[first].right <= left) {
+                _NodeRemove(seq, first);
             } else {
-                if (seq->nodes[0].left < left) {
-                    seq->nodes[0].left = left;
+                if (seq->node[first].left < left) {
+                    seq->node[first].left = left;
                 }
                 break;
             }
         }
-        for (WV_U8 i = 0; i < seq->used_count; i += 1) {
-            if (seq->nodes[i].right > right) {
-                if (seq->nodes[i].left >= right) {
-                    seq->used_count = i;
-                } else {
-                    seq->nodes[i].right = right;
-                    seq->used_count = i + 1;
-                }
-                break;
+        if (seq->used_count != 0) {
+            // nodes start at or after right are out of window
+            WV_U16 kept, dropped;
+            _NodeSplit(seq, seq->root, right, &kept, &dropped);
+            seq->root = kept;
+            _NodeDrop(seq, dropped);
+            WV_U16 last = _NodeLast(seq);
+            if (last != WV_SEQ_NIL && seq->node[last].right > right) {
+                seq->node[last].right = right;
             }
         }
         if (seq->offset < left) {
             // left expected data out of window
-            seq->on_out_of_window(seq, use_data ? ((WV_ByteSlice){ .cursor = seq->buffer, .length = left - seq->offset}) : WV_EMPTY);
-            if (use_data) {
-                for (WV_U8 i = 0; i < seq->used_count; i += 1) {
-                    assert(seq->nodes[i].left >= left);
-                    assert(seq->nodes[i].right - seq->offset <= WV_CONFIG_SeqBufferSize);
-                    memmove(
-                        &seq->buffer[seq->nodes[i].left - left],
-                        &seq->buffer[seq->nodes[i].left - seq->offset],
-                        seq->nodes[i].right - seq->nodes[i].left);
-                }
-                // printf("%u %u\n", seq->offset, left);
+            WV_ByteSlice skipped[2] = { WV_EMPTY, WV_EMPTY };
+            if (use_data && seq->capacity != 0) {
+                WV_U32 skipped_length = left - seq->offset;
+                _RingRead(seq, seq->offset, skipped_length < seq->capacity ? skipped_length : seq->capacity, skipped);
+            }
+            seq->on_out_of_window(seq, skipped[0]);
+            if (skipped[1].length != 0) {
+                // wrapped around the end of buffer
+                seq->on_out_of_window(seq, skipped[1]);
             }
             seq->offset = left;
         }
@@ -189,7 +539,7 @@ static inline WV_U8 WV_Insert(
             if (offset + takeup_length > right) {
                 // right out of window
                 // this is safe even data.length < takeup_length
-                seq->on_out_of_window(seq, WV_SliceAfter(data, offset + takeup_length - right));
+                seq->on_out_of_window(seq, WV_SliceAfter(data, right - offset));
                 takeup_length = right - offset;
                 if (offset + data.length > right) {
                     data = WV_SliceBefore(data, right - offset);
@@ -198,12 +548,8 @@ static inline WV_U8 WV_Insert(
         }
     }
     // printf("used_count: %u\n", seq->used_count);
-    assert(takeup_length < 3000);
     _AssertNodes(seq);
 
-    WV_U8 pos;
-    for (pos = 0; pos < seq->used_count && seq->nodes[pos].left < offset; pos += 1)
-        ;
     // printf("%u %u %u\n", seq->used_count, seq->post_start, seq->postfix.left);
     if (takeup_length != 0) {
         if (offset < seq->offset) {
@@ -216,45 +562,62 @@ static inline WV_U8 WV_Insert(
             data = WV_EMPTY;
         } else if (data.length != 0) {
             // assert(offset >= seq->offset);
-            if (pos != 0 && offset <= seq->nodes[pos - 1].right) {
+            WV_U16 prev = _NodeFloor(seq, offset);
+            WV_U16 cur;
+            if (prev != WV_SEQ_NIL && offset == seq->node[prev].left) {
+                // as if data is inserted before the node and merged with it
+                if (offset + data.length < seq->node[prev].right) {
+                    seq->on_overlap(seq, data);
+                } else {
+                    seq->on_retex(seq, WV_SliceBefore(data, seq->node[prev].right - seq->node[prev].left));
+                    seq->node[prev].right = offset + data.length;
+                }
+                cur = prev;
+            } else if (prev != WV_SEQ_NIL && offset <= seq->node[prev].right) {
                 // possible overlap/retrx
-                assert(offset >= seq->nodes[pos - 1].left);
-                if (offset + data.length > seq->nodes[pos - 1].right) {
-                    if (offset < seq->nodes[pos - 1].right) {
-                        seq->on_overlap(seq, WV_SliceBefore(data, seq->nodes[pos - 1].right - offset));
+                assert(offset >= seq->node[prev].left);
+                if (offset + data.length > seq->node[prev].right) {
+                    if (offset < seq->node[prev].right) {
+                        seq->on_overlap(seq, WV_SliceBefore(data, seq->node[prev].right - offset));
                     }
-                    seq->nodes[pos - 1].right = offset + data.length;
+                    seq->node[prev].right = offset + data.length;
                 } else {
                     seq->on_retex(seq, data);
                 }
-                pos = pos - 1;
-            } else {
-                _InsertNode(seq, pos);
-                seq->nodes[pos] = (WV_SeqMeta){ .left = offset, .right = offset + data.length };
+                cur = prev;
+            } else if ((cur = _NodeAlloc(seq, offset, offset + data.length)) != WV_SEQ_NIL) {
+                _NodeInsert(seq, cur);
             }
-            // printf("before while#1\n");
-            while (pos + 1 < seq->used_count && seq->nodes[pos].right >= seq->nodes[pos + 1].left) {
-                // possible overlap/retrx
-                if (seq->nodes[pos].right < seq->nodes[pos + 1].right) {
-                    if (seq->nodes[pos].right > seq->nodes[pos + 1].left) {
-                        seq->on_overlap(seq, WV_SliceBefore(
-                            WV_SliceAfter(data, seq->nodes[pos + 1].left - offset), seq->nodes[pos].right - seq->nodes[pos + 1].left));
+            if (cur == WV_SEQ_NIL) {
+                // too many holes
+                seq->on_buffer_exceed(seq, data);
+                data = WV_EMPTY;
+            } else {
+                // printf("before while#1\n");
+                WV_U16 next;
+                while ((next = _NodeAfter(seq, seq->node[cur].left)) != WV_SEQ_NIL && seq->node[cur].right >= seq->node[next].left) {
+                    // possible overlap/retrx
+                    if (seq->node[cur].right < seq->node[next].right) {
+                        if (seq->node[cur].right > seq->node[next].left) {
+                            seq->on_overlap(seq, WV_SliceBefore(
+                                WV_SliceAfter(data, seq->node[next].left - offset), seq->node[cur].right - seq->node[next].left));
+                        }
+                        seq->node[cur].right = seq->node[next].right;
+                    } else {
+                        seq->on_retex(seq, WV_SliceBefore(
+                                WV_SliceAfter(data, seq->node[next].left - offset), seq->node[next].right - seq->node[next].left));
                     }
-                    seq->nodes[pos].right = seq->nodes[pos + 1].right;
-                } else {
-                    seq->on_retex(seq, WV_SliceBefore(
-                            WV_SliceAfter(data, seq->nodes[pos + 1].left - offset), seq->nodes[pos + 1].right - seq->nodes[pos + 1].left));
+                    _NodeRemove(seq, next);
+                }
+                // printf("after while#1\n");
+                seq->pre_done = 1;
+
+                if (data.length != takeup_length && !seq->post_start) {
+                    assert(!seq->post_start);
+                    // printf("set post_start #1\n");
+                    seq->post_start = 1;
+                    seq->postfix = (WV_SeqMeta){ .left = offset + data.length, .right = offset + takeup_length };
                 }
-                _RemoveNode(seq, pos + 1);
-            }
-            // printf("after while#1\n");
-            seq->pre_done = 1;
-
-            if (data.length != takeup_length && !seq->post_start) {
-                assert(!seq->post_start);
-                // printf("set post_start #1\n");
-                seq->post_start = 1;
-                seq->postfix = (WV_SeqMeta){ .left = offset + data.length, .right = offset + takeup_length };
             }
         } else {
             if (seq->post_start) {
@@ -274,7 +637,7 @@ static inline WV_U8 WV_Insert(
                     seq->on_out_of_window(seq, data);
                 }
             } else {
-                if (seq->used_count == 0 || offset >= seq->nodes[seq->used_count - 1].right) {
+                if (seq->used_count == 0 || offset >= seq->node[_NodeLast(seq)].right) {
                     // printf("set post_start #2\n");
                     seq->post_start = 1;
                     seq->postfix = (WV_SeqMeta){ .left = offset, .right = offset + takeup_length };
@@ -285,15 +648,20 @@ static inline WV_U8 WV_Insert(
             }
         }
     }
-    if (seq->used_count > 0 && seq->nodes[seq->used_count - 1].right - seq->offset > WV_CONFIG_SeqBufferSize) {
+    WV_U16 last = _NodeLast(seq);
+    WV_U32 limit = seq->limit;
+    if (use_data && data.length != 0 && last != WV_SEQ_NIL) {
+        limit = _SeqReserve(seq, seq->node[last].right - seq->offset);
+    }
+    if (last != WV_SEQ_NIL && seq->node[last].right - seq->offset > limit) {
         seq->on_buffer_exceed(seq, data);
-        if (seq->nodes[seq->used_count - 1].left - seq->offset < WV_CONFIG_SeqBufferSize) {
+        if (seq->node[last].left - seq->offset < limit) {
             // right out of memory
-            seq->nodes[seq->used_count - 1].right = seq->offset + WV_CONFIG_SeqBufferSize;
-            data = WV_SliceBefore(data, seq->offset + WV_CONFIG_SeqBufferSize - offset);
+            seq->node[last].right = seq->offset + limit;
+            data = WV_SliceBefore(data, seq->offset + limit - offset);
         } else {
             // full out of memory
-            seq->used_count -= 1;
+            _NodeRemove(seq, last);
             data = WV_EMPTY;
         }
     }
@@ -301,60 +669,70 @@ static inline WV_U8 WV_Insert(
 
     if (use_data && data.length != 0) {
         assert(offset >= seq->offset);
-        assert(offset - seq->offset + data.length <= WV_CONFIG_SeqBufferSize);
-        // printf("memcpy (insert)\n");
-        WV_Memcpy(&seq->buffer[offset - seq->offset], data.cursor, data.length);
+        assert(offset - seq->offset + data.length <= seq->capacity);
+        _RingWrite(seq, offset, data);
     }
+    _NodeRelease(seq);
     return _AssertNodes(seq);
 }
 
 static inline WV_U8 WV_SeqReady(WV_Seq* seq)
 {
     // printf("used_count: %u\n", seq->used_count);
-    if (seq->used_count > 0 && seq->nodes[0].left != seq->offset) {
+    WV_U16 first = _NodeFirst(seq);
+    if (first != WV_SEQ_NIL && seq->node[first].left != seq->offset) {
         return 0;
     }
     // printf("offset: %u\n", seq->offset);
     if (!seq->post_start) {
         return 1;
     }
-    if (seq->used_count == 0) {
+    if (first == WV_SEQ_NIL) {
         // printf("offset: %u postfix.left: %u\n", seq->offset, seq->postfix.left);
         return seq->offset >= seq->postfix.left;
     } else {
-        // printf("nodes[0].right: %u postfix.left: %u\n", seq->nodes[0].right, seq->postfix.left);
-        return seq->nodes[0].right == seq->postfix.left;
+        // printf("nodes[0].right: %u postfix.left: %u\n", seq->node[first].right, seq->postfix.left);
+        return seq->node[first].right == seq->postfix.left;
     }
 }
 
-static inline WV_ByteSlice WV_SeqAssemble(WV_Seq* seq, WV_Byte** need_free, WV_U8 use_data)
+// take ready data out of seq, without copying
+// return total length, iov[1] is not empty only if data wraps around the end of buffer
+// slices are valid until next inserting
+static inline WV_U32 WV_SeqAssembleV(WV_Seq* seq, WV_ByteSlice iov[2], WV_U8 use_data)
 {
-    // printf("%u %u\n", seq->used_count, seq->offset);
-    if (seq->used_count == 0 || seq->nodes[0].left != seq->offset) {
-        *need_free = NULL;
-        return WV_EMPTY;
+    iov[0] = iov[1] = WV_EMPTY;
+    WV_U16 first = _NodeFirst(seq);
+    if (first == WV_SEQ_NIL || seq->node[first].left != seq->offset) {
+        return 0;
     }
-    WV_U32 ready_length = seq->nodes[0].right - seq->nodes[0].left;
-    if (seq->used_count == 1) {
-        *need_free = NULL;
-        seq->offset = seq->nodes[0].right;
-        seq->used_count = 0;
-        return (WV_ByteSlice){ .cursor = seq->buffer, .length = ready_length };
+    WV_U32 ready_length = seq->node[first].right - seq->node[first].left;
+    WV_U8 last_node = seq->used_count == 1;
+    seq->offset = seq->node[first].right;
+    _NodeRemove(seq, first);
+    _NodeRelease(seq);
+    if (use_data && seq->capacity != 0) {
+        _RingRead(seq, seq->offset - ready_length, ready_length, iov);
+    } else if (last_node) {
+        // length without data
+        iov[0] = (WV_ByteSlice){ .cursor = NULL, .length = ready_length };
     }
+    return ready_length;
+}
 
-    seq->offset = seq->nodes[0].right;
-    _RemoveNode(seq, 0);
-    if (use_data) {
-        WV_Byte* ready_buffer = WV_Malloc(sizeof(WV_Byte) * ready_length);
-        // printf("memcpy\n");
-        WV_Memcpy(ready_buffer, &seq->buffer[seq->nodes[0].left - seq->offset],
-            ready_length);
-        *need_free = ready_buffer;
-        return (WV_ByteSlice){ .cursor = ready_buffer, .length = ready_length };
-    } else {
-        *need_free = NULL;
-        return WV_EMPTY;
+// take ready data out of seq as one slice
+// data is in place unless it wraps around, in which case it is copied into scratch,
+// which should be able to hold limit bytes and live as long as the slice
+static inline WV_ByteSlice WV_SeqAssemble(WV_Seq* seq, WV_Byte* scratch, WV_U8 use_data)
+{
+    WV_ByteSlice iov[2];
+    WV_SeqAssembleV(seq, iov, use_data);
+    if (iov[1].length == 0) {
+        return iov[0];
     }
+    WV_Memcpy(scratch, iov[0].cursor, iov[0].length);
+    WV_Memcpy(scratch + iov[0].length, iov[1].cursor, iov[1].length);
+    return (WV_ByteSlice){ .cursor = scratch, .length = iov[0].length + iov[1].length };
 }
 
-#endif
\ No newline at end of file
+#endif
@@ -1,62 +1,506 @@
+#define WV_CONFIG_SeqCheck
 #include "seq.h"
 #include <assert.h>
 #include <stdlib.h>
 #include <string.h>
 
+WV_SeqPool pool;
+
 void test_create() {
   WV_Seq seq;
-  WV_InitSeq(&seq, 1, 0);
+  WV_InitSeq(&seq, &pool, WV_CONFIG_SeqBufferSize, WV_CONFIG_SeqNodeCount, 1, 0);
   WV_CleanSeq(&seq, 1);
 }
 
 void test_insert_in_order() {
   WV_Seq seq;
-  WV_InitSeq(&seq, 1, 0);
+  WV_InitSeq(&seq, &pool, WV_CONFIG_SeqBufferSize, WV_CONFIG_SeqNodeCount, 1, 0);
   WV_Byte buf[100];
+  static WV_Byte scratch[WV_CONFIG_SeqBufferSize];
   for (int i = 0; i < 100; i += 1) {
     memset(buf, i, sizeof(buf));
     WV_ByteSlice payload = {.cursor = buf, .length = sizeof(buf)};
     WV_Insert(&seq, i * sizeof(buf), payload, sizeof(buf), 1, 0, 65536);
-    WV_Byte *free_ptr;
-    WV_ByteSlice assembled = WV_SeqAssemble(&seq, &free_ptr, 1);
+    WV_ByteSlice assembled = WV_SeqAssemble(&seq, scratch, 1);
     assert(assembled.length == payload.length);
-    assert(
-      memcmp(assembled.cursor, payload.cursor, sizeof(assembled.length)) == 0);
-    if (free_ptr != NULL) {
-      free(free_ptr);
-    }
+    assert(memcmp(assembled.cursor, payload.cursor, assembled.length) == 0);
   }
   WV_CleanSeq(&seq, 1);
 }
 
 void test_insert_out_of_order() {
   WV_Seq seq;
-  WV_InitSeq(&seq, 1, 1);
+  WV_InitSeq(&seq, &pool, WV_CONFIG_SeqBufferSize, WV_CONFIG_SeqNodeCount, 1, 1);
   WV_Byte buf[100];
   memset(buf, 0xCC, sizeof(buf));
   WV_ByteSlice payload = {.cursor = buf, .length = sizeof(buf)};
   WV_Insert(&seq, sizeof(buf), payload, sizeof(buf), 1, 0, 65536);
-  WV_Byte *free_ptr;
-  assert(WV_SeqAssemble(&seq, &free_ptr, 1).length == 0);
+  static WV_Byte scratch[WV_CONFIG_SeqBufferSize];
+  assert(WV_SeqAssemble(&seq, scratch, 1).length == 0);
   memset(buf, 0xCD, sizeof(buf));
   WV_Insert(&seq, 0, payload, sizeof(buf), 1, 0, 65536);
-  WV_ByteSlice assembled = WV_SeqAssemble(&seq, &free_ptr, 1);
+  WV_ByteSlice assembled = WV_SeqAssemble(&seq, scratch, 1);
   assert(assembled.length == 2 * sizeof(buf));
   for (int i = 0; i < 2 * sizeof(buf); i += 1) {
     assert(assembled.cursor[i] == (i < sizeof(buf) ? 0xCD : 0xCC));
   }
-  if (free_ptr != NULL) {
-    free(free_ptr);
+  WV_CleanSeq(&seq, 1);
+}
+
+void test_assemble_in_place() {
+  WV_Seq seq;
+  WV_InitSeq(&seq, &pool, WV_CONFIG_SeqBufferSize, WV_CONFIG_SeqNodeCount, 1, 0);
+  WV_Byte buf[1000];
+  // wrap around several times inside window
+  for (int i = 0; i < 50; i += 1) {
+    memset(buf, i, sizeof(buf));
+    WV_ByteSlice payload = {.cursor = buf, .length = sizeof(buf)};
+    WV_Insert(&seq, i * sizeof(buf), payload, sizeof(buf), 1, 0, 65536);
+    WV_ByteSlice iov[2];
+    assert(WV_SeqAssembleV(&seq, iov, 1) == sizeof(buf));
+    assert(iov[0].length + iov[1].length == sizeof(buf));
+    // never copied out of sequence buffer
+    assert(iov[0].cursor >= seq.buffer &&
+           iov[0].cursor + iov[0].length <= seq.buffer + seq.capacity);
+    assert(iov[0].cursor == seq.buffer + (i * sizeof(buf)) % seq.capacity);
+    if (iov[1].length != 0) {
+      assert(iov[1].cursor == seq.buffer);
+      assert(iov[0].cursor + iov[0].length == seq.buffer + seq.capacity);
+    }
+    for (int j = 0; j < 2; j += 1) {
+      for (int k = 0; k < iov[j].length; k += 1) {
+        assert(iov[j].cursor[k] == i);
+      }
+    }
+  }
+  WV_CleanSeq(&seq, 1);
+}
+
+void test_out_of_order_wrap() {
+  WV_Seq seq;
+  WV_InitSeq(&seq, &pool, WV_CONFIG_SeqBufferSize, WV_CONFIG_SeqNodeCount, 1, 1);
+  WV_Byte buf[3000];
+  static WV_Byte scratch[WV_CONFIG_SeqBufferSize];
+  // move window close to the end of buffer
+  WV_U32 base = WV_CONFIG_SeqBufferSize - 1000;
+  memset(buf, 0xAA, sizeof(buf));
+  WV_ByteSlice payload;
+  for (WV_U32 offset = 0; offset < base; offset += payload.length) {
+    payload.cursor = buf;
+    payload.length = base - offset < 1000 ? base - offset : 1000;
+    WV_Insert(&seq, offset, payload, payload.length, 1, 0, 65536);
+    assert(WV_SeqAssemble(&seq, scratch, 1).length == payload.length);
+  }
+
+  // [base + 1500, base + 3000) arrives first, wholly wrapped
+  memset(buf, 0xCC, sizeof(buf));
+  payload = (WV_ByteSlice){.cursor = buf, .length = 1500};
+  WV_Insert(&seq, base + 1500, payload, 1500, 1, 0, 65536);
+  assert(WV_SeqAssemble(&seq, scratch, 1).length == 0);
+  // then [base, base + 1500), crossing the end of buffer
+  memset(buf, 0xCD, sizeof(buf));
+  WV_Insert(&seq, base, payload, 1500, 1, 0, 65536);
+  WV_ByteSlice assembled = WV_SeqAssemble(&seq, scratch, 1);
+  assert(assembled.length == 3000);
+  assert(assembled.cursor == scratch);
+  for (int i = 0; i < 3000; i += 1) {
+    assert(assembled.cursor[i] == (i < 1500 ? 0xCD : 0xCC));
+  }
+  WV_CleanSeq(&seq, 1);
+}
+
+void test_lazy_buffer() {
+  WV_Seq seq;
+  WV_InitSeq(&seq, &pool, WV_CONFIG_SeqBufferSize, WV_CONFIG_SeqNodeCount, 1, 1);
+  assert(seq.capacity == 0);
+  WV_Byte buf[1000];
+  static WV_Byte scratch[WV_CONFIG_SeqBufferSize];
+  // in-order data that is not buffered
+  memset(buf, 0xAA, sizeof(buf));
+  WV_ByteSlice payload = {.cursor = buf, .length = sizeof(buf)};
+  assert(WV_SeqEmptyAlign(&seq, 0, payload, sizeof(buf)));
+  WV_Insert(&seq, 0, payload, sizeof(buf), 0, 0, 65536);
+  assert(WV_SeqAssemble(&seq, NULL, 0).length == sizeof(buf));
+  assert(seq.capacity == 0);
+
+  // out-of-order data starts with one chunk
+  memset(buf, 0xCC, sizeof(buf));
+  WV_Insert(&seq, 2000, payload, sizeof(buf), 1, 0, 65536);
+  assert(seq.capacity == WV_CONFIG_SeqChunkSize);
+  // and grows until it holds everything
+  memset(buf, 0xCE, sizeof(buf));
+  WV_Insert(&seq, 5000, payload, sizeof(buf), 1, 0, 65536);
+  assert(seq.capacity == 8 * (1 << 10));
+  memset(buf, 0xCD, sizeof(buf));
+  WV_Insert(&seq, 1000, payload, sizeof(buf), 1, 0, 65536);
+  WV_ByteSlice assembled = WV_SeqAssemble(&seq, scratch, 1);
+  assert(assembled.length == 2000);
+  for (int i = 0; i < 2000; i += 1) {
+    assert(assembled.cursor[i] == (i < 1000 ? 0xCD : 0xCC));
+  }
+  memset(buf, 0xCF, sizeof(buf));
+  WV_Insert(&seq, 3000, payload, sizeof(buf), 1, 0, 65536);
+  WV_Insert(&seq, 4000, payload, sizeof(buf), 1, 0, 65536);
+  assembled = WV_SeqAssemble(&seq, scratch, 1);
+  assert(assembled.length == 3000);
+  for (int i = 0; i < 3000; i += 1) {
+    assert(assembled.cursor[i] == (i < 2000 ? 0xCF : 0xCE));
+  }
+  // buffer is still referred by assembled data
+  assert(seq.capacity != 0);
+  WV_Byte *buffer = seq.buffer;
+
+  // returned to pool once back in order
+  memset(buf, 0xAA, sizeof(buf));
+  assert(WV_SeqEmptyAlign(&seq, 6000, payload, sizeof(buf)));
+  WV_Insert(&seq, 6000, payload, sizeof(buf), 0, 0, 65536);
+  assert(seq.capacity == 0);
+  assert(WV_SeqPoolAlloc(&pool, 8 * (1 << 10)) == buffer);
+  WV_SeqPoolFree(&pool, buffer, 8 * (1 << 10));
+  WV_CleanSeq(&seq, 1);
+}
+
+void test_grow_wrapped() {
+  WV_Seq seq;
+  WV_InitSeq(&seq, &pool, WV_CONFIG_SeqBufferSize, WV_CONFIG_SeqNodeCount, 1, 1);
+  WV_Byte buf[1000];
+  static WV_Byte scratch[WV_CONFIG_SeqBufferSize];
+  memset(buf, 0xAA, sizeof(buf));
+  WV_ByteSlice payload = {.cursor = buf, .length = sizeof(buf)};
+  for (int i = 0; i < 3; i += 1) {
+    WV_Insert(&seq, i * sizeof(buf), payload, sizeof(buf), 0, 0, 65536);
+    WV_SeqAssemble(&seq, NULL, 0);
+  }
+  // [4000, 4500) wraps around the end of first chunk
+  memset(buf, 0xCC, sizeof(buf));
+  payload.length = 500;
+  WV_Insert(&seq, 4000, payload, 500, 1, 0, 65536);
+  assert(seq.capacity == WV_CONFIG_SeqChunkSize);
+  assert((4000 & (seq.capacity - 1)) + 500 > seq.capacity);
+  // moved into grown buffer
+  memset(buf, 0xCE, sizeof(buf));
+  WV_Insert(&seq, 6000, payload, 500, 1, 0, 65536);
+  assert(seq.capacity == 4 * (1 << 10));
+  memset(buf, 0xCD, sizeof(buf));
+  payload.length = 1000;
+  WV_Insert(&seq, 3000, payload, 1000, 1, 0, 65536);
+  WV_ByteSlice assembled = WV_SeqAssemble(&seq, scratch, 1);
+  assert(assembled.length == 1500);
+  for (int i = 0; i < 1500; i += 1) {
+    assert(assembled.cursor[i] == (i < 1000 ? 0xCD : 0xCC));
+  }
+  WV_CleanSeq(&seq, 1);
+}
+
+void test_buffer_limit() {
+  WV_Seq seq;
+  WV_InitSeq(&seq, &pool, 4 * (1 << 10), WV_CONFIG_SeqNodeCount, 1, 1);
+  WV_Byte buf[1000];
+  memset(buf, 0xCC, sizeof(buf));
+  WV_ByteSlice payload = {.cursor = buf, .length = sizeof(buf)};
+  WV_Insert(&seq, 1000, payload, sizeof(buf), 1, 0, 65536);
+  // partially out of limit
+  WV_Insert(&seq, 3500, payload, sizeof(buf), 1, 0, 65536);
+  assert(seq.capacity == 4 * (1 << 10));
+  assert(seq.node[_NodeLast(&seq)].right == 4 * (1 << 10));
+  // fully out of limit
+  WV_Insert(&seq, 5000, payload, sizeof(buf), 1, 0, 65536);
+  assert(seq.used_count == 2);
+  assert(seq.capacity == 4 * (1 << 10));
+  WV_CleanSeq(&seq, 1);
+}
+
+WV_U32 exceed_count, overlap_length, retex_length;
+
+WV_U8 count_exceed(WV_Seq *seq, WV_ByteSlice payload) {
+  exceed_count += 1;
+  return 0;
+}
+
+WV_U8 count_overlap(WV_Seq *seq, WV_ByteSlice payload) {
+  overlap_length += payload.length;
+  return 0;
+}
+
+WV_U8 count_retex(WV_Seq *seq, WV_ByteSlice payload) {
+  retex_length += payload.length;
+  return 0;
+}
+
+void test_many_holes() {
+  WV_Seq seq;
+  WV_U16 count = 2000;
+  WV_InitSeq(&seq, &pool, 64 * (1 << 10), count, 1, 1);
+  static WV_Byte scratch[64 * (1 << 10)];
+  WV_Byte buf[30];
+  // every other segment, in shuffled order
+  WV_U32 order[1000];
+  for (WV_U32 i = 0; i < 1000; i += 1) {
+    order[i] = i;
+  }
+  srand(42);
+  for (WV_U32 i = 999; i > 0; i -= 1) {
+    WV_U32 j = rand() % (i + 1), t = order[i];
+    order[i] = order[j];
+    order[j] = t;
+  }
+  for (WV_U32 i = 0; i < 1000; i += 1) {
+    WV_U32 k = order[i] * 2 + 1;
+    memset(buf, k & 0xff, sizeof(buf));
+    WV_ByteSlice payload = {.cursor = buf, .length = sizeof(buf)};
+    WV_Insert(&seq, k * sizeof(buf), payload, sizeof(buf), 1, 0, 65536);
+  }
+  assert(seq.used_count == 1000);
+  assert(WV_SeqAssemble(&seq, scratch, 1).length == 0);
+  // fill holes backward, so no node merges until the first one
+  for (WV_U32 i = 1000; i > 0; i -= 1) {
+    WV_U32 k = (i - 1) * 2;
+    memset(buf, k & 0xff, sizeof(buf));
+    WV_ByteSlice payload = {.cursor = buf, .length = sizeof(buf)};
+    WV_Insert(&seq, k * sizeof(buf), payload, sizeof(buf), 1, 0, 65536);
+  }
+  assert(seq.used_count == 1);
+  WV_ByteSlice assembled = WV_SeqAssemble(&seq, scratch, 1);
+  assert(assembled.length == 2000 * sizeof(buf));
+  for (WV_U32 i = 0; i < assembled.length; i += 1) {
+    assert(assembled.cursor[i] == (i / sizeof(buf)) % 256);
+  }
+  assert(seq.node == NULL);
+  WV_CleanSeq(&seq, 1);
+}
+
+void test_node_limit() {
+  WV_Seq seq;
+  WV_InitSeq(&seq, &pool, WV_CONFIG_SeqBufferSize, 4, 1, 1);
+  seq.on_buffer_exceed = count_exceed;
+  exceed_count = 0;
+  WV_Byte buf[10];
+  memset(buf, 0xCC, sizeof(buf));
+  WV_ByteSlice payload = {.cursor = buf, .length = sizeof(buf)};
+  for (WV_U32 i = 1; i <= 5; i += 1) {
+    WV_Insert(&seq, i * 20, payload, sizeof(buf), 1, 0, 65536);
+  }
+  assert(seq.used_count == 4);
+  assert(exceed_count == 1);
+  // merging needs no more node
+  WV_Insert(&seq, 30, payload, sizeof(buf), 1, 0, 65536);
+  assert(seq.used_count == 3);
+  assert(exceed_count == 1);
+  WV_CleanSeq(&seq, 1);
+}
+
+void test_overlap_retex() {
+  WV_Seq seq;
+  WV_InitSeq(&seq, &pool, WV_CONFIG_SeqBufferSize, WV_CONFIG_SeqNodeCount, 1, 1);
+  seq.on_overlap = count_overlap;
+  seq.on_retex = count_retex;
+  overlap_length = retex_length = 0;
+  WV_Byte buf[100];
+  memset(buf, 0xCC, sizeof(buf));
+  WV_ByteSlice payload = {.cursor = buf, .length = 10};
+  WV_Insert(&seq, 10, payload, 10, 1, 0, 65536);
+  WV_Insert(&seq, 30, payload, 10, 1, 0, 65536);
+  WV_Insert(&seq, 50, payload, 10, 1, 0, 65536);
+  // covered by [10, 20)
+  WV_Insert(&seq, 12, (WV_ByteSlice){.cursor = buf, .length = 5}, 5, 1, 0, 65536);
+  assert(retex_length == 5 && overlap_length == 0);
+  // [15, 55) overlaps [15, 20), [50, 55) and covers [30, 40)
+  WV_Insert(&seq, 15, (WV_ByteSlice){.cursor = buf, .length = 40}, 40, 1, 0, 65536);
+  assert(overlap_length == 5 + 5);
+  assert(retex_length == 5 + 10);
+  assert(seq.used_count == 1);
+  assert(seq.node[_NodeFirst(&seq)].left == 10);
+  assert(seq.node[_NodeFirst(&seq)].right == 60);
+  WV_CleanSeq(&seq, 1);
+}
+
+#define LARGE (64 * (1 << 10))
+
+WV_U32 out_of_window_length;
+
+WV_U8 count_out_of_window(WV_Seq *seq, WV_ByteSlice payload) {
+  out_of_window_length += payload.length;
+  return 0;
+}
+
+void test_large_in_order() {
+  WV_Seq seq;
+  WV_InitSeq(&seq, &pool, 2 * LARGE, WV_CONFIG_SeqNodeCount, 1, 0);
+  static WV_Byte buf[LARGE], scratch[2 * LARGE];
+  // not buffered
+  for (WV_U32 i = 0; i < 4; i += 1) {
+    memset(buf, i, sizeof(buf));
+    WV_ByteSlice payload = {.cursor = buf, .length = sizeof(buf)};
+    assert(i == 0 || WV_SeqEmptyAlign(&seq, 1000 + i * LARGE, payload, LARGE));
+    WV_Insert(&seq, 1000 + i * LARGE, payload, LARGE, 0, 0, 0);
+    assert(WV_SeqAssemble(&seq, NULL, 0).length == LARGE);
+  }
+  // buffered, wrapping around
+  for (WV_U32 i = 4; i < 8; i += 1) {
+    memset(buf, i, sizeof(buf));
+    WV_ByteSlice payload = {.cursor = buf, .length = sizeof(buf)};
+    WV_Insert(&seq, 1000 + i * LARGE, payload, LARGE, 1, 0, 0);
+    WV_ByteSlice assembled = WV_SeqAssemble(&seq, scratch, 1);
+    assert(assembled.length == LARGE);
+    for (WV_U32 j = 0; j < LARGE; j += 1) {
+      assert(assembled.cursor[j] == i);
+    }
+  }
+  WV_CleanSeq(&seq, 1);
+}
+
+void test_large_out_of_order() {
+  WV_Seq seq;
+  WV_InitSeq(&seq, &pool, 4 * LARGE, WV_CONFIG_SeqNodeCount, 1, 1);
+  static WV_Byte buf[LARGE], scratch[4 * LARGE];
+  for (WV_U32 i = 3; i > 0; i -= 1) {
+    memset(buf, i, sizeof(buf));
+    WV_ByteSlice payload = {.cursor = buf, .length = sizeof(buf)};
+    WV_Insert(&seq, i * LARGE, payload, LARGE, 1, 0, 0);
+    assert(WV_SeqAssemble(&seq, scratch, 1).length == 0);
+  }
+  assert(seq.used_count == 1);
+  // overlaps the next one by half
+  memset(buf, 0, sizeof(buf));
+  WV_ByteSlice payload = {.cursor = buf, .length = sizeof(buf)};
+  WV_Insert(&seq, LARGE / 2, payload, LARGE, 1, 0, 0);
+  assert(WV_SeqAssemble(&seq, scratch, 1).length == 0);
+  WV_Insert(&seq, 0, (WV_ByteSlice){.cursor = buf, .length = LARGE / 2}, LARGE / 2, 1, 0, 0);
+  WV_ByteSlice assembled = WV_SeqAssemble(&seq, scratch, 1);
+  assert(assembled.length == 4 * LARGE);
+  for (WV_U32 j = 0; j < 4 * LARGE; j += 1) {
+    assert(assembled.cursor[j] == (j < 3 * LARGE / 2 ? 0 : j / LARGE));
+  }
+  WV_CleanSeq(&seq, 1);
+}
+
+void test_large_exceed() {
+  WV_Seq seq;
+  WV_InitSeq(&seq, &pool, WV_CONFIG_SeqBufferSize, WV_CONFIG_SeqNodeCount, 1, 1);
+  seq.on_buffer_exceed = count_exceed;
+  exceed_count = 0;
+  static WV_Byte buf[LARGE], scratch[WV_CONFIG_SeqBufferSize];
+  for (WV_U32 j = 0; j < LARGE; j += 1) {
+    buf[j] = j;
+  }
+  WV_ByteSlice payload = {.cursor = buf, .length = sizeof(buf)};
+  WV_Insert(&seq, 100, payload, LARGE, 1, 0, 0);
+  assert(exceed_count == 1);
+  assert(seq.capacity == WV_CONFIG_SeqBufferSize);
+  WV_Insert(&seq, 0, (WV_ByteSlice){.cursor = buf, .length = 100}, 100, 1, 0, 0);
+  WV_ByteSlice assembled = WV_SeqAssemble(&seq, scratch, 1);
+  assert(assembled.length == WV_CONFIG_SeqBufferSize);
+  for (WV_U32 j = 100; j < WV_CONFIG_SeqBufferSize; j += 1) {
+    assert(assembled.cursor[j] == (WV_Byte)(j - 100));
+  }
+  WV_CleanSeq(&seq, 1);
+}
+
+void test_large_window() {
+  WV_Seq seq;
+  WV_InitSeq(&seq, &pool, 2 * LARGE, WV_CONFIG_SeqNodeCount, 1, 1);
+  seq.on_overlap = count_overlap;
+  seq.on_out_of_window = count_out_of_window;
+  overlap_length = out_of_window_length = 0;
+  static WV_Byte buf[LARGE], scratch[2 * LARGE];
+  for (WV_U32 j = 0; j < LARGE; j += 1) {
+    buf[j] = j;
+  }
+  WV_ByteSlice payload = {.cursor = buf, .length = sizeof(buf)};
+  WV_Insert(&seq, 0, payload, LARGE, 1, 0, 0);
+  assert(WV_SeqAssemble(&seq, scratch, 1).length == LARGE);
+  // [LARGE - 1000, 2 * LARGE - 1000) clipped by window [LARGE, LARGE + 30000)
+  WV_Insert(&seq, LARGE - 1000, payload, LARGE, 1, LARGE, LARGE + 30000);
+  assert(overlap_length == 1000);
+  assert(out_of_window_length == LARGE - 1000 - 30000);
+  WV_ByteSlice assembled = WV_SeqAssemble(&seq, scratch, 1);
+  assert(assembled.length == 30000);
+  for (WV_U32 j = 0; j < 30000; j += 1) {
+    assert(assembled.cursor[j] == (WV_Byte)(j + 1000));
+  }
+  WV_CleanSeq(&seq, 1);
+}
+
+WV_Byte out_of_window_data[LARGE];
+
+WV_U8 copy_out_of_window(WV_Seq *seq, WV_ByteSlice payload) {
+  memcpy(out_of_window_data + out_of_window_length, payload.cursor, payload.length);
+  out_of_window_length += payload.length;
+  return 0;
+}
+
+void test_skip_wrapped() {
+  WV_Seq seq;
+  WV_InitSeq(&seq, &pool, WV_CONFIG_SeqBufferSize, WV_CONFIG_SeqNodeCount, 1, 1);
+  WV_Byte buf[200];
+  memset(buf, 0xAA, sizeof(buf));
+  WV_ByteSlice payload = {.cursor = buf, .length = 100};
+  for (WV_U32 offset = 0; offset < 1800; offset += 100) {
+    WV_Insert(&seq, offset, payload, 100, 0, 0, 0);
+    WV_SeqAssemble(&seq, NULL, 0);
+  }
+  // [1900, 2100) wraps around the end of first chunk
+  memset(buf, 0xCC, sizeof(buf));
+  payload.length = 200;
+  WV_Insert(&seq, 1900, payload, 200, 1, 0, 0);
+  assert(seq.capacity == WV_CONFIG_SeqChunkSize);
+  // window slides over [1800, 2100), which wraps as well
+  seq.on_out_of_window = copy_out_of_window;
+  out_of_window_length = 0;
+  payload.length = 100;
+  WV_Insert(&seq, 2100, payload, 100, 1, 2100, 65536);
+  assert(out_of_window_length == 300);
+  for (WV_U32 j = 100; j < 300; j += 1) {
+    assert(out_of_window_data[j] == 0xCC);
+  }
+  WV_CleanSeq(&seq, 1);
+}
+
+// as generated code does: in-order data is delivered from packet without buffering (see
+// OptimizeDriver in rubik/compile.py), and the others are buffered and assembled
+void test_assemble_sdu() {
+  WV_Seq seq;
+  WV_InitSeq(&seq, &pool, WV_CONFIG_SeqBufferSize, WV_CONFIG_SeqNodeCount, 1, 1);
+  static WV_Byte stream[30 * 700], scratch[WV_CONFIG_SeqBufferSize];
+  for (WV_U32 j = 0; j < sizeof(stream); j += 1) {
+    stream[j] = j * 7 + j / 251;
+  }
+  // segments of 700 bytes, so assembled data wraps around sometimes
+  WV_U32 order[30] = {0, 1, 3, 2, 4, 6, 7, 5, 8, 9, 12, 11, 10, 13, 14,
+                      15, 17, 16, 18, 19, 20, 22, 21, 23, 24, 25, 27, 26, 28, 29};
+  WV_U32 assembled_length = 0;
+  for (WV_U32 i = 0; i < 30; i += 1) {
+    WV_ByteSlice payload = {.cursor = stream + order[i] * 700, .length = 700};
+    WV_U8 use_data = !WV_SeqEmptyAlign(&seq, order[i] * 700, payload, 700);
+    WV_Insert(&seq, order[i] * 700, payload, 700, use_data, 0, 65536);
+    WV_ByteSlice sdu = WV_SeqAssemble(&seq, use_data ? scratch : NULL, use_data);
+    if (!use_data) {
+      assert(sdu.length == payload.length);
+      sdu = payload;
+    }
+    assert(sdu.length == 0 || sdu.cursor != NULL);
+    for (WV_U32 j = 0; j < sdu.length; j += 1) {
+      assert(sdu.cursor[j] == stream[assembled_length + j]);
+    }
+    assembled_length += sdu.length;
   }
+  assert(assembled_length == sizeof(stream));
   WV_CleanSeq(&seq, 1);
 }
 
 void (*TESTCASES[])() = {
-  test_create, test_insert_in_order, test_insert_out_of_order, NULL};
+  test_create, test_insert_in_order, test_insert_out_of_order,
+  test_assemble_in_place, test_out_of_order_wrap, test_lazy_buffer,
+  test_grow_wrapped, test_buffer_limit, test_many_holes, test_node_limit,
+  test_overlap_retex, test_large_in_order, test_large_out_of_order,
+  test_large_exceed, test_large_window, test_skip_wrapped,
+  test_assemble_sdu, NULL};
 
 int main() {
+  WV_InitSeqPool(&pool);
   for (int i = 0; TESTCASES[i] != NULL; i += 1) {
     TESTCASES[i]();
   }
+  WV_CleanSeqPool(&pool);
   return 0;
 }
\ No newline at end of file
@@ -0,0 +1,156 @@
+#ifndef WEAVER_RUNTIME_SLAB_H
+#define WEAVER_RUNTIME_SLAB_H
+
+#include "malloc.h"
+#include "profile.h"
+#include "types.h"
+#include <string.h>
+#ifdef WV_CONFIG_SlabHugepage
+#include <sys/mman.h>
+#endif
+
+// Slab allocator for fixed-size objects, i.e. instances of one layer
+// objects are carved from large chunks and recycled through an intrusive free list
+// every WV_Runtime owns its slabs and a runtime is never shared between cores, so the
+// free list is per core and needs neither lock nor atomic operation
+// chunks are never returned before WV_CleanSlab
+//
+// chunk memory:
+// * DPDK: rte_malloc, which always allocates from hugepages on the socket of caller
+// * otherwise: malloc, or mmap with MAP_HUGETLB if WV_CONFIG_SlabHugepage is defined
+//   (falls back to normal pages if no hugepage is reserved)
+
+#define WV_CONFIG_SlabChunkSize (2 * (1 << 20))
+#define WV_CONFIG_SlabAlign 64
+
+typedef struct _WV_SlabObject {
+    struct _WV_SlabObject* next;
+} WV_SlabObject;
+
+typedef struct _WV_SlabChunk {
+    struct _WV_SlabChunk* next;
+    WV_U64 size;
+    WV_U8 mapped;
+} WV_SlabChunk;
+
+typedef struct {
+    WV_U32 object_size;
+    WV_SlabObject* free_list;
+    WV_SlabChunk* chunk_list;
+    WV_SlabStat stat;
+} WV_Slab;
+
+static inline WV_U8 WV_InitSlab(WV_Slab* slab, const char* name, WV_U32 object_size)
+{
+    if (object_size < sizeof(WV_SlabObject)) {
+        object_size = sizeof(WV_SlabObject);
+    }
+    slab->object_size = (object_size + WV_CONFIG_SlabAlign - 1) / WV_CONFIG_SlabAlign * WV_CONFIG_SlabAlign;
+    slab->free_list = NULL;
+    slab->chunk_list = NULL;
+    memset(&slab->stat, 0, sizeof(WV_SlabStat));
+    slab->stat.name = name;
+    return 0;
+}
+
+static inline WV_SlabChunk* WV_SlabChunkAlloc(WV_U64 size)
+{
+    WV_SlabChunk* chunk;
+#ifdef WV_CONFIG_SlabHugepage
+    chunk = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS | MAP_HUGETLB, -1, 0);
+    if (chunk == MAP_FAILED) {
+        chunk = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+    }
+    if (chunk == MAP_FAILED) {
+        return NULL;
+    }
+    chunk->mapped = 1;
+#else
+    if (!(chunk = WV_Malloc(size))) {
+        return NULL;
+    }
+    chunk->mapped = 0;
+#endif
+    chunk->size = size;
+    return chunk;
+}
+
+static inline void WV_SlabChunkFree(WV_SlabChunk* chunk)
+{
+#ifdef WV_CONFIG_SlabHugepage
+    if (chunk->mapped) {
+        munmap(chunk, chunk->size);
+        return;
+    }
+#endif
+    WV_Free(chunk);
+}
+
+// refill free list with a new chunk
+static inline WV_U8 WV_SlabGrow(WV_Slab* slab)
+{
+    WV_U64 size = WV_CONFIG_SlabChunkSize;
+    WV_U64 least = sizeof(WV_SlabChunk) + WV_CONFIG_SlabAlign + slab->object_size;
+    if (size < least) {
+        size = least;
+    }
+    WV_SlabChunk* chunk = WV_SlabChunkAlloc(size);
+    if (chunk == NULL) {
+        return 1;
+    }
+    chunk->next = slab->chunk_list;
+    slab->chunk_list = chunk;
+
+    WV_Byte* end = (WV_Byte*)chunk + size;
+    WV_Byte* object = (WV_Byte*)(((uintptr_t)(chunk + 1) + WV_CONFIG_SlabAlign - 1) & ~(uintptr_t)(WV_CONFIG_SlabAlign - 1));
+    // keep objects in address order in free list
+    WV_SlabObject** tail = &slab->free_list;
+    while (*tail != NULL) {
+        tail = &(*tail)->next;
+    }
+    for (; object + slab->object_size <= end; object += slab->object_size) {
+        *tail = (WV_SlabObject*)object;
+        tail = &(*tail)->next;
+        slab->stat.capacity += 1;
+    }
+    *tail = NULL;
+    slab->stat.chunk_count += 1;
+    return 0;
+}
+
+// content of allocated object is undefined
+static inline WV_Any WV_SlabAlloc(WV_Slab* slab)
+{
+    if (slab->free_list == NULL && WV_SlabGrow(slab)) {
+        return NULL;
+    }
+    WV_SlabObject* object = slab->free_list;
+    slab->free_list = object->next;
+    slab->stat.used += 1;
+    if (slab->stat.used > slab->stat.peak) {
+        slab->stat.peak = slab->stat.used;
+    }
+    return object;
+}
+
+static inline void WV_SlabFree(WV_Slab* slab, WV_Any object)
+{
+    WV_SlabObject* node = object;
+    node->next = slab->free_list;
+    slab->free_list = node;
+    slab->stat.used -= 1;
+}
+
+static inline WV_U8 WV_CleanSlab(WV_Slab* slab)
+{
+    while (slab->chunk_list != NULL) {
+        WV_SlabChunk* chunk = slab->chunk_list;
+        slab->chunk_list = chunk->next;
+        WV_SlabChunkFree(chunk);
+    }
+    slab->free_list = NULL;
+    slab->stat.capacity = slab->stat.used = slab->stat.chunk_count = 0;
+    return 0;
+}
+
+#endif
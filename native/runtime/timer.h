@@ -2,51 +2,217 @@
 #define WEAVER_NATIVE_RUNTIME_TIMER_H
 
 #include "types.h"
+#include <stddef.h>
 #include <sys/time.h>
 
+// idle timeout of instances, in seconds
 #define TIMEOUT 30
 
+// Hierarchical timer wheel for instance expiry
+// time is measured in ticks of 1 / WV_CONFIG_TimerHz second, and every level has
+// 2 ^ WV_CONFIG_TimerSlotBits slots, each of which covers one slot of its lower level
+// (with default config: 10ms, 640ms, 41s, 44min, and later expiry is clamped to the top level)
+//
+// touching an instance only stores its last update time, expiry of an instance that is
+// touched since scheduled is postponed lazily when its slot is due
+// work of expiry is bounded by WV_CONFIG_TimerTickBudget ticks of advancing and
+// the budget passed to WV_TimerPop, so no call costs a sweep of all instances
+// callers earn WV_CONFIG_TimerExpireBudget per packet and per advanced tick, so that
+// expiry keeps up with elapsed time when packets are rare
+
+#define WV_CONFIG_TimerHz 100
+#define WV_CONFIG_TimerSlotBits 6
+#define WV_CONFIG_TimerLevelCount 4
+#define WV_CONFIG_TimerTickBudget 1024
+#define WV_CONFIG_TimerExpireBudget 8
+
+#define WV_TIMER_SLOT_COUNT (1 << WV_CONFIG_TimerSlotBits)
+#define WV_TIMER_SLOT_MASK (WV_TIMER_SLOT_COUNT - 1)
+
+typedef struct _WV_TimerNode {
+    struct _WV_TimerNode *prev, *next;
+    WV_U64 expire;
+    WV_U64 last_update;
+} WV_TimerNode;
+
+typedef struct {
+    WV_U64 current; // last processed tick
+    WV_U64 count; // scheduled nodes, including expired ones not popped
+    WV_U64 timeout;
+    WV_TimerNode expired;
+    WV_TimerNode slot[WV_CONFIG_TimerLevelCount][WV_TIMER_SLOT_COUNT];
+} WV_TimerWheel;
+
+// wall clock in microseconds, for drivers that have no timestamp of packets
+static inline WV_U64 WV_TimerClock()
+{
+    struct timeval tv;
+    gettimeofday(&tv, NULL);
+    return (WV_U64)tv.tv_sec * 1000000 + tv.tv_usec;
+}
+
+static inline WV_U64 WV_TimerTick(WV_U64 us)
+{
+    return us / (1000000 / WV_CONFIG_TimerHz);
+}
+
+static inline void WV_TimerListInit(WV_TimerNode* head)
+{
+    head->prev = head->next = head;
+}
+
+static inline void WV_TimerListAppend(WV_TimerNode* head, WV_TimerNode* node)
+{
+    node->prev = head->prev;
+    node->next = head;
+    head->prev->next = node;
+    head->prev = node;
+}
+
+// move all nodes of src to the end of dst
+static inline void WV_TimerListSplice(WV_TimerNode* dst, WV_TimerNode* src)
+{
+    if (src->next == src) {
+        return;
+    }
+    src->next->prev = dst->prev;
+    dst->prev->next = src->next;
+    src->prev->next = dst;
+    dst->prev = src->prev;
+    WV_TimerListInit(src);
+}
+
+static inline WV_U8 WV_InitTimer(WV_TimerWheel* wheel, WV_U64 now, WV_U64 timeout)
+{
+    wheel->current = now;
+    wheel->count = 0;
+    wheel->timeout = timeout;
+    WV_TimerListInit(&wheel->expired);
+    for (WV_U32 level = 0; level < WV_CONFIG_TimerLevelCount; level += 1) {
+        for (WV_U32 i = 0; i < WV_TIMER_SLOT_COUNT; i += 1) {
+            WV_TimerListInit(&wheel->slot[level][i]);
+        }
+    }
+    return 0;
+}
+
+static inline void WV_TimerPlace(WV_TimerWheel* wheel, WV_TimerNode* node)
+{
+    if (node->expire <= wheel->current) {
+        WV_TimerListAppend(&wheel->expired, node);
+        return;
+    }
+    WV_U64 expire = node->expire;
+    WV_U32 level = 0;
+    while (level + 1 < WV_CONFIG_TimerLevelCount && expire - wheel->current >= (WV_U64)1 << (WV_CONFIG_TimerSlotBits * (level + 1))) {
+        level += 1;
+    }
+    WV_U64 range = (WV_U64)1 << (WV_CONFIG_TimerSlotBits * (level + 1));
+    if (expire - wheel->current >= range) {
+        // rescheduled when cascaded
+        expire = wheel->current + range - 1;
+    }
+    WV_TimerListAppend(&wheel->slot[level][(expire >> (WV_CONFIG_TimerSlotBits * level)) & WV_TIMER_SLOT_MASK], node);
+}
+
+static inline void WV_TimerSchedule(WV_TimerWheel* wheel, WV_TimerNode* node, WV_U64 expire)
+{
+    node->expire = expire;
+    WV_TimerPlace(wheel, node);
+    wheel->count += 1;
+}
+
+// no-op for node that is not scheduled
+static inline void WV_TimerCancel(WV_TimerWheel* wheel, WV_TimerNode* node)
+{
+    if (node->next == NULL) {
+        return;
+    }
+    node->prev->next = node->next;
+    node->next->prev = node->prev;
+    node->prev = node->next = NULL;
+    wheel->count -= 1;
+}
+
+static inline void WV_TimerCascade(WV_TimerWheel* wheel, WV_TimerNode* head)
+{
+    WV_TimerNode list;
+    WV_TimerListInit(&list);
+    WV_TimerListSplice(&list, head);
+    while (list.next != &list) {
+        WV_TimerNode* node = list.next;
+        node->prev->next = node->next;
+        node->next->prev = node->prev;
+        WV_TimerPlace(wheel, node);
+    }
+}
+
+// move nodes that are due at or before now into expired list, return advanced ticks
+static inline WV_U32 WV_TimerAdvance(WV_TimerWheel* wheel, WV_U64 now)
+{
+    if (wheel->count == 0) {
+        if (now > wheel->current) {
+            wheel->current = now;
+        }
+        return 0;
+    }
+    WV_U32 budget = WV_CONFIG_TimerTickBudget;
+    for (; budget > 0 && wheel->current < now; budget -= 1) {
+        wheel->current += 1;
+        WV_U64 tick = wheel->current;
+        for (WV_U32 level = 1; level < WV_CONFIG_TimerLevelCount; level += 1) {
+            if ((tick & (((WV_U64)1 << (WV_CONFIG_TimerSlotBits * level)) - 1)) != 0) {
+                break;
+            }
+            WV_TimerCascade(wheel, &wheel->slot[level][(tick >> (WV_CONFIG_TimerSlotBits * level)) & WV_TIMER_SLOT_MASK]);
+        }
+        WV_TimerListSplice(&wheel->expired, &wheel->slot[0][tick & WV_TIMER_SLOT_MASK]);
+    }
+    return WV_CONFIG_TimerTickBudget - budget;
+}
+
+// pop a node which has been idle for timeout, consuming budget for every visited node
+// nodes that are touched since scheduled are rescheduled
+static inline WV_TimerNode* WV_TimerPop(WV_TimerWheel* wheel, WV_U64 now, WV_U32* budget)
+{
+    while (*budget > 0 && wheel->expired.next != &wheel->expired) {
+        *budget -= 1;
+        WV_TimerNode* node = wheel->expired.next;
+        WV_TimerCancel(wheel, node);
+        if (node->last_update + wheel->timeout > now) {
+            WV_TimerSchedule(wheel, node, node->last_update + wheel->timeout);
+            continue;
+        }
+        return node;
+    }
+    return NULL;
+}
+
 #define TIMER_FIELDS(inst_type) \
-    inst_type *inst_type##_timer_head, *inst_type##_timer_last;
+    WV_TimerWheel inst_type##_timer;
 
 #define TIMER_INJECT_FIELDS(inst_type) \
-    struct inst_type *prev, *next; \
-    WV_U64 last_update;
+    WV_TimerNode timer;
 
 #define TIMER_INIT(rt, inst_type) \
-    rt->inst_type##_timer_head = rt->inst_type##_timer_last = NULL
-
-#define TIMER_INSERT(rt, inst_type, inst) \
-    if (rt->inst_type##_timer_last == NULL) { \
-        rt->inst_type##_timer_head = rt->inst_type##_timer_last = inst; \
-        inst->prev = inst->next = NULL; \
-    } else { \
-        inst->prev = NULL; \
-        inst->next = rt->inst_type##_timer_head; \
-        rt->inst_type##_timer_head->prev = inst; \
-        rt->inst_type##_timer_head = inst; \
-    } \
-    struct timeval tv; \
-    gettimeofday(&tv, NULL); \
-    inst->last_update = tv.tv_sec
+    WV_InitTimer(&rt->inst_type##_timer, rt->now, (WV_U64)TIMEOUT * WV_CONFIG_TimerHz)
+
+// the wheel is passed instead of the instance type, so that the code could be shared by
+// layers with different wheels
+#define TIMER_INSERT(rt, wheel, inst) \
+    inst->timer.last_update = rt->now; \
+    WV_TimerSchedule(wheel, &inst->timer, rt->now + (wheel)->timeout)
 
 #define TIMER_FETCH(rt, inst_type, inst) \
-    if (inst->prev != NULL) { \
-        inst->prev->next = inst->next; \
-    } \
-    if (inst->next != NULL) { \
-        inst->next->prev = inst->prev; \
-    } else { \
-        rt->inst_type##_timer_last = inst->prev; \
-    } \
-    if (inst->prev != NULL) { \
-        inst->prev = NULL; \
-        inst->next = rt->inst_type##_timer_head; \
-        rt->inst_type##_timer_head->prev = inst; \
-        rt->inst_type##_timer_head = inst; \
-    } \
-    struct timeval tv; \
-    gettimeofday(&tv, NULL); \
-    inst->last_update = tv.tv_sec
-
-#endif
\ No newline at end of file
+    inst->timer.last_update = rt->now
+
+#define TIMER_REMOVE(wheel, inst) \
+    WV_TimerCancel(wheel, &inst->timer)
+
+#define TIMER_POP(rt, inst_type, budget) \
+    WV_TimerPop(&rt->inst_type##_timer, rt->now, budget)
+
+#define TIMER_ENTRY(node, inst_type) \
+    ((inst_type*)((WV_Byte*)(node)-offsetof(inst_type, timer)))
+
+#endif
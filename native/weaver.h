@@ -3,8 +3,10 @@
 #define WV_WEAVER_H
 
 #include "runtime/malloc.h"
+#include "runtime/oatable.h"
 #include "runtime/profile.h"
 #include "runtime/seq.h"
+#include "runtime/slab.h"
 #include "runtime/types.h"
 #include "runtime/timer.h"
 #include <stdlib.h>
@@ -13,6 +15,12 @@
 // implemented by blackbox
 typedef struct _WV_Runtime WV_Runtime;
 WV_U8 WV_ProcessPacket(WV_ByteSlice, WV_Runtime *);
+// status of every packet in burst is stored into the WV_U8 array
+WV_U8 WV_ProcessBurst(WV_ByteSlice *, WV_U32, WV_U8 *, WV_Runtime *);
+// with timestamp in microseconds, which drives expiry instead of wall clock
+WV_U8 WV_ProcessPacketTs(WV_ByteSlice, WV_U64, WV_Runtime *);
+// one timestamp for every packet in burst
+WV_U8 WV_ProcessBurstTs(WV_ByteSlice *, const WV_U64 *, WV_U32, WV_U8 *, WV_Runtime *);
 WV_Runtime *WV_AllocRuntime();
 WV_U8 WV_FreeRuntime(WV_Runtime *);
 WV_Profile *WV_GetProfile(WV_Runtime *);
@@ -1,30 +1,150 @@
-from sys import argv
+from argparse import ArgumentParser
+from sys import stderr, exit
 from importlib import import_module
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 
-from rubik.compile import compile5a_layer, OptimizeDriver
+from rubik.compile import compile5a_layer, OptimizeDriver, eliminate_dead_regs
 from rubik.compile2 import compile7_stack, compile7w_stack
+from rubik.prog import Block
+from rubik.cache import Cache, source_digest, ir_digest
 
 
-stack = import_module(argv[1]).stack
+parser = ArgumentParser(prog="python3 -m rubik")
+parser.add_argument("stack", help="module that defines the stack, e.g. stock.tcp_ip")
+parser.add_argument(
+    "--layer-functions",
+    action="store_true",
+    help="compile every layer into its own function instead of a single function",
+)
+parser.add_argument(
+    "--inline-lines",
+    type=int,
+    default=0,
+    help="layer functions with no more lines of code than this are always inlined",
+)
+parser.add_argument(
+    "--no-inline-stateless",
+    action="store_true",
+    help="do not always inline the functions of layers without instance",
+)
+parser.add_argument(
+    "--share-layers",
+    action="store_true",
+    help="share the function of layers that are compiled into the same code "
+    "(implies --layer-functions)",
+)
+parser.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    default=1,
+    help="optimize layers in this number of processes",
+)
+parser.add_argument(
+    "--cache-dir",
+    help="cache the generated code and the optimized layers in this directory",
+)
+args = parser.parse_args()
+# the options that change the generated code
+options = (
+    args.stack,
+    args.layer_functions,
+    args.share_layers,
+    args.inline_lines,
+    args.no_inline_stateless,
+)
+
+stack = import_module(args.stack).stack
+cache = Cache(args.cache_dir) if args.cache_dir is not None else None
+if cache is not None:
+    stack_key = source_digest(options)
+    cached = cache.load(stack_key)
+    if cached is not None:
+        dead_stat_lines, code7 = cached
+        for dead_stat_line in dead_stat_lines:
+            print(dead_stat_line, file=stderr)
+        print(code7)
+        exit()
+stack.context.layer_functions = args.layer_functions or args.share_layers
+stack.context.share_layers = args.share_layers
+stack.context.inline_lines = args.inline_lines
+stack.context.inline_stateless = not args.no_inline_stateless
+# all layers are compiled before optimizing any of them, so that every register read by
+# other layers is known (in stack.context.foreign_regs) when dead values are eliminated
 block_map = {
-    # layer.layer.context.layer_id: compile5a_layer(layer.layer)
-    layer.layer.context.layer_id: compile5a_layer(layer.layer).optimize(
-        OptimizeDriver(layer.layer.context)
-    )
+    layer.layer.context.layer_id: compile5a_layer(layer.layer)
     for layer in stack.name_map.values()
 }
+layer_context_map = {
+    layer.layer.context.layer_id: layer.layer.context
+    for layer in stack.name_map.values()
+}
+
+
+# registers are all allocated by now, and layers are optimized independently
+# worker processes are forked, so they inherit the compiled layers, and only send back
+# the optimized blocks
+def optimize_layer(layer_id):
+    return block_map[layer_id].optimize(OptimizeDriver(layer_context_map[layer_id]))
+
+
+opt_block_map = {}
+if cache is not None:
+    compiler_key = source_digest(None, compiler_only=True)
+    layer_key_map = {
+        layer_id: ir_digest(
+            [
+                compiler_key,
+                block,
+                OptimizeDriver(layer_context_map[layer_id]).cache_key(),
+            ]
+        )
+        for layer_id, block in block_map.items()
+    }
+    for layer_id, layer_key in layer_key_map.items():
+        opt_block = cache.load(layer_key)
+        if opt_block is not None:
+            opt_block_map[layer_id] = opt_block
+pending_layers = [layer_id for layer_id in block_map if layer_id not in opt_block_map]
+if args.jobs > 1 and len(pending_layers) > 1:
+    with ProcessPoolExecutor(args.jobs, get_context("fork")) as pool:
+        opt_blocks = list(pool.map(optimize_layer, pending_layers))
+else:
+    opt_blocks = [optimize_layer(layer_id) for layer_id in pending_layers]
+for layer_id, opt_block in zip(pending_layers, opt_blocks):
+    opt_block_map[layer_id] = opt_block
+    if cache is not None:
+        cache.store(layer_key_map[layer_id], opt_block)
+block_map = {
+    layer_id: opt_block_map[layer_id].sink_lazy(stack.context.foreign_regs)
+    for layer_id in block_map
+}
+block_map, dead_stats = eliminate_dead_regs(stack.context, block_map, layer_context_map)
+dead_stat_lines = [str(dead_stat) for dead_stat in dead_stats]
+for dead_stat_line in dead_stat_lines:
+    print(dead_stat_line, file=stderr)
+Block.renumber(block_map.values())
 inst_decls = {
     layer.layer.context.layer_id: layer.layer.context.inst.decl(layer.layer.context)
     for layer in stack.name_map.values()
     if layer.layer.context.inst is not None
 }
 
-print("/* Weaver Whitebox Code Template */")
-print(compile7w_stack(stack.context))
-print("/* Weaver Auto-generated Blackbox Code */")
-print(
-    compile7_stack(
-        stack.context, block_map, inst_decls, stack.entry.layer.context.layer_id,
-        {layer.layer.context.layer_id: layer.layer.context for layer in stack.name_map.values()}
-    )
+code7 = "\n".join(
+    [
+        "/* Weaver Whitebox Code Template */",
+        compile7w_stack(stack.context),
+        "/* Weaver Auto-generated Blackbox Code */",
+        compile7_stack(
+            stack.context,
+            block_map,
+            inst_decls,
+            stack.entry.layer.context.layer_id,
+            layer_context_map,
+        ),
+    ]
 )
+print(code7)
+if cache is not None:
+    cache.store(stack_key, (dead_stat_lines, code7))
@@ -0,0 +1,128 @@
+import hashlib
+import os
+import pickle
+import sys
+import sysconfig
+from tempfile import NamedTemporaryFile
+
+from rubik.prog import Block
+
+
+# on-disk cache of `python3 -m rubik --cache-dir`
+# the generated code of the whole stack is cached by the sources of the stack definition
+# and the compiler, so an unchanged stack is regenerated without compiling
+# the optimized program of every layer is cached by its content before optimizing, so
+# layers are not optimized again when only the layers after them are changed (register
+# ids are allocated in order, so changing a layer changes the programs after it)
+# entries are never evicted, remove the directory to clean up
+class Cache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def load(self, key):
+        try:
+            with open(os.path.join(self.cache_dir, key), "rb") as cache_file:
+                return pickle.load(cache_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def store(self, key, value):
+        with NamedTemporaryFile("wb", dir=self.cache_dir, delete=False) as cache_file:
+            pickle.dump(value, cache_file)
+        # concurrent runs could store the same entry, and the last one wins
+        os.replace(cache_file.name, os.path.join(self.cache_dir, key))
+
+
+def install_paths():
+    paths = sysconfig.get_paths()
+    return tuple(
+        os.path.abspath(paths[name])
+        for name in ("stdlib", "platstdlib", "purelib", "platlib")
+    )
+
+
+# digest of the sources of loaded modules, i.e. the compiler itself (and the stack
+# definition unless `compiler_only`), together with `extra` and the version of Python
+def source_digest(extra, compiler_only=False):
+    hasher = hashlib.sha256(repr((sys.version, extra)).encode())
+    excluded = install_paths()
+    for name, module in sorted(sys.modules.items()):
+        path = getattr(module, "__file__", None)
+        if path is None or not path.endswith(".py"):
+            continue
+        # i.e. rubik.__main__ for __main__
+        name = getattr(getattr(module, "__spec__", None), "name", None) or name
+        is_compiler = name.split(".")[0] == "rubik"
+        if compiler_only and not is_compiler:
+            continue
+        if not is_compiler and os.path.abspath(path).startswith(excluded):
+            continue
+        with open(path, "rb") as source_file:
+            hasher.update(f"{name}\0".encode())
+            hasher.update(hashlib.sha256(source_file.read()).digest())
+    return hasher.hexdigest()
+
+
+# stable digest of compiled programs, which covers every attribute of the instructions,
+# expressions and handlers, but not object ids, e.g. the ids of blocks
+def ir_digest(obj):
+    hasher = hashlib.sha256()
+    index_map = {}  # id of visited object -> index
+
+    def update(text):
+        hasher.update(f"{text}\0".encode())
+
+    def walk(obj):
+        if obj is None or isinstance(obj, (bool, int, float, str, bytes)):
+            update(repr(obj))
+            return
+        if isinstance(obj, type):
+            update(f"{obj.__module__}.{obj.__qualname__}")
+            return
+        # the objects are kept alive by the program, so their ids are not reused
+        if id(obj) in index_map:
+            update(f"@{index_map[id(obj)]}")
+            return
+        index_map[id(obj)] = len(index_map)
+        if isinstance(obj, (list, tuple)):
+            update(f"{type(obj).__name__}{len(obj)}")
+            for item in obj:
+                walk(item)
+        elif isinstance(obj, (set, frozenset)):
+            # mostly registers
+            try:
+                update(f"set{sorted(obj)}")
+            except TypeError:
+                update(f"set{sorted(ir_digest(item) for item in obj)}")
+        elif isinstance(obj, dict):
+            update(f"dict{len(obj)}")
+            try:
+                items = sorted(obj.items())
+            except TypeError:
+                items = sorted(obj.items(), key=lambda item: ir_digest(item[0]))
+            for key, value in items:
+                walk(key)
+                walk(value)
+        elif isinstance(obj, Block):
+            update("Block")
+            walk(obj.instr_list)
+            walk(obj.pred)
+            walk(obj.yes_block)
+            walk(obj.no_block)
+        else:
+            walk(type(obj))
+            # underscored attributes cache values derived from the others, e.g. the
+            # rendered code of instructions
+            attrs = [
+                (name, value)
+                for name, value in sorted(vars(obj).items())
+                if not name.startswith("_")
+            ]
+            update(f"attrs{len(attrs)}")
+            for name, value in attrs:
+                update(name)
+                walk(value)
+
+    walk(obj)
+    return hasher.hexdigest()
@@ -8,7 +8,8 @@ compile2: allocate temp and perm variables in context, and set context attribute
 compile3: generate instance helper struct
   signature: (Prototype, LayerContext) -> Inst/BiInst (which impl compile5)
 compile4: generate content for expressions
-  signature: (LayerContext) -> rubik.prog.Expr (which impl eval1 and compile6)
+  signature: (LayerContext) -> rubik.prog.Expr (which impl eval1, and carries rubik.ctree
+    expression which is rendered into compile6)
 compile5: generate content for statements
   signature: (LayerContext) -> rubik.prog.UpdateReg/Branch (which impl eval2 and compile7)
 NOTICE: compile6 is generated in compile4 stage, so as compile7 in compile5
@@ -19,10 +20,8 @@ eval2: (try to) evaluate statement, statically implemented in rubik.prog
   signature: (EvalContext) -> None
 eval3: assert an expression to be true, and modify context according to it
   signature: (EvalContext) -> None
-compile6: generated C code for expression
+compile6: generated C code for expression, rendered lazily from Expr.code6
   signature: (<str for valid C code>, <str for debug info>)
-CAUTION: this signature has been proved to be a bad design, because when a single string is
-accidentially taken place of the expected tuple, nothing but weird result is caused
 compile7: generated C code for statement, without postfix '\n'
   signature: str, recommend to '// <debug info> \n<C code>', 
     or rubik.util.code_comment(<C code>, <debug info>)
@@ -37,19 +36,42 @@ they complete stage 3 and 5 respectively for whole layer, and their signatures a
 different to other functions in compile3 and compile5 families
 """
 
+import re
+
 from rubik.prog import Expr, UpdateReg, Branch, NotConstant, Block
 from rubik.compile2 import (
+    compile6_hash,
     compile6_inst_type,
+    compile6_key_type,
+    compile6_rev_key_type,
     compile6_prefetch_type,
     compile6_content,
-    compile6_need_free,
+    compile6_wrap,
     compile6_struct_expr,
     compile6_inst_expr,
     compile6_prefetch_expr,
+    compile6_peek_key,
+    compile6_table,
+    compile6_dir,
     compile7_decl_inst,
     compile7_decl_bi_inst,
+    compile7_decl_canonical_bi_inst,
+    compile7_layer_call,
+    compile7_layer_exit,
+    compile7_next_call,
+    compile7_peek_list,
 )
 from rubik.util import code_comment, comment_only, indent_join
+from rubik.ctree import (
+    CAtom,
+    CConst,
+    CFormat,
+    COp,
+    CAssign,
+    CComment,
+    CLines,
+    BlockRef,
+)
 
 
 class StackContext:
@@ -61,6 +83,13 @@ class StackContext:
         self.reg_map = {}  # reg(aka int) -> HeaderReg/TempReg/InstReg
         self.struct_map = {}  # struct(aka int) -> [reg(aka int)]
         self.call_struct = {}  # rubik.lang.Call -> struct ID (aka int)
+        self.foreign_regs = set()  # reg(aka int) read by layers other than its owner
+        self.dead_regs = set()  # reg(aka int) of temp registers never read
+        # code generation mode, see rubik.compile2.compile7_stack
+        self.layer_functions = False
+        self.inline_lines = 0
+        self.inline_stateless = True
+        self.share_layers = False
 
 
 class LayerContext:
@@ -73,10 +102,14 @@ class LayerContext:
         self.seq = None
         self.perm_regs = []
         self.buffer_data = True
+        self.table = compile6_table("hashdyn")
+        self.table_capacity = None
         self.layout_map = {}  # rubik.lang.layout -> reg(aka int)
         self.vexpr_map = {}  # id(<someone impl compile4>(aka expr)) -> reg(aka int)
         self.event_map = {}  # rubik.lang.Event -> var(aka Bit/AutoVar/InstVar)
         self.ntoh_map = {}  # UInt.var_id -> AutoVar
+        self.ntoh_init7_map = {}  # reg(aka int) of ntoh var -> conversion statement
+        self.next_list = None  # instructions of dispatching, see compile5_next_call
 
     def alloc_header_reg(self, bit, name):
         reg = HeaderReg(self.stack.reg_count, self.stack.struct_count, bit.length, name)
@@ -134,6 +167,27 @@ class LayerContext:
     def prealloc_expr6(self):
         return f"runtime->l{self.layer_id}_p"
 
+    @property
+    def slab_expr6(self):
+        return f"&runtime->s{self.layer_id}"
+
+    @property
+    def timer_expr6(self):
+        return f"&runtime->{self.inst_type6}_timer"
+
+    # instance fields other than key are always initialized by creating, so only
+    # key (including padding) is cleared for the next prealloc
+    def alloc_stat7(self, *key_fields):
+        return "\n".join(
+            [
+                f"{self.prealloc_expr6} = WV_SlabAlloc({self.slab_expr6});",
+                *[
+                    f"memset(&{self.prealloc_expr6}->{field}, 0, sizeof({key_type}));"
+                    for field, key_type in key_fields
+                ],
+            ]
+        )
+
     @property
     def inst_type6(self):
         return compile6_inst_type(self.layer_id)
@@ -142,6 +196,16 @@ class LayerContext:
     def prefetch_type6(self):
         return compile6_prefetch_type(self.layer_id)
 
+    # every key hash of the layer goes through here, so that hashes computed ahead
+    # (i.e. by WV_ProcessBurst) are always the ones tables are searched with
+    def hash_expr6(self, key6):
+        return f"hash(&{key6}, sizeof({compile6_key_type(self.layer_id)}))"
+
+    # hash of prealloc key, which is set in prefetching and reused by inserting
+    @property
+    def hash_var6(self):
+        return compile6_hash(self.layer_id)
+
     @property
     def insert_stat7(self):
         return self.insert_stat7_impl("")
@@ -151,24 +215,22 @@ class LayerContext:
         return self.insert_stat7_impl("_rev")
 
     def insert_stat7_impl(self, postfix):
-        return "\n".join(
-            [
-                f"tommy_hashdyn_insert(",
-                f"  &runtime->t{self.layer_id}, &{self.prealloc_expr6}->node{postfix}, &{self.prealloc_expr6}->k{postfix},",
-                f"  hash(&{self.prealloc_expr6}->k{postfix}, sizeof(L{self.layer_id}K))",
-                ");",
-            ]
+        return self.table.insert7(
+            f"runtime->t{self.layer_id}",
+            f"{self.prealloc_expr6}->node{postfix}",
+            f"{self.prealloc_expr6}->k{postfix}",
+            self.hash_expr6(f"{self.prealloc_expr6}->k{postfix}")
+            if postfix
+            else self.hash_var6,
         )
 
     @property
     def search_expr6(self):
-        return "\n".join(
-            [
-                f"tommy_hashdyn_search(",
-                f"  &runtime->t{self.layer_id}, l{self.layer_id}_eq, &{self.prealloc_expr6}->k,",
-                f"  hash(&{self.prealloc_expr6}->k, sizeof(L{self.layer_id}K))",
-                ")",
-            ]
+        return self.table.search6(
+            f"runtime->t{self.layer_id}",
+            f"l{self.layer_id}_eq",
+            f"{self.prealloc_expr6}->k",
+            self.hash_var6,
         )
 
     @property
@@ -176,13 +238,11 @@ class LayerContext:
         return self.remove_stat7_impl("")
 
     def remove_stat7_impl(self, postfix):
-        return "\n".join(
-            [
-                f"tommy_hashdyn_remove(",
-                f"  &runtime->t{self.layer_id}, l{self.layer_id}_eq, &{self.inst_expr6}->k{postfix},",
-                f"  hash(&{self.inst_expr6}->k{postfix}, sizeof(L{self.layer_id}K))",
-                ");",
-            ]
+        return self.table.remove7(
+            f"runtime->t{self.layer_id}",
+            f"l{self.layer_id}_eq",
+            f"{self.inst_expr6}->k{postfix}",
+            self.hash_expr6(f"{self.inst_expr6}->k{postfix}"),
         )
 
     @property
@@ -194,8 +254,26 @@ class LayerContext:
         return compile6_content(self.layer_id)
 
     @property
-    def need_free_expr6(self):
-        return compile6_need_free(self.layer_id)
+    def seq_limit6(self):
+        if self.seq.buffer_size is None:
+            return "WV_CONFIG_SeqBufferSize"
+        return str(self.seq.buffer_size)
+
+    @property
+    def seq_node_limit6(self):
+        if self.seq.node_count is None:
+            return "WV_CONFIG_SeqNodeCount"
+        return str(self.seq.node_count)
+
+    def init_seq7(self, seq_expr6):
+        return (
+            f"WV_InitSeq(&{seq_expr6}, &runtime->seq_pool, {self.seq_limit6}, "
+            f"{self.seq_node_limit6}, {int(self.buffer_data)}, {int(self.seq.zero_based)});"
+        )
+
+    @property
+    def wrap_expr6(self):
+        return f"runtime->{compile6_wrap(self.layer_id)}"
 
 
 # most of variables are declared by user through Bit/UInt of layouts
@@ -246,7 +324,7 @@ class InstVar:
 def compile4_var(var_id, context):
     reg = context.var_map[var_id]
     reg_info = context.stack.reg_map[reg]
-    return Expr({reg}, Eval1Var(reg), (reg_info.expr6, "$" + reg_info.debug_name))
+    return Expr({reg}, Eval1Var(reg), CAtom(reg_info.expr6, "$" + reg_info.debug_name))
 
 
 class Eval1Var:
@@ -291,8 +369,9 @@ class HeaderReg:
 
         self.expr6 = f"{compile6_struct_expr(self.struct_id)}->_{self.reg_id}"
 
-    def assign_key7(self, key7):
-        return f"{key7}._{self.reg_id} = {self.expr6};"
+    # src is the register whose value is assigned, for keys with swapped halves
+    def assign_key7(self, key7, src=None):
+        return f"{key7}._{self.reg_id} = {(src or self).expr6};"
 
 
 class TempReg:
@@ -317,15 +396,22 @@ class InstReg:
 
 
 # header actions
+# byte order of UInt fields is converted lazily in the program (see compile5_scanner), but
+# expressions evaluated during scanning have to convert the fields they read by themselves
+def compile7_ntoh_list(read_regs, context):
+    return [
+        init7 for reg, init7 in context.ntoh_init7_map.items() if reg in read_regs
+    ]
+
+
 class LocateStruct:
-    def __init__(self, struct_id, struct_length, parsed_reg, ntoh_init7_list):
+    def __init__(self, struct_id, struct_length, parsed_reg):
         if struct_id is not None:
             self.compile7 = "\n".join(
                 [
                     f"{compile6_struct_expr(struct_id)} = (WV_Any)current.cursor;",
                     f"current = WV_SliceAfter(current, {struct_length});",
                     f"{parsed_reg.expr6} = 1;",
-                    *ntoh_init7_list,
                 ],
             )
         else:
@@ -333,9 +419,10 @@ class LocateStruct:
 
 
 class CoverSlice:
-    def __init__(self, slice_reg, parsed_reg):
+    def __init__(self, slice_reg, parsed_reg, context):
         self.compile7 = "\n".join(
             [
+                *compile7_ntoh_list(slice_reg.length_expr4.read_regs, context),
                 f"{slice_reg.expr6}.cursor = current.cursor;",
                 f"{slice_reg.expr6}.length = ({slice_reg.length_expr4.compile6[0]}) >> 3; "
                 f"// {slice_reg.length_expr4.compile6[1]}",
@@ -355,24 +442,22 @@ def compile1_layout(layout, context):
     pack_length = 0
     struct_length = 0
     actions = []
-    ntoh_init7_list = []
     if layout.field_list == []:
-        actions.append(LocateStruct(None, None, parsed_reg, []))
+        actions.append(LocateStruct(None, None, parsed_reg))
     for name, bit in layout.field_list:
         if not isinstance(bit.length, int):
             assert pack_length == 0
             if struct_length != 0:
                 struct_id = context.finalize_struct()
-                actions.append(
-                    LocateStruct(struct_id, struct_length, parsed_reg, ntoh_init7_list)
-                )
+                actions.append(LocateStruct(struct_id, struct_length, parsed_reg))
                 struct_length = 0
-                ntoh_init7_list = []
             context.alloc_temp_reg(
                 AutoVar.from_bit(bit), layout.debug_name + "." + name
             )
             actions.append(
-                CoverSlice(context.stack.reg_map[context.query(bit)], parsed_reg)
+                CoverSlice(
+                    context.stack.reg_map[context.query(bit)], parsed_reg, context
+                )
             )
         elif bit.length % 8 == 0:
             assert bits_pack == []
@@ -382,11 +467,10 @@ def compile1_layout(layout, context):
             if bit.is_uint:
                 compile2_uint(bit, context)
                 ntoh_var = context.ntoh_map[bit.var_id]
-                var_id = bit.var_id
-                ntoh_init7_list.append(
+                context.ntoh_init7_map[context.query(ntoh_var)] = (
                     f"{context.stack.reg_map[context.query(ntoh_var)].expr6} = "
                     f"WV_NToH{ntoh_var.byte_length * 8}"
-                    f"({context.stack.reg_map[context.var_map[var_id]].expr6});",
+                    f"({context.stack.reg_map[context.query(bit)].expr6});"
                 )
         else:
             bits_pack.append((name, bit))
@@ -401,9 +485,7 @@ def compile1_layout(layout, context):
                 struct_length += 1
     if struct_length != 0:
         struct_id = context.finalize_struct()
-        actions.append(
-            LocateStruct(struct_id, struct_length, parsed_reg, ntoh_init7_list)
-        )
+        actions.append(LocateStruct(struct_id, struct_length, parsed_reg))
     return actions
 
 
@@ -417,22 +499,30 @@ def compile1_header_action(action, context):
 def compile1_if(if_action, context):
     return [
         ConditionalParse(
-            if_action.pred.compile4(context), if_action.yes_action.compile1(context)
+            if_action.pred.compile4(context),
+            if_action.yes_action.compile1(context),
+            context,
         )
     ]
 
 
 class ConditionalParse:
-    def __init__(self, pred4, scanner):
-        self.compile7 = code_comment(
-            f"if ({pred4.compile6[0]}) "
-            + indent_join(action.compile7 for action in scanner),
-            "IF " + pred4.compile6[1],
+    def __init__(self, pred4, scanner, context):
+        self.compile7 = "\n".join(
+            [
+                *compile7_ntoh_list(pred4.read_regs, context),
+                code_comment(
+                    f"if ({pred4.compile6[0]}) "
+                    + indent_join(action.compile7 for action in scanner),
+                    "IF " + pred4.compile6[1],
+                ),
+            ]
         )
 
 
 class TaggedLoop:
-    def __init__(self, tag_reg, scanner_map, pred4):
+    def __init__(self, tag_reg, scanner_map, pred4, context):
+        ntoh7_list = compile7_ntoh_list(pred4.read_regs, context)
         # I'm lazy
         assert tag_reg.byte_length in [1, 2]
         if tag_reg.byte_length == 1:
@@ -450,6 +540,7 @@ class TaggedLoop:
                             )
                             for value, scanner in scanner_map.items()
                         ),
+                        *ntoh7_list,
                         f"// WHILE {pred4.compile6[1]}",
                     ]
                 )
@@ -470,6 +561,7 @@ class TaggedLoop:
                             )
                             for value, scanner in scanner_map.items()
                         ),
+                        *ntoh7_list,
                         f"// WHILE {pred4.compile6[1]}",
                     ]
                 )
@@ -491,7 +583,7 @@ def compile1_any_until(any_until, context):
         case_scanner = compile1_layout(case_layout, context)
         context.layout_map[layout] = context.layout_map[case_layout]
         cases1[case_tag.const] = case_scanner
-    return [TaggedLoop(tag_reg, cases1, any_until.pred.compile4(context))]
+    return [TaggedLoop(tag_reg, cases1, any_until.pred.compile4(context), context)]
 
 
 # allocation and preparation
@@ -577,7 +669,7 @@ def compile2_event_group(event_group, context):
 
 # compile expressions & processing statements
 def compile4_const(value):
-    return Expr(set(), Eval1Const(value), (value, f"Const({value})"))
+    return Expr(set(), Eval1Const(value), CConst(value))
 
 
 class Eval1Const:
@@ -589,7 +681,7 @@ class Eval1Const:
 
 
 def compile4_empty():
-    return Expr(set(), Eval1Empty(), ("WV_EMPTY", "EmptySlice"))
+    return Expr(set(), Eval1Empty(), CAtom("WV_EMPTY", "EmptySlice"))
 
 
 class Eval1Empty:
@@ -604,11 +696,12 @@ def compile5_assign(assign, context):
     else:
         reg = assign.var.reg
     expr4 = assign.expr.compile4(context)
-    text = code_comment(
-        f"{context.stack.reg_map[reg].expr6} = {expr4.compile6[0]};",
-        f"{context.stack.reg_map[reg].debug_name} = {expr4.compile6[1]}",
+    code7 = CAssign(
+        context.stack.reg_map[reg].expr6,
+        context.stack.reg_map[reg].debug_name,
+        expr4.code6,
     )
-    return [UpdateReg(reg, expr4, False, text)]
+    return [UpdateReg(reg, expr4, False, code7)]
 
 
 def compile5_action(action, context):
@@ -633,8 +726,12 @@ def compile5_if(if_stat, context):
     ]
 
 
-def compile5_assemble(context, set_opt=True):
-    buffer_data = int(context.buffer_data if set_opt else False)
+# data is assembled from the buffer of sequence if it is inserted with `use_data`, which is
+# `set_opt` unless specified
+def compile5_assemble(context, set_opt=True, use_data=None):
+    if use_data is None:
+        use_data = set_opt
+    buffer_data = int(context.buffer_data if use_data else False)
     return [
         UpdateReg(
             StackContext.SEQUENCE,
@@ -642,7 +739,7 @@ def compile5_assemble(context, set_opt=True):
             True,
             code_comment(
                 f"{context.content_expr6} = "
-                f"WV_SeqAssemble(&{context.prefetch_expr6}->seq, &{context.need_free_expr6}, {buffer_data});",
+                f"WV_SeqAssemble(&{context.prefetch_expr6}->seq, {context.wrap_expr6 if buffer_data else 'NULL'}, {buffer_data});",
                 "assemble",
             ),
             SetOptFlag("assemble") if set_opt else None,
@@ -677,24 +774,25 @@ class VUpdateOp:
         return Expr(
             {StackContext.SEQUENCE, self.vexpr_reg, *expr4.read_regs},
             Eval1Abstract(),
-            (
+            CFormat(
                 f"WV_UpdateV(&{context.stack.reg_map[self.vexpr_reg].expr6}, "
-                f"{expr4.compile6[0]}) && WV_SeqReady(&{context.prefetch_expr6}->seq)",
-                f"vexpr({expr4.compile6[1]})",
+                f"{{}}) && WV_SeqReady(&{context.prefetch_expr6}->seq)",
+                "vexpr({})",
+                [expr4.code6],
             ),
         )
 
 
 def compile4_op2(name, expr1, expr2, context):
-    expr1_4 = expr1.compile4(context)
-    expr2_4 = expr2.compile4(context)
+    return compile4h_op2(name, expr1.compile4(context), expr2.compile4(context))
+
+
+# compile4_op2 for operands that are compiled already
+def compile4h_op2(name, expr1_4, expr2_4):
     return Expr(
         expr1_4.read_regs | expr2_4.read_regs,
         Eval1Op2(name, expr1_4, expr2_4),
-        (
-            compile6h_op2(name, expr1_4.compile6[0], expr2_4.compile6[0]),
-            compile6h_op2(name, expr1_4.compile6[1], expr2_4.compile6[1]),
-        ),
+        COp(name, [expr1_4.code6, expr2_4.code6]),
     )
 
 
@@ -735,44 +833,12 @@ class Eval1Op2:
             assert False, "unknown op2"
 
 
-def compile6h_op2(name, expr1, expr2):
-    if name == "add":
-        return f"WV_SafeAdd32({expr1}, {expr2})"
-    elif name == "sub":
-        return f"({expr1}) - ({expr2})"
-    elif name == "left_shift":
-        return f"({expr1}) << ({expr2})"
-    elif name == "less_than":
-        return f"({expr1}) < ({expr2})"
-    elif name == "equal":
-        return f"({expr1}) == ({expr2})"
-    elif name == "and":
-        return f"({expr1}) && ({expr2})"
-    elif name == "or":
-        return f"({expr1}) || ({expr2})"
-    elif name == "slice_before":
-        return f"WV_SliceBefore({expr1}, {expr2})"
-    elif name == "slice_after":
-        return f"WV_SliceAfter({expr1}, {expr2})"
-    elif name == "slice_get":
-        return f"({expr1}).cursor[{expr2}]"
-    elif name == "bit_and":
-        return f"({expr1}) & ({expr2})"
-    elif name == "right_shift":
-        return f"({expr1}) >> ({expr2})"
-    else:
-        assert False, f"unknown op2 {name}"
-
-
 def compile4_op1(name, expr, context):
     expr4 = expr.compile4(context)
     return Expr(
         expr4.read_regs,
         Eval1Op1(name, expr4),
-        (
-            compile6h_op1(name, expr4.compile6[0]),
-            compile6h_op1(name, expr4.compile6[1]),
-        ),
+        COp(name, [expr4.code6]),
     )
 
 
@@ -791,20 +857,11 @@ class Eval1Op1:
             assert False, f"unknown op1 {self.name}"
 
 
-def compile6h_op1(name, expr):
-    if name == "slice_length":
-        return f"({expr}).length"
-    elif name == "not":
-        return f"!({expr})"
-    else:
-        assert False, f"unknown op1 {name}"
-
-
 def compile4_header_contain(layout, context):
     return Expr(
         {StackContext.HEADER},
         Eval1Abstract(),
-        (
+        CAtom(
             f"{context.stack.reg_map[context.layout_map[layout]].expr6} == 1",
             f"<layout {layout.debug_name} is parsed>",
         ),
@@ -812,24 +869,26 @@ def compile4_header_contain(layout, context):
 
 
 def compile4_payload():
-    return Expr({StackContext.HEADER}, Eval1Abstract(), ("current", "$unparsed"))
+    return Expr({StackContext.HEADER}, Eval1Abstract(), CAtom("current", "$unparsed"))
 
 
 def compile4_content(context):
     return Expr(
-        {StackContext.SEQUENCE}, Eval1Abstract(), (context.content_expr6, "$sdu")
+        {StackContext.SEQUENCE}, Eval1Abstract(), CAtom(context.content_expr6, "$sdu")
     )
 
 
 def compile4_total():
-    return Expr({StackContext.RUNTIME}, Eval1Abstract(), ("saved", "$total"))
+    return Expr({StackContext.RUNTIME}, Eval1Abstract(), CAtom("saved", "$total"))
 
 
 def compile4_foreign_var(reg, context):
+    if reg not in context.var_map.values():
+        context.stack.foreign_regs.add(reg)
     return Expr(
         {reg},
         Eval1Var(reg),
-        (
+        CAtom(
             context.stack.reg_map[reg].expr6,
             "$foreign." + context.stack.reg_map[reg].debug_name,
         ),
@@ -847,18 +906,16 @@ def compile4_var_equal(var, expr, context):
     return Expr(
         {reg, *expr4.read_regs},
         Eval1Op2("equal", var4, expr4),
-        (
-            compile6h_op2("equal", var4.compile6[0], expr4.compile6[0]),
-            compile6h_op2("equal", var4.compile6[1], expr4.compile6[1]),
-        ),
-        Eval3VarEqual(reg, expr4),
+        COp("equal", [var4.code6, expr4.code6]),
+        Eval3VarEqual(reg, expr4, var4.compile6[0]),
     )
 
 
 class Eval3VarEqual:
-    def __init__(self, reg, expr):
+    def __init__(self, reg, expr, var6):
         self.reg = reg
         self.expr = expr
+        self.var6 = var6
 
     def eval3(self, context):
         try:
@@ -866,6 +923,14 @@ class Eval3VarEqual:
         except NotConstant:
             pass
 
+    # (var6, value) if the variable is compared against a constant, so that chains of
+    # such branches could be compiled into switch (see rubik.compile2.compile7_block)
+    def switch_case(self):
+        try:
+            return self.var6, self.expr.eval1({})
+        except NotConstant:
+            return None
+
 
 def compile5_assign_quic_uint(assign, context):
     reg = context.query(assign.var)
@@ -919,6 +984,7 @@ def compile5_assign_sdu(expr, context):
                 f"{context.content_expr6} = {expr4.compile6[0]};",
                 f"assign sdu <- {expr4.compile6[1]}",
             ),
+            peek_handler=peek_replay,
         )
     ]
 
@@ -982,7 +1048,12 @@ def compile3_inst(prototype, context):
                 reg1.append(r1)
                 reg2.append(r2)
         return BiInst(
-            reg1, reg2, dual, context.perm_regs, AutoVar.from_bit(prototype.rev_flag),
+            reg1,
+            reg2,
+            dual,
+            context.perm_regs,
+            AutoVar.from_bit(prototype.rev_flag),
+            prototype.canonical_key,
         )
 
 
@@ -996,13 +1067,17 @@ class Inst:
         self.create_light = CreateLightInst
         self.destroy = DestroyInst
         self.decl = DeclInst
+        self.canonical = False
 
-    def compile5(self, context):
-        return compile5_inst(self, context)
+    def compile5(self, context, stateless_pred=None):
+        return compile5_inst(self, context, stateless_pred)
 
     def compile2(self, context):
         pass
 
+    def assign_key7(self, context, key7):
+        return compile7_assign_key(self.key_regs, context, key7)
+
     def compile5_fetch_extra(self, context):
         return []
 
@@ -1018,6 +1093,16 @@ class CreateLightInst:
         )
 
 
+def compile7_assign_key(key_regs, context, key7):
+    return "\n".join(
+        code_comment(
+            context.stack.reg_map[reg].assign_key7(key7),
+            f"set key for {context.stack.reg_map[reg].debug_name}",
+        )
+        for reg in key_regs
+    )
+
+
 class CreateLightBiInst:
     def __init__(self, context):
         self.compile7 = code_comment(
@@ -1027,7 +1112,7 @@ class CreateLightBiInst:
         )
 
 
-def compile5_inst(inst, context):
+def compile5_inst(inst, context, stateless_pred=None):
     fetch_route = [
         UpdateReg(
             StackContext.INSTANCE, abstract_expr, True, inst.fetch(context).compile7,
@@ -1078,22 +1163,43 @@ def compile5_inst(inst, context):
         *init_stats,
         *inst.compile5_create_extra(context),
     ]
-    return [
+    prefetch = inst.prefetch(context)
+    lookup = [
         UpdateReg(
             StackContext.INSTANCE,
             Expr(set(inst.key_regs), Eval1Abstract(), None),
             True,
-            inst.prefetch(context).compile7,
+            prefetch.compile7,
+            peek_handler=prefetch,
         ),
         Branch(
             Expr(
                 {StackContext.INSTANCE},
                 Eval1Abstract(),
-                (context.prefetch_expr6, "instance exist"),
+                CAtom(context.prefetch_expr6, "instance exist"),
             ),
             fetch_route,
             create_route,
         ),
+    ]
+    if stateless_pred is not None:
+        # stateless packets always run on a fresh instance, which is destroyed before the
+        # packet is done, so it could be a light one and `optimize` also removes sequence
+        # buffering for it
+        stateless_route = [
+            UpdateReg(
+                StackContext.INSTANCE,
+                abstract_expr,
+                True,
+                inst.create_light(context).compile7,
+                SetOptFlag("create"),
+            ),
+            *init_stats,
+            *inst.compile5_create_extra(context),
+        ]
+        lookup = [Branch(stateless_pred, stateless_route, lookup)]
+    return [
+        *lookup,
         UpdateReg(
             StackContext.SEQUENCE,
             Expr({StackContext.INSTANCE}, Eval1Abstract(), None),
@@ -1120,21 +1226,41 @@ class PrefetchInst:
     def __init__(self, context):
         self.compile7 = "\n".join(
             [
-                *[
-                    code_comment(
-                        context.stack.reg_map[reg].assign_key7(
-                            f"{context.prealloc_expr6}->k"
-                        ),
-                        f"set key for {context.stack.reg_map[reg].debug_name}",
-                    )
-                    for reg in context.inst.key_regs
-                ],
+                context.inst.assign_key7(context, f"{context.prealloc_expr6}->k"),
+                code_comment(
+                    f"{context.hash_var6} = burst_layer == {context.layer_id} ? "
+                    f"(burst_layer = -1, burst_hash) : "
+                    f"{context.hash_expr6(f'{context.prealloc_expr6}->k')};",
+                    "hash key (computed ahead when processing burst)",
+                ),
                 code_comment(
                     f"{context.prefetch_expr6} = {context.search_expr6};",
                     "prefetch instance",
                 ),
             ],
         )
+        peek_key6 = compile6_peek_key(context.layer_id)
+        self.peek7_text = "\n".join(
+            [
+                f"memset(&{peek_key6}, 0, sizeof({compile6_key_type(context.layer_id)}));",
+                context.inst.assign_key7(context, peek_key6),
+                code_comment(
+                    "\n".join(
+                        [
+                            f"hint->layer = {context.layer_id};",
+                            f"hint->hash = {context.hash_expr6(peek_key6)};",
+                            "return;",
+                        ]
+                    ),
+                    "peek instance",
+                ),
+            ]
+        )
+
+    peek_end = True
+
+    def peek7(self, instr):
+        return self.peek7_text
 
 
 class CreateInst:
@@ -1145,39 +1271,58 @@ class CreateInst:
                     context.insert_stat7,
                     f"{context.prefetch_expr6} = (WV_Any)({context.inst_expr6} = {context.prealloc_expr6});",
                     f"{context.inst_expr6}->user_data = NULL;",
-                    f"WV_InitSeq(&{context.inst_expr6}->seq, {int(context.buffer_data)}, {int(context.seq.zero_based)});"
+                    context.init_seq7(f"{context.inst_expr6}->seq")
                     if context.seq is not None
                     else "// no seq",
-                    f"TIMER_INSERT(runtime, {context.inst_type6}, {context.inst_expr6});",
-                    f"{context.prealloc_expr6} = WV_Malloc(sizeof({context.inst_type6}));",
-                    f"memset({context.prealloc_expr6}, 0, sizeof({context.inst_type6}));",
+                    f"TIMER_INSERT(runtime, {context.timer_expr6}, {context.inst_expr6});",
+                    context.alloc_stat7(
+                        ("k", compile6_key_type(context.layer_id))
+                    ),
                 ]
             ),
             "create instance",
         )
 
 
+# a bidirectional instance is inserted twice by default, with key and reversed key
+# with canonical key, it is inserted once with the half keys ordered, and direction
+# of packet is told by whether they are swapped
 class BiInst:
-    def __init__(self, key_regs1, key_regs2, dual_regs, inst_regs, to_active):
+    def __init__(
+        self, key_regs1, key_regs2, dual_regs, inst_regs, to_active, canonical=False
+    ):
         self.key_regs1 = key_regs1
         self.key_regs2 = key_regs2
         self.dual_regs = dual_regs
         self.inst_regs = inst_regs
         self.key_regs = self.key_regs1 + self.key_regs2 + self.dual_regs
         self.prefetch = PrefetchInst  # same as Inst
-        self.create = CreateBiInst
-        self.create_light = CreateLightBiInst
-        self.fetch = FetchBiInst
-        self.destroy = DestroyBiInst
-        self.decl = DeclBiInst
+        self.canonical = canonical
+        if canonical:
+            self.create = CreateCanonicalBiInst
+            self.create_light = CreateLightCanonicalBiInst
+            self.fetch = FetchCanonicalBiInst
+            self.destroy = DestroyCanonicalBiInst
+            self.decl = DeclCanonicalBiInst
+        else:
+            self.create = CreateBiInst
+            self.create_light = CreateLightBiInst
+            self.fetch = FetchBiInst
+            self.destroy = DestroyBiInst
+            self.decl = DeclBiInst
         self.to_active = to_active
 
-    def compile5(self, context):
-        return compile5_inst(self, context)
+    def compile5(self, context, stateless_pred=None):
+        return compile5_inst(self, context, stateless_pred)
 
     def compile2(self, context):
         return compile2_bi_inst(self, context)
 
+    def assign_key7(self, context, key7):
+        if not self.canonical:
+            return compile7_assign_key(self.key_regs, context, key7)
+        return compile7_assign_canonical_key(self, context, key7)
+
     def compile5_fetch_extra(self, context):
         return [
             UpdateReg(
@@ -1247,15 +1392,17 @@ class CreateBiInst:
                     f"{context.inst_expr6}->flag_rev = 1;",
                     *(
                         [
-                            f"WV_InitSeq(&{context.inst_expr6}->seq, {int(context.buffer_data)}, {int(context.seq.zero_based)});",
-                            f"WV_InitSeq(&{context.inst_expr6}->seq_rev, {int(context.buffer_data)}, {int(context.seq.zero_based)});",
+                            context.init_seq7(f"{context.inst_expr6}->seq"),
+                            context.init_seq7(f"{context.inst_expr6}->seq_rev"),
                         ]
                         if context.seq is not None
                         else ["// no seq"]
                     ),
-                    f"TIMER_INSERT(runtime, {context.inst_type6}, {context.inst_expr6});",
-                    f"{context.prealloc_expr6} = WV_Malloc(sizeof({context.inst_type6}));",
-                    f"memset({context.prealloc_expr6}, 0, sizeof({context.inst_type6}));",
+                    f"TIMER_INSERT(runtime, {context.timer_expr6}, {context.inst_expr6});",
+                    context.alloc_stat7(
+                        ("k", compile6_key_type(context.layer_id)),
+                        ("k_rev", compile6_rev_key_type(context.layer_id)),
+                    ),
                 ]
             ),
             "create bidirectional instance",
@@ -1268,6 +1415,7 @@ class DestroyBiInst:
             [
                 context.remove_stat7,
                 context.remove_rev_stat7,
+                f"TIMER_REMOVE({context.timer_expr6}, {context.inst_expr6});",
                 *(
                     [
                         f"WV_CleanSeq(&{context.inst_expr6}->seq, {int(context.buffer_data)});",
@@ -1276,7 +1424,113 @@ class DestroyBiInst:
                     if context.seq is not None
                     else ["// no seq"]
                 ),
-                f"WV_Free({context.inst_expr6});",
+                f"WV_SlabFree({context.slab_expr6}, {context.inst_expr6});",
+            ]
+        )
+
+
+def compile7_assign_canonical_key(bi_inst, context, key7):
+    reg_map = context.stack.reg_map
+    dir6 = compile6_dir(context.layer_id)
+    pairs = list(zip(bi_inst.key_regs1, bi_inst.key_regs2))
+    greater6 = "0"
+    for reg1, reg2 in reversed(pairs):
+        expr1, expr2 = reg_map[reg1].expr6, reg_map[reg2].expr6
+        greater6 = f"{expr1} != {expr2} ? {expr1} > {expr2} : {greater6}"
+    return "\n".join(
+        [
+            code_comment(
+                f"{dir6} = {greater6};", "direction: first half key is greater"
+            ),
+            code_comment(
+                f"if ({dir6}) "
+                + indent_join(
+                    stat
+                    for reg1, reg2 in pairs
+                    for stat in [
+                        reg_map[reg1].assign_key7(key7, reg_map[reg2]),
+                        reg_map[reg2].assign_key7(key7, reg_map[reg1]),
+                    ]
+                )
+                + " else "
+                + indent_join(
+                    reg_map[reg].assign_key7(key7)
+                    for reg in bi_inst.key_regs1 + bi_inst.key_regs2
+                ),
+                "set canonical key, smaller half key first",
+            ),
+            compile7_assign_key(bi_inst.dual_regs, context, key7),
+        ]
+    )
+
+
+class DeclCanonicalBiInst:
+    def __init__(self, context):
+        self.compile7 = compile7_decl_canonical_bi_inst(context.inst, context)
+
+
+class FetchCanonicalBiInst:
+    def __init__(self, context):
+        dir6 = compile6_dir(context.layer_id)
+        self.compile7 = code_comment(
+            f"{context.inst_expr6} = (WV_Any){context.prefetch_expr6};\n"
+            f"{context.prefetch_expr6} = &{context.inst_expr6}->view[{dir6} ^ {context.inst_expr6}->flag];",
+            "fetch canonical bidirectional instance",
+        ) + f"\nTIMER_FETCH(runtime, {context.inst_type6}, {context.inst_expr6});"
+
+
+class CreateLightCanonicalBiInst:
+    def __init__(self, context):
+        self.compile7 = code_comment(
+            f"{context.prefetch_expr6} = &({context.inst_expr6} = {context.prealloc_expr6})->view[0];\n"
+            f"{context.prefetch_expr6}->reversed = 0;",
+            "create light canonical bidirectional instance",
+        )
+
+
+class CreateCanonicalBiInst:
+    def __init__(self, context):
+        inst6 = context.inst_expr6
+        self.compile7 = code_comment(
+            "\n".join(
+                [
+                    context.insert_stat7,
+                    f"{context.prefetch_expr6} = &({inst6} = {context.prealloc_expr6})->view[0];",
+                    f"{inst6}->flag = {compile6_dir(context.layer_id)};",
+                    f"{inst6}->view[0].reversed = 0;",
+                    f"{inst6}->view[1].reversed = 1;",
+                    f"{inst6}->view[0].user_data = {inst6}->view[1].user_data = NULL;",
+                    *(
+                        [
+                            context.init_seq7(f"{inst6}->view[0].seq"),
+                            context.init_seq7(f"{inst6}->view[1].seq"),
+                        ]
+                        if context.seq is not None
+                        else ["// no seq"]
+                    ),
+                    f"TIMER_INSERT(runtime, {context.timer_expr6}, {inst6});",
+                    context.alloc_stat7(("k", compile6_key_type(context.layer_id))),
+                ]
+            ),
+            "create canonical bidirectional instance",
+        )
+
+
+class DestroyCanonicalBiInst:
+    def __init__(self, context):
+        self.compile7 = "\n".join(
+            [
+                context.remove_stat7,
+                f"TIMER_REMOVE({context.timer_expr6}, {context.inst_expr6});",
+                *(
+                    [
+                        f"WV_CleanSeq(&{context.inst_expr6}->view[0].seq, {int(context.buffer_data)});",
+                        f"WV_CleanSeq(&{context.inst_expr6}->view[1].seq, {int(context.buffer_data)});",
+                    ]
+                    if context.seq is not None
+                    else ["// no seq"]
+                ),
+                f"WV_SlabFree({context.slab_expr6}, {context.inst_expr6});",
             ]
         )
 
@@ -1286,17 +1540,24 @@ class DestroyInst:
         self.compile7 = "\n".join(
             [
                 context.remove_stat7,
+                f"TIMER_REMOVE({context.timer_expr6}, {context.inst_expr6});",
                 f"WV_CleanSeq(&{context.inst_expr6}->seq, {int(context.buffer_data)});"
                 if context.seq is not None
                 else "// no seq",
-                f"WV_Free({context.inst_expr6});",
+                f"WV_SlabFree({context.slab_expr6}, {context.inst_expr6});",
             ]
         )
 
 
 def compile5_scanner(scanner, context):
     return [
-        UpdateReg(StackContext.HEADER, abstract_expr, False, "saved = current;"),
+        UpdateReg(
+            StackContext.HEADER,
+            abstract_expr,
+            False,
+            "saved = current;",
+            peek_handler=peek_replay,
+        ),
         UpdateReg(
             StackContext.HEADER,
             abstract_expr,
@@ -1310,6 +1571,7 @@ def compile5_scanner(scanner, context):
                     *[action.compile7 for action in scanner],
                 ]
             ),
+            peek_handler=peek_replay,
         ),
         *[
             UpdateReg(
@@ -1328,13 +1590,18 @@ def compile5_scanner(scanner, context):
             Expr({StackContext.HEADER}, Eval1Abstract(), None),
             False,
             code_comment(f"{context.content_expr6} = current;", "set SDU to payload"),
+            peek_handler=peek_replay,
         ),
         *[
             UpdateReg(
                 context.query(ntoh_var),
                 Expr({context.var_map[var_id]}, Eval1Abstract(), None),
                 False,
-                comment_only(f"set {ntoh_var.compile4(context).compile6[1]}"),
+                code_comment(
+                    context.ntoh_init7_map[context.query(ntoh_var)],
+                    f"set {ntoh_var.compile4(context).compile6[1]}",
+                ),
+                is_lazy=True,
             )
             for var_id, ntoh_var in context.ntoh_map.items()
         ],
@@ -1385,6 +1652,8 @@ def compile5_seq(seq, context, set_opt=True):
 # allocate layer according to prototype
 def compile3a_prototype(prototype, stack, layer_id, extra_event):
     context = LayerContext(layer_id, stack)
+    context.table = compile6_table(prototype.table)
+    context.table_capacity = prototype.table_capacity
     scanner = prototype.header.compile1(context)
 
     # prototype.header.compile2(context)
@@ -1454,10 +1723,18 @@ def compile5a_layer(layer):
     compile2_event_group(layer.event, layer.context)
 
     instr_list = compile5_scanner(layer.scanner, layer.context)
-    if layer.context.inst is not None:
-        instr_list += layer.context.inst.compile5(layer.context)
-    if layer.general is not None:
-        instr_list += layer.general.compile5(layer.context)
+    general_list = (
+        layer.general.compile5(layer.context) if layer.general is not None else []
+    )
+    stateless_pred = compile5_stateless_pred(layer, general_list)
+    if stateless_pred is not None:
+        # the predicate is decided before instance lookup, so does prep
+        instr_list += general_list
+        instr_list += layer.context.inst.compile5(layer.context, stateless_pred)
+    else:
+        if layer.context.inst is not None:
+            instr_list += layer.context.inst.compile5(layer.context)
+        instr_list += general_list
     if layer.seq is not None:
         instr_list += compile5_seq(layer.seq, layer.context)
     if layer.psm is not None:
@@ -1471,7 +1748,8 @@ def compile5a_layer(layer):
                 ),
                 False,
                 code_comment(
-                    f"if ({layer.psm.trans_var.compile4(layer.context).compile6[0]} == 0) goto G_Shower;",
+                    f"if ({layer.psm.trans_var.compile4(layer.context).compile6[0]} == 0) "
+                    + compile7_layer_exit(layer.context.stack),
                     "broken transition fail",
                 ),
             )
@@ -1509,14 +1787,44 @@ def compile5a_layer(layer):
             abstract_expr,
             False,
             f"current = {layer.context.content_expr6};",
+            peek_handler=peek_replay,
         )
     ]
-    instr_list += compile5_next_list(layer.next_list, layer.context, False)
+    next_list = compile5_next_list(layer.next_list, layer.context, False)
+    if layer.context.stack.share_layers and next_list:
+        layer.context.next_list = next_list
+        next_list = [compile5_next_call(next_list, layer.context)]
+    instr_list += next_list
     instr_list += compile5_finalize(layer, layer.context)
     instr_list += compile5_next_list(layer.next_list, layer.context, True)
     return Block.from_codes(instr_list)
 
 
+def compile5_stateless_pred(layer, general_list):
+    if layer.psm is None or layer.context.inst is None:
+        return None
+    pred = layer.psm.compile0_stateless_pred()
+    if pred is None:
+        return None
+    pred4 = pred.compile4(layer.context)
+    inst_list = layer.context.inst.compile5(layer.context)
+    inst_write_regs = set()
+    inst_read_regs = set()
+    for instr in inst_list:
+        inst_write_regs |= instr.write_regs
+        inst_read_regs |= instr.read_regs
+    general_read_regs = set(pred4.read_regs)
+    general_write_regs = set()
+    for instr in general_list:
+        general_read_regs |= instr.read_regs
+        general_write_regs |= instr.write_regs
+    assert not general_read_regs & inst_write_regs, (
+        "stateless predicate and prep should not depend on instance"
+    )
+    assert not general_write_regs & inst_read_regs
+    return pred4
+
+
 def compile5_finalize(layer, context):
     if layer.psm is not None:
         return [
@@ -1539,36 +1847,137 @@ def compile5_finalize(layer, context):
 
 
 def compile5_next_list(next_list, context, recursive):
-    stats = []
+    # adjacent edges that test one variable against different constants under the same
+    # condition are dispatched by a single switch, with the condition evaluated once
+    groups = []
     for pred, dst_layer in next_list:
         if recursive != (dst_layer.context.layer_id == context.layer_id):
             continue
-        jump = UpdateReg(
-            StackContext.RUNTIME,
-            abstract_expr,
-            True,
-            code_comment(
-                "\n".join(
-                    [
-                        "b%%BLOCK_ID%%_t = return_target;",
-                        "return_target = %%BLOCK_ID%%;",
-                        f"goto L{dst_layer.context.layer_id};",
-                        "B%%BLOCK_ID%%_R:",
-                        "return_target = b%%BLOCK_ID%%_t;",
-                    ]
-                    if not recursive
-                    else ["// recursive", f"goto L{dst_layer.context.layer_id};"]
-                ),
-                f"jump to next layer #{dst_layer.context.layer_id}",
-            ),
-        )
-        # print('before', stats)
-        stats = [Branch(pred.compile4(context), [jump], stats)]
-        # print(stats, stats[0].no_list)
+        split = compile5_split_equal(pred, context)
+        if (
+            split is not None
+            and groups
+            and groups[-1][0][2] is not None
+            and groups[-1][0][2][0] == split[0]
+            and split[3] not in [edge[2][3] for edge in groups[-1]]
+        ):
+            groups[-1].append((pred, dst_layer, split))
+        else:
+            groups.append([(pred, dst_layer, split)])
+
+    stats = []
+    for group in groups:
+        if len(group) == 1:
+            pred, dst_layer, _split = group[0]
+            jump = compile5_jump(dst_layer, context, recursive)
+            stats = [Branch(pred.compile4(context), [jump], stats)]
+        else:
+            stats = [compile5_switch(group, context, recursive, stats)]
 
     return stats
 
 
+# layers of the same prototype are mostly different in the next layers, e.g. the outer and
+# inner IP layers of PPTP stack, whose dispatching are even optimized differently, so when
+# stack.share_layers is set, dispatching is compiled into its own function instead, which
+# could be a parameter of the shared layer function (see compile7_layer_funcs)
+def compile5_next_call(next_list, context):
+    read_regs = set()
+    for instr in next_list:
+        read_regs |= instr.read_regs
+    return UpdateReg(
+        StackContext.RUNTIME,
+        Expr(read_regs, Eval1Abstract(), None),
+        True,
+        code_comment(compile7_next_call(context.layer_id), "jump to next layers"),
+        peek_handler=PeekNext(next_list, context.stack),
+    )
+
+
+# (key, common, var4, value) for predicate `common & (var == value)`, where edges with
+# the same key could share a switch
+def compile5_split_equal(pred, context):
+    split = getattr(pred, "compile0_split_equal", lambda: None)()
+    if split is None:
+        return None
+    common, var, value = split
+    var4 = var.compile4(context)
+    if common is None:
+        common_key = None
+    else:
+        # `a | b` and `b | a` are the same condition
+        common_key = frozenset(
+            str(term)
+            for term in getattr(common, "compile0_or_terms", lambda: [common])()
+        )
+    return (common_key, var4.compile6[0]), common, var4, value
+
+
+def compile5_jump(dst_layer, context, recursive):
+    return UpdateReg(
+        StackContext.RUNTIME,
+        abstract_expr,
+        True,
+        CComment(
+            CLines(
+                compile7_jump_lines(
+                    f"goto L{dst_layer.context.layer_id};",
+                    compile7_layer_call(dst_layer.context.layer_id),
+                    context.stack,
+                    recursive,
+                )
+            ),
+            f"jump to next layer #{dst_layer.context.layer_id}",
+        ),
+        peek_handler=PeekJump(dst_layer.context.layer_id),
+    )
+
+
+# goto7 jumps to the next layer, which returns through G_Shower, while call7 calls the
+# function of the next layer when the stack is compiled with layer_functions
+def compile7_jump_lines(goto7, call7, stack, recursive):
+    if stack.layer_functions:
+        return [call7] if not recursive else ["// recursive", call7, "return;"]
+    if recursive:
+        return ["// recursive", goto7]
+    return [
+        BlockRef("b{}_t = return_target;"),
+        BlockRef("return_target = WV_ReturnTo({});"),
+        goto7,
+        BlockRef("B{}_R:"),
+        BlockRef("return_target = b{}_t;"),
+    ]
+
+
+def compile5_switch(group, context, recursive, else_stats):
+    _key, common, var4, _value = group[0][2]
+    case_map = {split[3]: dst_layer.context.layer_id for _pred, dst_layer, split in group}
+    pred4 = None
+    for value in case_map:
+        equal4 = compile4h_op2("equal", var4, compile4_const(value))
+        pred4 = equal4 if pred4 is None else compile4h_op2("or", pred4, equal4)
+    if common is not None:
+        pred4 = compile4h_op2("and", common.compile4(context), pred4)
+    goto7 = f"switch ({var4.compile6[0]}) " + indent_join(
+        f"case {value}: goto L{layer_id};" for value, layer_id in case_map.items()
+    )
+    call7 = f"switch ({var4.compile6[0]}) " + indent_join(
+        f"case {value}: {compile7_layer_call(layer_id)} break;"
+        for value, layer_id in case_map.items()
+    )
+    jump = UpdateReg(
+        StackContext.RUNTIME,
+        Expr(set(var4.read_regs), Eval1Abstract(), None),
+        True,
+        CComment(
+            CLines(compile7_jump_lines(goto7, call7, context.stack, recursive)),
+            f"jump to next layer by {var4.compile6[1]}",
+        ),
+        peek_handler=PeekSwitch(var4, case_map),
+    )
+    return Branch(pred4, [jump], else_stats)
+
+
 # opt
 class OptimizeContext:
     def __init__(self, flag_map, index):
@@ -1580,6 +1989,25 @@ class OptimizeDriver:
     def __init__(self, context):
         self.context = context
 
+    # everything optimize() takes from the layer besides the program, so the optimized
+    # program could be cached by these and the program (see rubik.cache)
+    def cache_key(self):
+        context = self.context
+        key = [context.content_expr6, context.prefetch_expr6]
+        if context.inst is not None:
+            key.append(context.inst.create_light(context).compile7)
+        if context.seq is not None:
+            key += [
+                context.seq.data.compile4(context),
+                context.seq.offset.compile4(context),
+                context.seq.takeup.compile4(context),
+                compile5_seq(context.seq, context, False),
+                compile5_seq(context.seq, context, True),
+                compile5_assemble(context, False),
+                compile5_assemble(context, False, True),
+            ]
+        return key
+
     def __call__(self, instr_list):
         flag_map = {}
         for index, instr in enumerate(instr_list):
@@ -1653,10 +2081,10 @@ def optimize(instr_list, flags, context):
                         *takeup4.read_regs,
                     },
                     Eval1Abstract(),
-                    (
-                        f"WV_SeqEmptyAlign(&{context.prefetch_expr6}->seq, "
-                        f"{offset4.compile6[0]}, {data4.compile6[0]}, {takeup4.compile6[0]})",
+                    CFormat(
+                        f"WV_SeqEmptyAlign(&{context.prefetch_expr6}->seq, {{}}, {{}}, {{}})",
                         "EmptyAlign",
+                        [offset4.code6, data4.code6, takeup4.code6],
                     ),
                 ),
                 compile5_seq(context.seq, context, False)
@@ -1666,7 +2094,7 @@ def optimize(instr_list, flags, context):
                 + instr_list[assemble + 1 :],
                 compile5_seq(context.seq, context, True)
                 + instr_list[insert + 1 : assemble]
-                + compile5_assemble(context, False)
+                + compile5_assemble(context, False, True)
                 + instr_list[assemble + 1 :],
             )
         ]
@@ -1680,3 +2108,145 @@ class SetOptFlag:
 
     def opt(self, context):
         context.flag_map[self.name] = context.index
+
+
+# liveness
+# after all layers are optimized, temp registers that are never read by any layer are dead:
+# their assignments are removed from the programs, and their declarations from the
+# generated function (see compile7_stack)
+# read_regs of some hand-written instructions is not precise, so a register is also
+# considered read if its name shows up in code other than its own assignments
+SLICE_BYTE_LENGTH = 16  # sizeof(WV_ByteSlice) on 64-bit targets
+
+
+class DeadStat:
+    def __init__(self, layer_id):
+        self.layer_id = layer_id
+        self.reg_count = 0
+        self.stat_count = 0
+        self.byte_count = 0
+
+    def __str__(self):
+        return (
+            f"layer #{self.layer_id}: removed {self.reg_count} registers, "
+            f"{self.stat_count} statements, {self.byte_count} bytes of stack frame"
+        )
+
+
+def compile5_reg_mention(instr):
+    if isinstance(instr, Branch):
+        code6 = instr.pred.compile6[0]
+    else:
+        code6 = instr.compile7
+    return {int(reg) for reg in re.findall(r"\b_(\d+)\b", code6)}
+
+
+def eliminate_dead_regs(stack, block_map, layer_context_map):
+    owner_map = {
+        reg: layer_id
+        for layer_id, context in layer_context_map.items()
+        for reg in context.var_map.values()
+        if isinstance(stack.reg_map[reg], TempReg)
+    }
+    dead_stats = {layer_id: DeadStat(layer_id) for layer_id in block_map}
+    # instructions are shared by blocks and kept by remove_dead, so the code of every
+    # instruction is scanned once
+    mention_map = {}
+    while True:
+        live_regs = set()
+        for block in block_map.values():
+            for sub_block in block.recurse():
+                if sub_block.pred is not None:
+                    live_regs |= sub_block.pred.read_regs
+            for instr in block.instructions():
+                live_regs |= instr.read_regs
+                if instr not in mention_map:
+                    mention = compile5_reg_mention(instr)
+                    if isinstance(instr, UpdateReg) and not instr.is_command:
+                        mention.discard(instr.reg)
+                    mention_map[instr] = mention
+                live_regs |= mention_map[instr]
+        dead_regs = {
+            reg
+            for reg in owner_map
+            if reg not in live_regs and reg not in stack.dead_regs
+        }
+        if not dead_regs:
+            break
+        stack.dead_regs |= dead_regs
+        for reg in dead_regs:
+            reg_info = stack.reg_map[reg]
+            dead_stat = dead_stats[owner_map[reg]]
+            dead_stat.reg_count += 1
+            dead_stat.byte_count += (
+                reg_info.byte_length
+                if reg_info.byte_length is not None
+                else SLICE_BYTE_LENGTH
+            )
+        for layer_id, block in block_map.items():
+            removed = []
+            block_map[layer_id] = block.remove_dead(stack.dead_regs, removed)
+            # comment-only assignments generate no code
+            dead_stats[layer_id].stat_count += sum(
+                1
+                for instr in removed
+                if any(
+                    not line.startswith("//") for line in instr.compile7.split("\n")
+                )
+            )
+    return block_map, list(dead_stats.values())
+
+
+# peek
+# WV_ProcessBurst runs every packet through a copy of the program which stops at the
+# first instance prefetching, to compute its hash and warm up the table before the
+# real processing
+# only instructions that change nothing but local variables could be copied, the ones
+# writing special registers or instance registers stop peeking, unless they come
+# with a peek handler, which implements peek7(instr) to return the code to be copied
+class PeekReplay:
+    def peek7(self, instr):
+        return instr.compile7
+
+
+peek_replay = PeekReplay()
+
+
+class PeekSwitch:
+    peek_end = True
+
+    def __init__(self, var4, case_map):
+        self.var4 = var4
+        self.case_map = case_map
+
+    def peek7(self, instr):
+        return code_comment(
+            f"switch ({self.var4.compile6[0]}) "
+            + indent_join(
+                f"case {value}: goto PL{layer_id};"
+                for value, layer_id in self.case_map.items()
+            )
+            + "\nreturn;",
+            f"peek next layer by {self.var4.compile6[1]}",
+        )
+
+
+class PeekNext:
+    def __init__(self, next_list, stack):
+        peek7_list, _fallthrough = compile7_peek_list(next_list, stack)
+        self.code7 = "\n".join(peek7_list)
+
+    def peek7(self, instr):
+        return self.code7
+
+
+class PeekJump:
+    peek_end = True
+
+    def __init__(self, layer_id):
+        self.layer_id = layer_id
+
+    def peek7(self, instr):
+        return code_comment(
+            f"goto PL{self.layer_id};", f"peek next layer #{self.layer_id}"
+        )
@@ -1,39 +1,120 @@
+import re
+
 from rubik.util import indent_join, make_block, code_comment
+from rubik.ctree import CIf
 from mako.template import Template
 
 
 def compile7_branch(branch):
-    return code_comment(
-        "\n".join(
-            [
-                f"if ({branch.pred.compile6[0]}) "
-                + indent_join(stat.compile7 for stat in branch.yes_list)
-                + " else "
-                + indent_join(stat.compile7 for stat in branch.no_list),
-            ]
-        ),
-        f"IF {branch.pred.compile6[1]}",
-    )
+    return CIf(branch.pred.code6, branch.yes_list, branch.no_list)
 
 
-def compile7_block(block, is_entry, layer_id):
+def compile7_block(block, is_entry, layer_id, stack):
     if is_entry:
         prefix = f"L{layer_id}: "
     else:
         prefix = f"B{block.block_id}: "
-    if block.pred is not None:
+    case_list = compile7_case_list(block)
+    if len(case_list) > 1:
+        escape = f"switch ({case_list[0][0]}) " + indent_join(
+            [
+                *[
+                    f"case {value}: goto B{yes_block.block_id};"
+                    for _var6, value, yes_block, _no_block in case_list
+                ],
+                f"default: goto B{case_list[-1][3].block_id};",
+            ]
+        )
+    elif block.pred is not None:
         escape = code_comment(
             f"if ({block.pred.compile6[0]}) goto B{block.yes_block.block_id}; "
             f"else goto B{block.no_block.block_id};",
             f"BRANCH {block.pred.compile6[1]}",
         )
     else:
-        escape = "goto G_Shower;"
+        escape = compile7_layer_exit(stack)
     return prefix + indent_join(
-        [*[instr.compile7 for instr in block.instr_list], escape]
+        [*[instr.render7(block.block_id) for instr in block.instr_list], escape]
     )
 
 
+# [(var6, value, yes_block, no_block)] for the chain of branches starting from block,
+# which compare the same variable against different constants, and no instruction is
+# executed in between
+def compile7_case_list(block):
+    case_list = []
+    while block.pred is not None:
+        switch_case = getattr(block.pred.eval3_handler, "switch_case", lambda: None)()
+        if switch_case is None or not isinstance(switch_case[1], int):
+            break
+        var6, value = switch_case
+        if case_list and (
+            var6 != case_list[0][0] or value in {case[1] for case in case_list}
+        ):
+            break
+        case_list.append((var6, value, block.yes_block, block.no_block))
+        block = block.no_block
+        if block.instr_list:
+            break
+    return case_list
+
+
+# peek7 is the code copied into PeekPacket, or None if peeking should stop before
+# the instruction
+def compile7_peek_instr(instr, stack):
+    if hasattr(instr, "yes_list"):
+        yes7, _ = compile7_peek_list(instr.yes_list, stack)
+        no7, _ = compile7_peek_list(instr.no_list, stack)
+        return code_comment(
+            f"if ({instr.pred.compile6[0]}) "
+            + indent_join(yes7)
+            + " else "
+            + indent_join(no7),
+            f"IF {instr.pred.compile6[1]}",
+        )
+    if instr.peek_handler is not None:
+        return instr.peek_handler.peek7(instr)
+    reg = stack.reg_map.get(instr.reg)
+    # special registers and instance registers
+    if reg is None or hasattr(reg, "layer_id"):
+        return None
+    return instr.compile7
+
+
+def compile7_peek_list(instr_list, stack):
+    peek7_list = []
+    for instr in instr_list:
+        peek7 = compile7_peek_instr(instr, stack)
+        if peek7 is None:
+            return peek7_list + ["return;"], False
+        peek7_list.append(peek7)
+        if getattr(instr, "peek_handler", None) is not None and getattr(
+            instr.peek_handler, "peek_end", False
+        ):
+            return peek7_list, False
+    return peek7_list, True
+
+
+def compile7_peek_block(block, is_entry, layer_id, stack):
+    if is_entry:
+        prefix = f"PL{layer_id}: "
+    else:
+        prefix = f"PB{block.block_id}: "
+    peek7_list, fallthrough = compile7_peek_list(block.instr_list, stack)
+    if fallthrough:
+        if block.pred is not None:
+            peek7_list.append(
+                code_comment(
+                    f"if ({block.pred.compile6[0]}) goto PB{block.yes_block.block_id}; "
+                    f"else goto PB{block.no_block.block_id};",
+                    f"BRANCH {block.pred.compile6[1]}",
+                )
+            )
+        else:
+            peek7_list.append("return;")
+    return prefix + indent_join(peek7_list), fallthrough and block.pred is not None
+
+
 # really want to use `$123` instead of `_123` for every register
 # i.e. `h42->$123` for header registers and `l0_i->$123` for instance registers
 # and use `_123` for names derived from corresponding registers
@@ -41,16 +122,29 @@ def compile7_block(block, is_entry, layer_id):
 # unfortunately, GDB use $123 as reference to result of expression no.123 in
 # interactive session
 # revert it to original idea if there's any way to tweak GDB pls
-def decl_reg(reg, prefix="_"):
+def decl_reg(reg, prefix="_", init=True):
     if reg.byte_length is not None:
         type_decl = f"WV_U{reg.byte_length * 8}"
         post = ""
     else:
         type_decl = "WV_ByteSlice"
-        post = " = WV_EMPTY"
+        post = " = WV_EMPTY" if init else ""
     return f"{type_decl} {prefix}{reg.reg_id}{post};  // {reg.debug_name}"
 
 
+# temp registers, which are locals of ProcessPacket
+def local_regs(stack):
+    return [
+        reg
+        for reg in stack.reg_map.values()
+        # todo
+        if not hasattr(reg, "layer_id")
+        and not hasattr(reg, "struct_id")
+        and not hasattr(reg, "slice_reg6")
+        and reg.reg_id not in stack.dead_regs
+    ]
+
+
 def decl_header_reg(reg):
     if not hasattr(reg, "bit_length"):  # for SliceKeyReg
         prefix = "WV_Byte"
@@ -73,11 +167,30 @@ def compile7_stack(stack, block_map, inst_decls, entry_id, layer_context_map):
 ## prefix7
 #include <weaver.h>
 #include <tommyds/tommyhashdyn.h>
+#include <tommyds/tommyhashlin.h>
 #if TOMMY_SIZE_BIT == 64
 #define hash(k, s) tommy_hash_u64(0, k, s)
 #else
 #define hash(k, s) tommy_hash_u32(0, k, s)
 #endif
+#define WV_Prefetch(p) __builtin_prefetch(p)
+#define WV_BURST_MAX 32
+// layers return to where they are jumped from through G_Shower, either by the address
+// of the return label (GCC labels as values), or by switching on the jumping block id
+#if defined(__GNUC__) && !defined(WV_CONFIG_SwitchReturn)
+#define WV_COMPUTED_RETURN
+typedef void *WV_ReturnTarget;
+#define WV_ReturnTo(id) (&&B##id##_R)
+#define WV_ReturnEnd (&&G_End)
+#else
+typedef WV_I32 WV_ReturnTarget;
+#define WV_ReturnTo(id) (id)
+#define WV_ReturnEnd (-1)
+#endif
+typedef struct {
+  WV_I32 layer;
+  tommy_hash_t hash;
+} WV_BurstHint;
 ## struct7
 % for struct, regs in stack.struct_map.items():
 typedef struct {
@@ -105,22 +218,33 @@ int l${i}_eq(const void *key, const void *object) {
 ## runtime7
 struct _WV_Runtime {
   WV_Profile profile;
-  WV_U64 packet_count;
+  WV_U64 now;
+  WV_SeqPool seq_pool;
   % for i in range(layer_count):
   % if i in inst_decls:
   ${compile6_inst_type(i)} *l${i}_p;
-  tommy_hashdyn t${i};
+  WV_Slab s${i};
+  ${layer_context_map[i].table.type6} t${i};
   TIMER_FIELDS(${compile6_inst_type(i)})
   % endif
+  % if layer_context_map[i].seq is not None and layer_context_map[i].buffer_data:
+  // assembled data that wraps around sequence buffer
+  WV_Byte ${compile6_wrap(i)}[${layer_context_map[i].seq_limit6}];
+  % endif
   % endfor
 };
 WV_Runtime *WV_AllocRuntime() {
   WV_Runtime *rt = WV_Malloc(sizeof(WV_Runtime));
-  rt->packet_count = 0;
+  // wheels start from the first timestamp, since they are empty until then
+  rt->now = 0;
+  memset(&rt->profile, 0, sizeof(WV_Profile));
+  WV_InitSeqPool(&rt->seq_pool);
   % for i in range(layer_count):
   % if i in inst_decls:
-  tommy_hashdyn_init(&rt->t${i});
-  rt->l${i}_p = WV_Malloc(sizeof(${compile6_inst_type(i)}));
+  ${layer_context_map[i].table.init7(f"rt->t{i}", layer_context_map[i].table_capacity)}
+  WV_InitSlab(&rt->s${i}, "${compile6_inst_type(i)}", sizeof(${compile6_inst_type(i)}));
+  WV_ProfileWatchSlab(&rt->profile, &rt->s${i}.stat);
+  rt->l${i}_p = WV_SlabAlloc(&rt->s${i});
   memset(rt->l${i}_p, 0, sizeof(${compile6_inst_type(i)}));
   TIMER_INIT(rt, ${compile6_inst_type(i)});
   % endif
@@ -134,21 +258,16 @@ WV_U8 WV_FreeRuntime(WV_Runtime *rt) {
 WV_Profile *WV_GetProfile(WV_Runtime *rt) {
   return &rt->profile;
 }
-WV_U8 TimerCleanup(WV_Runtime *rt) {
+// destroy instances that are idle for TIMEOUT, at most budget of them are checked
+WV_U8 TimerCleanup(WV_Runtime *rt, WV_U32 budget) {
   WV_Runtime *runtime = rt;
-  struct timeval tv;
-  gettimeofday(&tv, NULL);
-  WV_U64 now = tv.tv_sec;
+  WV_TimerNode *node;
   % for i in range(layer_count):
   % if i in inst_decls:
-  <% last_ptr = f'rt->{compile6_inst_type(i)}_timer_last' %>
-  while (${last_ptr} != NULL && ${last_ptr}->last_update + TIMEOUT < now) {
-    ${compile6_inst_type(i)} *${layer_context_map[i].inst_expr6} = ${last_ptr};
+  budget += WV_TimerAdvance(&rt->${compile6_inst_type(i)}_timer, rt->now) * WV_CONFIG_TimerExpireBudget;
+  while ((node = TIMER_POP(rt, ${compile6_inst_type(i)}, &budget)) != NULL) {
+    ${compile6_inst_type(i)} *${layer_context_map[i].inst_expr6} = TIMER_ENTRY(node, ${compile6_inst_type(i)});
     ${layer_context_map[i].inst.destroy(layer_context_map[i]).compile7}
-    ${last_ptr} = ${last_ptr}->prev;
-  }
-  if (${last_ptr} == NULL) {
-    rt->${compile6_inst_type(i)}_timer_head = NULL;
   }
   % endif
   % endfor
@@ -161,96 +280,692 @@ WV_U8 TimerCleanup(WV_Runtime *rt) {
         layer_count=len(block_map),
         compile6_key_type=compile6_key_type,
         compile6_inst_type=compile6_inst_type,
+        compile6_wrap=compile6_wrap,
         decl_header_reg=decl_header_reg,
         layer_context_map=layer_context_map
     )
 
     layer_count = len(block_map)
-    raw_blocks7 = {
-        block.block_id: compile7_block(block, block is entry, layer_id)
+    # blocks are hash-consed, so a block may be reached from several others (or even
+    # several layers, e.g. empty exit blocks), and it is still compiled and emitted once
+    blocks7 = {
+        block.block_id: compile7_block(block, block is entry, layer_id, stack)
         for layer_id, entry in block_map.items()
         for block in entry.recursive()
     }
-    blocks7 = {
-        block_id: block7.replace("%%BLOCK_ID%%", str(block_id))
-        for block_id, block7 in raw_blocks7.items()
+    # blocks that return from the next layer to themselves (see compile7_jump_lines)
+    return_blocks = {
+        block.block_id
+        for entry in block_map.values()
+        for block in entry.recursive()
+        if any(instr.has_block_ref for instr in block.instr_list)
     }
 
-    process7 = (
-        "WV_U8 WV_ProcessPacket(WV_ByteSlice packet, WV_Runtime *runtime) "
+    struct_decls7 = [
+        *[f"H{struct} *{compile6_struct_expr(struct)};" for struct in stack.struct_map],
+        *[
+            f"H{struct} h{struct}_c; h{struct} = &h{struct}_c;"
+            for struct in stack.call_struct.values()
+        ],
+    ]
+    reg_decls7 = [decl_reg(reg, "_") for reg in local_regs(stack)]
+
+    peek_blocks7 = {}
+    for layer_id, entry in block_map.items():
+        pending = [entry]
+        while pending:
+            block = pending.pop()
+            if block.block_id in peek_blocks7:
+                continue
+            peek_block7, branching = compile7_peek_block(
+                block, block is entry, layer_id, stack
+            )
+            peek_blocks7[block.block_id] = peek_block7
+            if branching:
+                pending += [block.no_block, block.yes_block]
+
+    peek7 = (
+        "static void PeekPacket(WV_ByteSlice packet, WV_Runtime *runtime, WV_BurstHint *hint) "
         + indent_join(
             [
+                *struct_decls7,
                 *[
-                    'if (runtime->packet_count++ == 1000000) ' + make_block(
-                        'runtime->packet_count = 0;\n'
-                        'TimerCleanup(runtime);'
-                    )
-                ],
-                *[
-                    f"H{struct} *{compile6_struct_expr(struct)};"
-                    for struct in stack.struct_map
-                ],
-                *[
-                    f"H{struct} h{struct}_c; h{struct} = &h{struct}_c;"
-                    for struct in stack.call_struct.values()
-                ],
-                *[
-                    f"WV_ByteSlice {compile6_content(layer)};\n"
-                    + f"WV_Byte *{compile6_need_free(layer)} = NULL;"
+                    f"WV_ByteSlice {compile6_content(layer)};"
                     for layer in range(layer_count)
                 ],
                 *[
-                    f"{compile6_inst_type(layer)} *{compile6_inst_expr(layer)};\n"
-                    + f"{compile6_prefetch_type(layer)} *{compile6_prefetch_expr(layer)};"
+                    f"{compile6_key_type(layer)} {compile6_peek_key(layer)};"
                     for layer in range(layer_count)
                     if layer in inst_decls
                 ],
                 *[
-                    f"WV_U16 b{block_id}_t;"
-                    for block_id in blocks7
-                    if raw_blocks7[block_id] != blocks7[block_id]
-                ],
-                *[
-                    decl_reg(reg, "_")
-                    for reg in stack.reg_map.values()
-                    # todo
-                    if not hasattr(reg, "layer_id")
-                    and not hasattr(reg, "struct_id")
-                    and not hasattr(reg, "slice_reg6")
+                    f"WV_U8 {compile6_dir(layer)};"
+                    for layer in range(layer_count)
+                    if layer in inst_decls and layer_context_map[layer].inst.canonical
                 ],
+                *reg_decls7,
                 "WV_ByteSlice current = packet, saved;",
-                "WV_I32 return_target = -1;",
-                f"goto L{entry_id};",
-                "G_Shower: "
-                + make_block(
-                    "switch (return_target) "
-                    + indent_join(
-                        [
-                            *[
-                                f"case {block_id}: goto B{block_id}_R;"
-                                for block_id in blocks7
-                                if raw_blocks7[block_id] != blocks7[block_id]
-                            ],
-                            "default: goto G_End;",
-                        ]
-                    )
-                ),
-                "G_End: "
+                "hint->layer = -1;",
+                f"goto PL{entry_id};",
+                *peek_blocks7.values(),
+            ]
+        )
+    )
+
+    prefetch7 = "\n".join(
+        [
+            "static void PrefetchBucket(WV_Runtime *runtime, WV_BurstHint *hint) "
+            + make_block(
+                "switch (hint->layer) "
                 + indent_join(
                     [
                         *[
-                            f"if (l{layer}_nf) WV_Free(l{layer}_nf);"
+                            f"case {layer}: WV_Prefetch("
+                            f"{layer_context_map[layer].table.slot6(f'runtime->t{layer}', 'hint->hash')}); break;"
                             for layer in range(layer_count)
+                            if layer in inst_decls
                         ],
-                        "return 0;",
+                        "default: break;",
                     ]
+                )
+            ),
+            "static void PrefetchInstance(WV_Runtime *runtime, WV_BurstHint *hint) "
+            + indent_join(
+                [
+                    "WV_Any node = NULL;",
+                    "switch (hint->layer) "
+                    + indent_join(
+                        [
+                            *[
+                                f"case {layer}: node = "
+                                f"{layer_context_map[layer].table.bucket6(f'runtime->t{layer}', 'hint->hash')}; break;"
+                                for layer in range(layer_count)
+                                if layer in inst_decls
+                            ],
+                            "default: break;",
+                        ]
+                    ),
+                    "if (node) WV_Prefetch(node);",
+                ]
+            ),
+        ]
+    )
+
+    if stack.layer_functions:
+        process7 = compile7_layer_funcs(
+            stack, block_map, blocks7, inst_decls, entry_id, layer_context_map
+        )
+    else:
+        process7 = (
+            "static WV_U8 ProcessPacket(WV_ByteSlice packet, WV_Runtime *runtime, WV_BurstHint *hint) "
+            + indent_join(
+                [
+                    *struct_decls7,
+                    *[
+                        f"WV_ByteSlice {compile6_content(layer)};"
+                        for layer in range(layer_count)
+                    ],
+                    *[
+                        f"{compile6_inst_type(layer)} *{compile6_inst_expr(layer)};\n"
+                        + f"{compile6_prefetch_type(layer)} *{compile6_prefetch_expr(layer)};\n"
+                        + f"tommy_hash_t {compile6_hash(layer)};"
+                        for layer in range(layer_count)
+                        if layer in inst_decls
+                    ],
+                    *[
+                        f"WV_U8 {compile6_dir(layer)};"
+                        for layer in range(layer_count)
+                        if layer in inst_decls and layer_context_map[layer].inst.canonical
+                    ],
+                    *[
+                        f"WV_ReturnTarget b{block_id}_t;"
+                        for block_id in blocks7
+                        if block_id in return_blocks
+                    ],
+                    *reg_decls7,
+                    "WV_ByteSlice current = packet, saved;",
+                    "WV_ReturnTarget return_target = WV_ReturnEnd;",
+                    "WV_I32 burst_layer = hint ? hint->layer : -1;",
+                    "tommy_hash_t burst_hash = hint ? hint->hash : 0;",
+                    f"goto L{entry_id};",
+                    "G_Shower: "
+                    + make_block(
+                        "\n".join(
+                            [
+                                "#ifdef WV_COMPUTED_RETURN",
+                                "goto *return_target;",
+                                "#else",
+                                "switch (return_target) "
+                                + indent_join(
+                                    [
+                                        *[
+                                            f"case {block_id}: goto B{block_id}_R;"
+                                            for block_id in blocks7
+                                            if block_id in return_blocks
+                                        ],
+                                        "default: goto G_End;",
+                                    ]
+                                ),
+                                "#endif",
+                            ]
+                        )
+                    ),
+                    "G_End: return 0;",
+                    *blocks7.values(),
+                ]
+            )
+        )
+
+    # a burst is processed in three passes, so that the cache misses of table
+    # searching for different packets overlap with each other instead of stalling
+    # one by one:
+    # 1. peek every packet to compute its hash, and prefetch the bucket
+    # 2. prefetch the first node in the bucket, which is probably the instance
+    # 3. process packets as usual, with hashes from 1
+    # hints only carry hashes, so instances expired in pass 3 are never referred
+    # timestamps (in microseconds) come from the driver, e.g. the capture time of a
+    # replayed trace, one for every packet, and the status of every packet is stored
+    # into `statuses`
+    burst7 = "\n".join(
+        [
+            "// timestamps of a replayed trace may step backward, runtime clock never does",
+            "static void SetClock(WV_Runtime *runtime, WV_U64 ts) "
+            + indent_join(
+                [
+                    "WV_U64 now = WV_TimerTick(ts);",
+                    "if (now > runtime->now) runtime->now = now;",
+                ]
+            ),
+            "WV_U8 WV_ProcessPacketTs(WV_ByteSlice packet, WV_U64 ts, WV_Runtime *runtime) "
+            + indent_join(
+                [
+                    "SetClock(runtime, ts);",
+                    "TimerCleanup(runtime, WV_CONFIG_TimerExpireBudget);",
+                    "return ProcessPacket(packet, runtime, NULL);",
+                ]
+            ),
+            "WV_U8 WV_ProcessPacket(WV_ByteSlice packet, WV_Runtime *runtime) "
+            + make_block("return WV_ProcessPacketTs(packet, WV_TimerClock(), runtime);"),
+            "// clock is set by caller if ts is NULL",
+            "static WV_U8 ProcessBurst(WV_ByteSlice *packets, const WV_U64 *ts, WV_U32 count, "
+            "WV_U8 *statuses, WV_Runtime *runtime) "
+            + indent_join(
+                [
+                    "WV_BurstHint hints[WV_BURST_MAX];",
+                    "for (WV_U32 base = 0; base < count; base += WV_BURST_MAX) "
+                    + indent_join(
+                        [
+                            "WV_U32 n = count - base < WV_BURST_MAX ? count - base : WV_BURST_MAX;",
+                            "for (WV_U32 i = 0; i < n; i += 1) "
+                            + indent_join(
+                                [
+                                    "PeekPacket(packets[base + i], runtime, &hints[i]);",
+                                    "PrefetchBucket(runtime, &hints[i]);",
+                                ]
+                            ),
+                            "for (WV_U32 i = 0; i < n; i += 1) "
+                            + make_block("PrefetchInstance(runtime, &hints[i]);"),
+                            "for (WV_U32 i = 0; i < n; i += 1) "
+                            + indent_join(
+                                [
+                                    "if (ts != NULL) SetClock(runtime, ts[base + i]);",
+                                    "TimerCleanup(runtime, WV_CONFIG_TimerExpireBudget);",
+                                    "statuses[base + i] = ProcessPacket(packets[base + i], runtime, &hints[i]);",
+                                ]
+                            ),
+                        ]
+                    ),
+                    "return 0;",
+                ]
+            ),
+            "WV_U8 WV_ProcessBurstTs(WV_ByteSlice *packets, const WV_U64 *ts, WV_U32 count, "
+            "WV_U8 *statuses, WV_Runtime *runtime) "
+            + make_block("return ProcessBurst(packets, ts, count, statuses, runtime);"),
+            "WV_U8 WV_ProcessBurst(WV_ByteSlice *packets, WV_U32 count, WV_U8 *statuses, "
+            "WV_Runtime *runtime) "
+            + indent_join(
+                [
+                    "SetClock(runtime, WV_TimerClock());",
+                    "return ProcessBurst(packets, NULL, count, statuses, runtime);",
+                ]
+            ),
+        ]
+    )
+
+    return "\n".join([struct7, peek7, prefetch7, process7, burst7])
+
+
+# when stack.layer_functions is set, every layer is compiled into its own function
+# instead of a label in ProcessPacket, so that register allocation works on smaller
+# functions, and profilers could tell the layers apart
+# locals of ProcessPacket are shared between layers, so they are moved into a per-packet
+# frame, which is passed to every layer function
+def compile7_layer_funcs(stack, block_map, blocks7, inst_decls, entry_id, layer_context_map):
+    layer_count = len(block_map)
+    # (declaration, name) of frame fields
+    frame_fields = [
+        *[
+            (f"H{struct} *{compile6_struct_expr(struct)};", compile6_struct_expr(struct))
+            for struct in stack.struct_map
+        ],
+        *[(f"H{struct} h{struct}_c;", f"h{struct}_c") for struct in stack.call_struct.values()],
+        *[
+            (f"WV_ByteSlice {compile6_content(layer)};", compile6_content(layer))
+            for layer in range(layer_count)
+        ],
+        *[
+            field
+            for layer in range(layer_count)
+            if layer in inst_decls
+            for field in [
+                (
+                    f"{compile6_inst_type(layer)} *{compile6_inst_expr(layer)};",
+                    compile6_inst_expr(layer),
+                ),
+                (
+                    f"{compile6_prefetch_type(layer)} *{compile6_prefetch_expr(layer)};",
+                    compile6_prefetch_expr(layer),
                 ),
-                *blocks7.values(),
+                (f"tommy_hash_t {compile6_hash(layer)};", compile6_hash(layer)),
             ]
+        ],
+        *[
+            (f"WV_U8 {compile6_dir(layer)};", compile6_dir(layer))
+            for layer in range(layer_count)
+            if layer in inst_decls and layer_context_map[layer].inst.canonical
+        ],
+        *[(decl_reg(reg, "_", init=False), f"_{reg.reg_id}") for reg in local_regs(stack)],
+        ("WV_ByteSlice current;", "current"),
+        ("WV_ByteSlice saved;", "saved"),
+        ("WV_I32 burst_layer;", "burst_layer"),
+        ("tommy_hash_t burst_hash;", "burst_hash"),
+    ]
+    frame_access = re.compile(
+        r"(?<!->)(?<![\w.])("
+        + "|".join(sorted((name for _decl, name in frame_fields), key=len, reverse=True))
+        + r")\b"
+    )
+
+    def compile7_frame_access(code7):
+        return frame_access.sub(r"frame->\1", code7)
+
+    layer_body7_map = {
+        layer_id: indent_join(
+            compile7_frame_access(blocks7[block.block_id]) for block in entry.recursive()
         )
+        for layer_id, entry in block_map.items()
+    }
+    # dispatching of the layers, if it is compiled into its own function
+    next_body7_map = {
+        layer_id: indent_join(
+            compile7_frame_access(instr.compile7)
+            for instr in layer_context_map[layer_id].next_list
+        )
+        for layer_id in block_map
+        if layer_context_map[layer_id].next_list is not None
+    }
+    # a layer calls the layers that its dispatching function calls as well
+    call_map = {
+        layer_id: {
+            int(callee)
+            for callee in re.findall(
+                r"\bLayer(\d+)\(frame", body7 + next_body7_map.get(layer_id, "")
+            )
+        }
+        for layer_id, body7 in layer_body7_map.items()
+    }
+
+    share_list = []
+    if stack.share_layers:
+        share_list = compile7_share_layers(
+            layer_body7_map,
+            {
+                layer_id: compile7_layer_decls(stack, layer_id, inst_decls, layer_context_map)
+                for layer_id in block_map
+            },
+            {
+                name: decl[: re.search(rf"\b{name}\b", decl).start()]
+                for decl, name in frame_fields
+            },
+            {
+                layer_id: {f"L{layer_id}"} | {f"B{block.block_id}" for block in entry.recursive()}
+                for layer_id, entry in block_map.items()
+            },
+        )
+    shared_layers = {layer_id for share in share_list for layer_id in share.layers}
+
+    # always_inline fails on (mutual) recursion
+    def is_recursive(layer_id):
+        visited, pending = set(), list(call_map[layer_id])
+        while pending:
+            callee = pending.pop()
+            if callee == layer_id:
+                return True
+            if callee not in visited:
+                visited.add(callee)
+                pending += call_map[callee]
+        return False
+
+    def is_inline(layer_id):
+        if is_recursive(layer_id):
+            return False
+        # the function only calls the shared one
+        if layer_id in shared_layers:
+            return True
+        if layer_id not in inst_decls and stack.inline_stateless:
+            return True
+        return layer_body7_map[layer_id].count("\n") + 1 <= stack.inline_lines
+
+    def decl_layer_func(layer_id):
+        if is_inline(layer_id):
+            prefix = "static inline __attribute__((always_inline))"
+        else:
+            prefix = "static __attribute__((noinline))"
+        return (
+            f"{prefix} void {compile6_layer_func(layer_id)}"
+            "(WV_Frame *frame, WV_Runtime *runtime, WV_BurstHint *hint)"
+        )
+
+    # inlined unless it is called by shared function through parameter
+    def decl_next_func(layer_id):
+        return (
+            f"static inline void {compile6_next_func(layer_id)}"
+            "(WV_Frame *frame, WV_Runtime *runtime, WV_BurstHint *hint)"
+        )
+
+    return "\n".join(
+        [
+            "typedef struct "
+            + indent_join(decl for decl, _name in frame_fields)
+            + " WV_Frame;",
+            *[decl_layer_func(layer_id) + ";" for layer_id in block_map],
+            *[
+                decl_next_func(layer_id) + " " + next_body7
+                for layer_id, next_body7 in next_body7_map.items()
+            ],
+            *[share.compile7() for share in share_list],
+            *[
+                decl_layer_func(layer_id)
+                + " "
+                + (
+                    make_block(
+                        next(share for share in share_list if layer_id in share.layers)
+                        .call7(layer_id)
+                    )
+                    if layer_id in shared_layers
+                    else body7
+                )
+                for layer_id, body7 in layer_body7_map.items()
+            ],
+            "static WV_U8 ProcessPacket(WV_ByteSlice packet, WV_Runtime *runtime, WV_BurstHint *hint) "
+            + indent_join(
+                [
+                    "WV_Frame frame_storage, *frame = &frame_storage;",
+                    *[
+                        compile7_frame_access(init7)
+                        for init7 in [
+                            *[
+                                f"h{struct} = &h{struct}_c;"
+                                for struct in stack.call_struct.values()
+                            ],
+                            *[
+                                f"_{reg.reg_id} = WV_EMPTY;"
+                                for reg in local_regs(stack)
+                                if reg.byte_length is None
+                            ],
+                            "current = packet;",
+                            "burst_layer = hint ? hint->layer : -1;",
+                            "burst_hash = hint ? hint->hash : 0;",
+                        ]
+                    ],
+                    compile7_layer_call(entry_id),
+                    "return 0;",
+                ]
+            ),
+        ]
+    )
+
+
+# types that are declared for the layer, i.e. its header structs and instance types
+def compile7_layer_decls(stack, layer_id, inst_decls, layer_context_map):
+    return "\n".join(
+        [
+            *[
+                "typedef struct "
+                + indent_join(decl_header_reg(stack.reg_map[reg]) for reg in stack.struct_map[struct])
+                + f"__attribute__((packed)) H{struct};"
+                for struct in sorted(layer_context_map[layer_id].structs)
+            ],
+            inst_decls[layer_id].compile7 if layer_id in inst_decls else "",
+        ]
     )
 
-    return "\n".join([struct7, process7])
+
+# layers that are compiled into the same code, except the names of their own frame fields,
+# runtime fields, types and labels, the layers they call and some constants, share a
+# single function, which takes the differences as parameters
+# this is the case of layers that are created by the same parser, and are followed by
+# similar layers (or dispatching functions), e.g. the outer and inner IP layers of GTP and
+# PPTP stacks
+class SharedLayers:
+    def __init__(self, layers, param_list, body7):
+        self.layers = layers
+        # (C declaration of parameter field, {layer_id: value7})
+        self.param_list = param_list
+        self.body7 = body7
+
+    @property
+    def func6(self):
+        return f"{compile6_layer_func(self.layers[0])}Shared"
+
+    @property
+    def param_type6(self):
+        return f"L{self.layers[0]}P"
+
+    def compile7(self):
+        return "\n".join(
+            [
+                "typedef struct "
+                + indent_join(decl7 for decl7, _value_map in self.param_list)
+                + f" {self.param_type6};",
+                *[
+                    f"static const {self.param_type6} l{layer_id}_param = "
+                    + indent_join(
+                        f"{value_map[layer_id]}," for _decl7, value_map in self.param_list
+                    )
+                    + ";"
+                    for layer_id in self.layers
+                ],
+                f"static __attribute__((noinline)) void {self.func6}(WV_Frame *frame, "
+                f"WV_Runtime *runtime, WV_BurstHint *hint, const {self.param_type6} *param) "
+                + self.body7,
+            ]
+        )
+
+    def call7(self, layer_id):
+        return f"{self.func6}(frame, runtime, hint, &l{layer_id}_param);"
+
+
+# comments are dropped, since they are not compared
+C_TOKEN = re.compile(r'//[^\n]*|"(?:\\.|[^"\\])*"|[A-Za-z_]\w*|\d\w*|->|\S')
+
+
+def c_tokens(code7):
+    return [match for match in C_TOKEN.finditer(code7) if not match.group().startswith("//")]
+
+
+# identifier with numbers erased, i.e. `L#I` for both `L1I` and `L4I`
+def c_shape(token):
+    return re.sub(r"\d+", "#", token)
+
+
+# {identifier: identifier} that renames decl7 into other_decl7, or None if they are
+# different in other ways
+def c_renaming(decl7, other_decl7):
+    tokens, other_tokens = c_tokens(decl7), c_tokens(other_decl7)
+    if len(tokens) != len(other_tokens):
+        return None
+    renaming = {}
+    for token, other_token in zip(tokens, other_tokens):
+        x, y = token.group(), other_token.group()
+        if x == y:
+            continue
+        if not re.fullmatch(r"[A-Za-z_]\w*", x) or c_shape(x) != c_shape(y):
+            return None
+        if renaming.setdefault(x, y) != y:
+            return None
+    return renaming
+
+
+def compile7_share_layers(layer_body7_map, layer_decls7_map, frame_type_map, label_map):
+    # [(layers, {layer_id: {(kind, token position or name): token}})]
+    group_list = []
+    for layer_id, body7 in layer_body7_map.items():
+        for layers, diff_map in group_list:
+            diff = compile7_layer_diff(
+                layers[0],
+                layer_id,
+                layer_body7_map,
+                layer_decls7_map,
+                frame_type_map,
+                label_map,
+            )
+            if diff is not None:
+                layers.append(layer_id)
+                diff_map[layer_id] = diff
+                break
+        else:
+            group_list.append(([layer_id], {layer_id: {}}))
+
+    share_list = []
+    for layers, diff_map in group_list:
+        if len(layers) == 1:
+            continue
+        rep = layers[0]
+        tokens = c_tokens(layer_body7_map[rep])
+        param_list = []
+        replace_map = {}  # token position -> C expression
+        param_map = {}  # (kind, token) -> param name
+        for position, token in enumerate(tokens):
+            value_map = {
+                layer_id: diff_map[layer_id].get(position, token.group())
+                for layer_id in layers
+            }
+            if len(set(value_map.values())) == 1:
+                continue
+            kind, x = next(
+                diff_map[layer_id][("kind", position)]
+                for layer_id in layers[1:]
+                if ("kind", position) in diff_map[layer_id]
+            )
+            if kind == "n":
+                key = (kind, tuple(value_map.values()))
+            else:
+                key = (kind, x)
+            if key not in param_map:
+                name = f"{kind}{len(param_map)}"
+                param_map[key] = name
+                if kind == "f":
+                    decl7 = f"WV_U32 {name};"
+                    values = {
+                        layer_id: f"offsetof(WV_Frame, {value})"
+                        for layer_id, value in value_map.items()
+                    }
+                elif kind == "r":
+                    decl7 = f"WV_U32 {name};"
+                    values = {
+                        layer_id: f"offsetof(WV_Runtime, {value})"
+                        for layer_id, value in value_map.items()
+                    }
+                elif kind == "c":
+                    decl7 = f"void (*{name})(WV_Frame *, WV_Runtime *, WV_BurstHint *);"
+                    values = value_map
+                else:
+                    decl7 = f"WV_U64 {name};"
+                    values = value_map
+                param_list.append((decl7, values))
+            name = param_map[key]
+            if kind == "f":
+                replace_map[position - 2] = (
+                    position,
+                    f"(*(typeof(frame->{x}) *)((WV_Byte *)frame + param->{name}))",
+                )
+            elif kind == "r":
+                replace_map[position - 2] = (
+                    position,
+                    f"(*(typeof(runtime->{x}) *)((WV_Byte *)runtime + param->{name}))",
+                )
+            else:
+                replace_map[position] = (position, f"param->{name}")
+
+        body7 = layer_body7_map[rep]
+        shared7 = ""
+        last = 0
+        for start_position, (end_position, expr7) in sorted(replace_map.items()):
+            shared7 += body7[last : tokens[start_position].start()] + expr7
+            last = tokens[end_position].end()
+        shared7 += body7[last:]
+        share_list.append(SharedLayers(layers, param_list, shared7))
+    return share_list
+
+
+# {token position: token of other layer} for the tokens that are different in the code of
+# other layer, together with {("kind", token position): (kind, token)}, or None if the
+# code of other layer could not be shared with the layer
+# kinds are "f" for frame fields, "r" for runtime fields, "c" for called layers (and
+# dispatching functions) and "n" for numbers, other different names must be labels, types
+# and struct fields which are declared in the same way
+def compile7_layer_diff(
+    layer_id, other_id, layer_body7_map, layer_decls7_map, frame_type_map, label_map
+):
+    renaming = c_renaming(layer_decls7_map[layer_id], layer_decls7_map[other_id])
+    if renaming is None:
+        return None
+    renaming[f"l{layer_id}_eq"] = f"l{other_id}_eq"
+    tokens = c_tokens(layer_body7_map[layer_id])
+    other_tokens = c_tokens(layer_body7_map[other_id])
+    if len(tokens) != len(other_tokens):
+        return None
+    diff = {}
+    kind_map = {}  # (kind, token) -> token of other layer
+    for position, (token, other_token) in enumerate(zip(tokens, other_tokens)):
+        x, y = token.group(), other_token.group()
+        prev = [tokens[position - 2].group(), tokens[position - 1].group()]
+        if prev == ["frame", "->"]:
+            kind = "f"
+            # i.e. pointers to header structs of the layers
+            type_renaming = c_renaming(frame_type_map[x], frame_type_map[y])
+            if type_renaming is None or any(
+                renaming.get(name) != other_name
+                for name, other_name in type_renaming.items()
+            ):
+                return None
+        elif prev == ["runtime", "->"]:
+            kind = "r"
+        elif re.fullmatch(r"Layer\d+(Next)?", x) and tokens[position + 1].group() == "(":
+            kind = "c"
+        elif x[0].isdigit():
+            if x == y:
+                continue
+            if not y[0].isdigit() or prev[1] == "case":
+                return None
+            diff[position] = y
+            diff[("kind", position)] = ("n", x)
+            continue
+        else:
+            if x == y:
+                continue
+            if x in label_map[layer_id] and y in label_map[other_id]:
+                continue
+            if renaming.get(x) == y:
+                continue
+            return None
+        if kind_map.setdefault((kind, x), y) != y or c_shape(x) != c_shape(y):
+            return None
+        if x != y:
+            diff[position] = y
+            diff[("kind", position)] = (kind, x)
+    return diff
 
 
 def compile7w_stack(stack):
@@ -272,6 +987,28 @@ WV_U8 WV_Setup() {
     return "\n".join(["#include <weaver.h>", default7, extern_call7])
 
 
+def compile6_layer_func(layer_id):
+    return f"Layer{layer_id}"
+
+
+def compile7_layer_call(layer_id):
+    return f"{compile6_layer_func(layer_id)}(frame, runtime, hint);"
+
+
+# the function that dispatches to the next layers (see compile5_next_call)
+def compile6_next_func(layer_id):
+    return f"{compile6_layer_func(layer_id)}Next"
+
+
+def compile7_next_call(layer_id):
+    return f"{compile6_next_func(layer_id)}(frame, runtime, hint);"
+
+
+# leave the current layer, and return to the one jumped (or called) into it
+def compile7_layer_exit(stack):
+    return "return;" if stack.layer_functions else "goto G_Shower;"
+
+
 def compile6_inst_type(layer_id):
     return f"L{layer_id}I"
 
@@ -300,14 +1037,137 @@ def compile6_content(layer_id):
     return f"l{layer_id}_c"
 
 
-def compile6_need_free(layer_id):
-    return f"l{layer_id}_nf"
+def compile6_wrap(layer_id):
+    return f"w{layer_id}"
+
+
+def compile6_hash(layer_id):
+    return f"l{layer_id}_h"
+
+
+def compile6_peek_key(layer_id):
+    return f"l{layer_id}_k"
+
+
+def compile6_dir(layer_id):
+    return f"l{layer_id}_d"
 
 
 def compile6_prefetch_expr(layer_id):
     return f"l{layer_id}_p"
 
 
+# flow table backends, selected per layer by Prototype.table
+# every table is a value field of runtime, so table6 is an lvalue instead of pointer
+class TommyTable:
+    def __init__(self, kind):
+        self.kind = kind
+
+    @property
+    def type6(self):
+        return f"tommy_{self.kind}"
+
+    def init7(self, table6, capacity):
+        assert capacity is None, "table_capacity is only supported by open_addressing"
+        return f"tommy_{self.kind}_init(&{table6});"
+
+    def insert7(self, table6, node6, data6, hash6):
+        return "\n".join(
+            [
+                f"tommy_{self.kind}_insert(",
+                f"  &{table6}, &{node6}, &{data6},",
+                f"  {hash6}",
+                ");",
+            ]
+        )
+
+    def search6(self, table6, eq6, key6, hash6):
+        return "\n".join(
+            [
+                f"tommy_{self.kind}_search(",
+                f"  &{table6}, {eq6}, &{key6},",
+                f"  {hash6}",
+                ")",
+            ]
+        )
+
+    def remove7(self, table6, eq6, key6, hash6):
+        return "\n".join(
+            [
+                f"tommy_{self.kind}_remove(",
+                f"  &{table6}, {eq6}, &{key6},",
+                f"  {hash6}",
+                ");",
+            ]
+        )
+
+    # address of the bucket that hash6 lives in
+    def slot6(self, table6, hash6):
+        if self.kind == "hashdyn":
+            return f"&{table6}.bucket[{hash6} & {table6}.bucket_mask]"
+        return f"tommy_{self.kind}_bucket_ref(&{table6}, {hash6})"
+
+    # first candidate object of hash6, maybe NULL
+    def bucket6(self, table6, hash6):
+        return f"tommy_{self.kind}_bucket(&{table6}, {hash6})"
+
+
+class OATable:
+    type6 = "WV_OATable"
+
+    def init7(self, table6, capacity):
+        return f"WV_InitOATable(&{table6}, {capacity or 0});"
+
+    def insert7(self, table6, node6, data6, hash6):
+        # no node is required by open addressing
+        return "\n".join(
+            [
+                f"WV_OATableInsert(",
+                f"  &{table6}, &{data6},",
+                f"  {hash6}",
+                ");",
+            ]
+        )
+
+    def search6(self, table6, eq6, key6, hash6):
+        return "\n".join(
+            [
+                f"WV_OATableSearch(",
+                f"  &{table6}, {eq6}, &{key6},",
+                f"  {hash6}",
+                ")",
+            ]
+        )
+
+    def remove7(self, table6, eq6, key6, hash6):
+        return "\n".join(
+            [
+                f"WV_OATableRemove(",
+                f"  &{table6}, {eq6}, &{key6},",
+                f"  {hash6}",
+                ");",
+            ]
+        )
+
+    def slot6(self, table6, hash6):
+        return f"WV_OATableSlotOf(&{table6}, {hash6})"
+
+    def bucket6(self, table6, hash6):
+        return f"WV_OATableBucket(&{table6}, {hash6})"
+
+
+table_backends = {
+    "hashdyn": TommyTable("hashdyn"),
+    "hashlin": TommyTable("hashlin"),
+    "open_addressing": OATable(),
+}
+
+
+def compile6_table(kind):
+    assert kind in table_backends, f"unknown table backend: {kind}"
+    return table_backends[kind]
+
+
 def compile7_decl_inst(inst, context):
     return (
         "typedef struct "
@@ -374,3 +1234,30 @@ def compile7_decl_bi_inst(bi_inst, context):
         )
         + f" {compile6_prefetch_type(context.layer_id)};"
     )
+
+
+# prefetch type is the view of one direction, which is selected by fetching
+def compile7_decl_canonical_bi_inst(bi_inst, context):
+    return (
+        "typedef struct "
+        + indent_join(
+            decl_header_reg(context.stack.reg_map[reg])
+            for reg in bi_inst.key_regs1 + bi_inst.key_regs2 + bi_inst.dual_regs
+        )
+        + f" {compile6_key_type(context.layer_id)};\n"
+        + "typedef struct "
+        + indent_join(["WV_U8 reversed;", "WV_Seq seq;", "WV_Any user_data;"])
+        + f" {compile6_prefetch_type(context.layer_id)};\n"
+        + f"typedef struct {compile6_inst_type(context.layer_id)} "
+        + indent_join(
+            [
+                f"{compile6_key_type(context.layer_id)} k;",
+                "tommy_node node;",
+                "WV_U8 flag;  // direction of the first packet",
+                f"{compile6_prefetch_type(context.layer_id)} view[2];",
+                f"TIMER_INJECT_FIELDS({compile6_inst_type(context.layer_id)})",
+                *[decl_reg(context.stack.reg_map[reg]) for reg in bi_inst.inst_regs],
+            ]
+        )
+        + f" {compile6_inst_type(context.layer_id)};"
+    )
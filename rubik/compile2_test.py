@@ -0,0 +1,36 @@
+import re
+import subprocess
+import sys
+
+
+# {representative layer: set of layers} of the layer functions shared in generated code
+def shared_layers(stack_name):
+    code7 = subprocess.run(
+        [sys.executable, "-m", "rubik", stack_name, "--share-layers"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=True,
+        universal_newlines=True,
+    ).stdout
+    share_map = {}
+    for rep, layer_id in re.findall(r"^static const L(\d+)P l(\d+)_param = ", code7, re.M):
+        share_map.setdefault(int(rep), set()).add(int(layer_id))
+    return share_map
+
+
+def test_share_gtp():
+    # outer and inner IP
+    assert shared_layers("stock.gtp") == {1: {1, 4}}
+
+
+def test_share_pptp():
+    # outer and inner IP, which dispatch to different layers
+    # the TCP layers are not shared, since the control one assembles and reads its data
+    assert shared_layers("stock.pptp") == {1: {1, 6}}
+
+
+TESTCASES = [test_share_gtp, test_share_pptp]
+
+if __name__ == "__main__":
+    for testcase in TESTCASES:
+        testcase()
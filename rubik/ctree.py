@@ -0,0 +1,165 @@
+from abc import ABC, abstractmethod
+
+from rubik.util import indent_join, code_comment
+
+
+# structured C code, which is rendered once it is known to be emitted (and which block it
+# is emitted in), instead of being joined into strings when compiling
+# expressions (CExpr) are built for rubik.prog.Expr, and are rendered into both C code and
+# debug text, i.e. Expr.compile6
+# statements (CNode) are built for instructions, plain strings and instructions
+# (rubik.prog.UpdateReg and Branch) are accepted as statements as well
+
+
+class CExpr(ABC):
+    @abstractmethod
+    def render6(self):
+        ...
+
+    @abstractmethod
+    def debug6(self):
+        ...
+
+
+# registers, constants and other expressions that are written by hand
+class CAtom(CExpr):
+    def __init__(self, code6, debug_code6):
+        self.code6 = code6
+        self.debug_code6 = debug_code6
+
+    def render6(self):
+        return self.code6
+
+    def debug6(self):
+        return self.debug_code6
+
+
+class CConst(CAtom):
+    def __init__(self, value):
+        super().__init__(str(value), f"Const({value})")
+        self.value = value
+
+
+# operands are filled into format, for C code and debug text respectively
+class CFormat(CExpr):
+    def __init__(self, format6, debug_format6, operands):
+        self.format6 = format6
+        self.debug_format6 = debug_format6
+        self.operands = operands
+
+    def render6(self):
+        return self.format6.format(*(operand.render6() for operand in self.operands))
+
+    def debug6(self):
+        return self.debug_format6.format(*(operand.debug6() for operand in self.operands))
+
+
+OP_FORMAT6 = {
+    "add": "WV_SafeAdd32({}, {})",
+    "sub": "({}) - ({})",
+    "left_shift": "({}) << ({})",
+    "less_than": "({}) < ({})",
+    "equal": "({}) == ({})",
+    "and": "({}) && ({})",
+    "or": "({}) || ({})",
+    "slice_before": "WV_SliceBefore({}, {})",
+    "slice_after": "WV_SliceAfter({}, {})",
+    "slice_get": "({}).cursor[{}]",
+    "bit_and": "({}) & ({})",
+    "right_shift": "({}) >> ({})",
+    "slice_length": "({}).length",
+    "not": "!({})",
+}
+
+
+# operators of rubik.lang, which are named as rubik.compile.Eval1Op2 and Eval1Op1
+class COp(CFormat):
+    def __init__(self, name, operands):
+        assert name in OP_FORMAT6, f"unknown op {name}"
+        super().__init__(OP_FORMAT6[name], OP_FORMAT6[name], operands)
+        self.name = name
+
+
+class CNode(ABC):
+    # whether the code refers to the block it is emitted in (see BlockRef)
+    has_block_ref = False
+
+    @abstractmethod
+    def render7(self, block_id=None):
+        ...
+
+
+def render7(code, block_id=None):
+    if isinstance(code, str):
+        return code
+    return code.render7(block_id)
+
+
+def has_block_ref(code):
+    return not isinstance(code, str) and code.has_block_ref
+
+
+# statements on their own lines
+class CLines(CNode):
+    def __init__(self, stats):
+        self.stats = list(stats)
+        self.has_block_ref = any(has_block_ref(stat) for stat in self.stats)
+
+    def render7(self, block_id=None):
+        return "\n".join(render7(stat, block_id) for stat in self.stats)
+
+
+class CComment(CNode):
+    def __init__(self, code, comment):
+        self.code = code
+        self.comment = comment
+        self.has_block_ref = has_block_ref(code)
+
+    def render7(self, block_id=None):
+        return code_comment(render7(self.code, block_id), self.comment)
+
+
+class CAssign(CNode):
+    def __init__(self, target6, debug_target6, expr):
+        self.target6 = target6
+        self.debug_target6 = debug_target6
+        self.expr = expr
+
+    def render7(self, block_id=None):
+        return code_comment(
+            f"{self.target6} = {self.expr.render6()};",
+            f"{self.debug_target6} = {self.expr.debug6()}",
+        )
+
+
+class CIf(CNode):
+    def __init__(self, cond, yes_list, no_list):
+        self.cond = cond
+        self.yes_list = yes_list
+        self.no_list = no_list
+        self.has_block_ref = any(
+            has_block_ref(stat) for stat in [*yes_list, *no_list]
+        )
+
+    def render7(self, block_id=None):
+        return code_comment(
+            f"if ({self.cond.render6()}) "
+            + indent_join(render7(stat, block_id) for stat in self.yes_list)
+            + " else "
+            + indent_join(render7(stat, block_id) for stat in self.no_list),
+            f"IF {self.cond.debug6()}",
+        )
+
+
+# the id of the block that the code is emitted in, which makes labels and variables unique
+# when the instruction is duplicated into several blocks
+# `#` is rendered when the code is not emitted, e.g. for analysis, which is not a part of
+# any register name
+class BlockRef(CNode):
+    has_block_ref = True
+
+    def __init__(self, format7):
+        self.format7 = format7
+
+    def render7(self, block_id=None):
+        return self.format7.format("#" if block_id is None else block_id)
@@ -217,6 +217,12 @@ class Prototype:
         self.header = self.selector = self.temp = self.prep = self.seq = self.psm = None
         self.perm = None
         self.event = EventGroup({}, {}, {})
+        # flow table backend: "hashdyn", "hashlin" or "open_addressing"
+        # and expected count of instances to pre-size it (open_addressing only)
+        self.table = "hashdyn"
+        self.table_capacity = None
+        # insert bidirectional instance once with canonical key instead of twice
+        self.canonical_key = False
 
         self.payload = PayloadExpr()
         self.payload_len = self.payload.length
@@ -279,26 +285,34 @@ class Direction:
         self.dst = dst
 
     def __add__(self, pred):
-        return DirPred(self.src, self.dst, pred.pred, Action([]))
+        return DirPred(self.src, self.dst, pred.pred, Action([]), pred.stateless)
 
 
+# a stateless predicate promises that matched packets belong to no instance, so they are
+# processed with a fresh instance and skip table lookup, even if an instance with the same
+# key exists (e.g. unfragmented IP packets between two hosts that are also exchanging
+# fragments)
 class Predicate:
-    def __init__(self, pred):
+    def __init__(self, pred, stateless=False):
         self.pred = Const.wrap_int(pred)
+        self.stateless = stateless
 
 
 Pred = Predicate
 
 
 class DirPred:
-    def __init__(self, src, dst, pred, action):
+    def __init__(self, src, dst, pred, action, stateless=False):
         self.src = src
         self.dst = dst
         self.pred = pred
         self.action = action
+        self.stateless = stateless
 
     def __add__(self, stat):
-        return DirPred(self.src, self.dst, self.pred, self.action + stat)
+        return DirPred(
+            self.src, self.dst, self.pred, self.action + stat, self.stateless
+        )
 
 
 # layout interface
@@ -377,7 +391,14 @@ class UInt(VariableOpMixin):
 # dedicated pipeline interfaces
 class Sequence:
     def __init__(
-        self, meta, data, zero_based=True, data_len=None, window=None,
+        self,
+        meta,
+        data,
+        zero_based=True,
+        data_len=None,
+        window=None,
+        buffer_size=None,
+        node_count=None,
     ):
         self.offset = meta
         self.data = data
@@ -387,6 +408,16 @@ class Sequence:
             self.window_left = self.window_right = Const(0)
         else:
             self.window_left, self.window_right = window
+        # most bytes of out-of-order data buffered for an instance, must be power of 2
+        # buffer is allocated on demand, and grows up to this size
+        # None for WV_CONFIG_SeqBufferSize (8KB)
+        assert buffer_size is None or buffer_size & (buffer_size - 1) == 0
+        self.buffer_size = buffer_size
+        # most separated parts of data kept at the same time, i.e. holes + 1, more parts
+        # are dropped and trigger buffer exceeding
+        # None for WV_CONFIG_SeqNodeCount (32)
+        assert node_count is None or 0 < node_count < 0xFFFF
+        self.node_count = node_count
 
 
 class PSMState:
@@ -437,7 +468,13 @@ class PSM(NameMapMixin):
         return self.state_list
 
     def handle_set(self, dir_pred):
-        trans = PSMTrans(dir_pred.pred, dir_pred.dst.state_id, dir_pred.action)
+        if dir_pred.stateless:
+            # the fresh instance must be destroyed after the packet, or it would have to be
+            # inserted into the table anyway
+            assert dir_pred.src.start and dir_pred.dst.start and dir_pred.dst.accept
+        trans = PSMTrans(
+            dir_pred.pred, dir_pred.dst.state_id, dir_pred.action, dir_pred.stateless
+        )
         self.trans_list.append(trans)
         trans_id = len(self.trans_list)  # count from 1, 0 means not triggered yet
         self.state_map[dir_pred.src.state_id].append(trans_id)
@@ -450,43 +487,136 @@ class PSM(NameMapMixin):
         return Action(
             [
                 Assign(self.trans_var, 0),
-                *[
-                    If(self.trans_var == 0)
-                    >> (
-                        If(state == state_id)
-                        >> self.compile0_trans_list(trans_list, state)
-                    )
-                    for state_id, trans_list in self.state_map.items()
-                ],
+                self.compile0_dispatch(
+                    {
+                        state_id: [
+                            (trans_id, self.trans_list[trans_id - 1].pred)
+                            for trans_id in trans_list
+                        ]
+                        for state_id, trans_list in self.state_map.items()
+                        if trans_list
+                    },
+                    state,
+                ),
             ]
         )
 
-    def compile0_trans_list(self, trans_list, state):
+    # only one state is checked for each packet, so a test shared by transitions of
+    # different states is not hoisted above the dispatch, which would only duplicate the
+    # transitions that come before it
+    def compile0_dispatch(self, pred_map, state):
         action = Action([])
-        for trans_id in trans_list:
+        for state_id, pred_list in reversed(list(pred_map.items())):
+            action = IfElse(
+                state == state_id, self.compile0_trans_list(pred_list, state), action
+            )
+        return action
+
+    # transitions are tried in order, and the first one whose pred holds is taken
+    def compile0_trans_list(self, pred_list, state):
+        split = PSM.compile0_split_var(
+            [compile0_atoms(pred) for trans_id, pred in pred_list]
+        )
+        if split is not None:
+            return IfElse(
+                split[0] == split[1],
+                self.compile0_trans_list(
+                    PSM.compile0_assume_list(pred_list, *split, True), state
+                ),
+                self.compile0_trans_list(
+                    PSM.compile0_assume_list(pred_list, *split, False), state
+                ),
+            )
+        action = Action([])
+        for trans_id, pred in reversed(pred_list):
             trans = self.trans_list[trans_id - 1]
-            action += If(self.trans_var == 0) >> (
-                If(trans.pred)
-                >> (
-                    Assign(self.trans_var, trans_id)
-                    + Assign(state, trans.dst_state)
-                    + trans.action
-                )
+            trans_action = (
+                Assign(self.trans_var, trans_id)
+                + Assign(state, trans.dst_state)
+                + trans.action
             )
+            if isinstance(pred, Const):
+                action = trans_action
+            else:
+                action = IfElse(pred, trans_action, action)
         return action
 
+    # (var, value) for the variable tested in most of the groups, if it is tested in
+    # more than one of them
+    @staticmethod
+    def compile0_split_var(group_list):
+        # Bit is not hashable, see Bit.var_id
+        count_map = {}
+        for group in group_list:
+            for var_id, (var, value) in {
+                var.var_id: (var, value) for var, value in reversed(group)
+            }.items():
+                count, first_var, first_value = count_map.get(var_id, (0, var, value))
+                count_map[var_id] = (count + 1, first_var, first_value)
+        best = None
+        for count, var, value in count_map.values():
+            if count > 1 and (best is None or count > best[0]):
+                best = (count, var, value)
+        return best[1:] if best is not None else None
+
+    @staticmethod
+    def compile0_assume_list(pred_list, var, value, equal):
+        assumed_list = []
+        for trans_id, pred in pred_list:
+            pred = compile0_assume(pred, var, value, equal)
+            if isinstance(pred, Const) and not pred.value:
+                continue
+            assumed_list.append((trans_id, pred))
+            if isinstance(pred, Const):
+                break  # always taken, so the rest is unreachable
+        return assumed_list
+
     def compile0_accept_pred(self, state):
         pred = Const(0)
         for state_id in self.accept_list:
             pred = (state == state_id) | pred
         return pred
 
+    def compile0_stateless_pred(self):
+        # transitions are tried in order, so a stateless one is only taken when the
+        # transitions before it are not
+        pred = None
+        earlier_pred = None
+        for trans_id in self.state_map.get(0, []):
+            trans = self.trans_list[trans_id - 1]
+            if trans.stateless:
+                trans_pred = trans.pred
+                if earlier_pred is not None:
+                    trans_pred = LogicalAndOp(trans_pred, NotOp(earlier_pred))
+                pred = trans_pred if pred is None else LogicalOrOp(pred, trans_pred)
+            earlier_pred = (
+                trans.pred
+                if earlier_pred is None
+                else LogicalOrOp(earlier_pred, trans.pred)
+            )
+        return pred
+
 
 class PSMTrans:
-    def __init__(self, pred, dst_state, action):
+    def __init__(self, pred, dst_state, action, stateless=False):
         self.pred = pred
         self.dst_state = dst_state
         self.action = action
+        self.stateless = stateless
+
+
+# [(var, value)] for the `var == value` tests that pred is a conjunction of
+def compile0_atoms(pred):
+    return getattr(pred, "compile0_atoms", lambda: [])()
+
+
+# pred simplified under `var == value` (or `var != value` if not equal)
+# virtual preds are kept as they are, since they are looked up by identity in
+# rubik.compile.LayerContext.vexpr_map
+def compile0_assume(pred, var, value, equal):
+    if pred.virtual:
+        return pred
+    return getattr(pred, "compile0_assume", lambda *_: pred)(var, value, equal)
 
 
 class EventGroup(NameMapMixin):
@@ -769,6 +899,20 @@ class LogicalOrOp(NumberOpMixin, Op2VirtualMixin):
     def compile4(self, context):
         return compile4_op2("or", self.expr1, self.expr2, context)
 
+    def compile0_or_terms(self):
+        return [
+            *getattr(self.expr1, "compile0_or_terms", lambda: [self.expr1])(),
+            *getattr(self.expr2, "compile0_or_terms", lambda: [self.expr2])(),
+        ]
+
+    def compile0_assume(self, var, value, equal):
+        expr1 = compile0_assume(self.expr1, var, value, equal)
+        expr2 = compile0_assume(self.expr2, var, value, equal)
+        for const, other in [(expr1, expr2), (expr2, expr1)]:
+            if isinstance(const, Const):
+                return const if const.value else other
+        return LogicalOrOp(expr1, expr2)
+
 
 class SubOp(NumberOpMixin, Op2VirtualMixin):
     def __init__(self, expr1, expr2):
@@ -830,6 +974,25 @@ class LogicalAndOp(NumberOpMixin, Op2VirtualMixin):
     def compile4(self, context):
         return compile4_op2("and", self.expr1, self.expr2, context)
 
+    # (common, var, value) for `common & (var == value)`, see VarEqualOp
+    def compile0_split_equal(self):
+        for common, equal in [(self.expr1, self.expr2), (self.expr2, self.expr1)]:
+            split = getattr(equal, "compile0_split_equal", lambda: None)()
+            if split is not None and split[0] is None:
+                return common, split[1], split[2]
+        return None
+
+    def compile0_atoms(self):
+        return [*compile0_atoms(self.expr1), *compile0_atoms(self.expr2)]
+
+    def compile0_assume(self, var, value, equal):
+        expr1 = compile0_assume(self.expr1, var, value, equal)
+        expr2 = compile0_assume(self.expr2, var, value, equal)
+        for const, other in [(expr1, expr2), (expr2, expr1)]:
+            if isinstance(const, Const):
+                return other if const.value else const
+        return LogicalAndOp(expr1, expr2)
+
 
 class SliceBeforeOp(SliceOpMixin, Op2VirtualMixin):
     def __init__(self, slice, index):
@@ -890,6 +1053,12 @@ class NotOp(NumberOpMixin):
     def compile4(self, context):
         return compile4_op1("not", self.expr, context)
 
+    def compile0_assume(self, var, value, equal):
+        expr = compile0_assume(self.expr, var, value, equal)
+        if isinstance(expr, Const):
+            return Const(int(not expr.value))
+        return NotOp(expr)
+
 
 class PayloadExpr(SliceOpMixin):
     def __init__(self):
@@ -936,6 +1105,30 @@ class VarEqualOp(NumberOpMixin):
     def compile4(self, context):
         return compile4_var_equal(self.var, self.expr, context)
 
+    # edges of layers are grouped by the variable they test against constants, and
+    # compiled into switch (see compile5_next_list)
+    def compile0_split_equal(self):
+        if isinstance(self.expr, Const):
+            return None, self.var, self.expr.value
+        return None
+
+    def compile0_atoms(self):
+        if isinstance(self.expr, Const):
+            return [(self.var, self.expr.value)]
+        return []
+
+    def compile0_assume(self, var, value, equal):
+        if self.var is not var or not isinstance(self.expr, Const):
+            return self
+        if equal:
+            return Const(int(self.expr.value == value))
+        if self.expr.value == value:
+            return Const(0)
+        # the other value of a single bit
+        if not var.is_uint and var.length == 1:
+            return Const(int(self.expr.value == 1 - value))
+        return self
+
 
 class RightShiftOp(NumberOpMixin, Op2VirtualMixin):
     def __init__(self, expr1, expr2):
@@ -2,16 +2,39 @@ from __future__ import annotations
 
 # pylint: disable = unused-wildcard-import
 from typing import *
+from weakref import WeakValueDictionary
 from rubik.compile2 import compile7_branch
+from rubik.ctree import CExpr, render7, has_block_ref
+
+
+# register sets are also kept as bitmasks, for the dataflow analyses of Block
+# register ids are dense integers (see rubik.compile.StackContext), so the masks are short
+def reg_mask(regs):
+    mask = 0
+    for reg in regs:
+        mask |= 1 << reg
+    return mask
 
 
 class Expr:
-    def __init__(self, read_regs, eval1_handler, compile6, eval3_handler=None):
+    def __init__(self, read_regs, eval1_handler, code6, eval3_handler=None):
         assert isinstance(read_regs, set)
+        assert code6 is None or isinstance(code6, CExpr)
         self.read_regs = read_regs
+        self.read_mask = reg_mask(read_regs)
         self.eval1_handler = eval1_handler
-        self.compile6 = compile6
+        # rubik.ctree expression, or None for the expressions that are never rendered
+        self.code6 = code6
         self.eval3_handler = eval3_handler
+        self._compile6 = None
+
+    # (C code, debug text), which is rendered (once) when needed
+    @property
+    def compile6(self):
+        if self._compile6 is None:
+            assert self.code6 is not None, "abstract expression is rendered"
+            self._compile6 = (self.code6.render6(), self.code6.debug6())
+        return self._compile6
 
     def eval1(self, context):
         return self.eval1_handler.eval1(context)
@@ -26,15 +49,44 @@ class NotConstant(Exception):
 
 
 class UpdateReg:
-    def __init__(self, reg, expr, is_command, compile7, opt_handler=None):
+    def __init__(
+        self,
+        reg,
+        expr,
+        is_command,
+        compile7,
+        opt_handler=None,
+        peek_handler=None,
+        is_lazy=False,
+    ):
         self.reg = reg
         self.expr = expr
         self.read_regs = expr.read_regs
         self.write_regs = {reg}
+        self.read_mask = expr.read_mask
+        self.write_mask = 1 << reg
         self.is_command = is_command
-        self.compile7 = compile7
+        # string or rubik.ctree node, which is rendered (once) when needed
+        self.code7 = compile7
+        self.has_block_ref = has_block_ref(compile7)
+        self._compile7 = None
         self.is_choice = False
         self.opt_handler = opt_handler
+        self.peek_handler = peek_handler
+        # lazy instruction is pure, and is worth nothing until its result is read
+        self.is_lazy = is_lazy
+
+    # the code without the block it is emitted in, e.g. for analysis
+    @property
+    def compile7(self):
+        if self._compile7 is None:
+            self._compile7 = render7(self.code7)
+        return self._compile7
+
+    def render7(self, block_id=None):
+        if self.has_block_ref:
+            return render7(self.code7, block_id)
+        return self.compile7
 
     def eval2(self, context):
         if not self.is_command:
@@ -55,11 +107,19 @@ class Branch:
         self.no_list = no_list
         self.read_regs = set(pred.read_regs)
         self.write_regs = set()
+        self.read_mask = pred.read_mask
+        self.write_mask = 0
         for instr in yes_list + no_list:
             self.read_regs |= instr.read_regs
             self.write_regs |= instr.write_regs
+            self.read_mask |= instr.read_mask
+            self.write_mask |= instr.write_mask
         self.is_command = False
         self.is_choice = is_choice
+        self.has_block_ref = any(
+            instr.has_block_ref for instr in yes_list + no_list
+        )
+        self._compile7 = None
 
     def eval2(self, context):
         try:
@@ -74,7 +134,14 @@ class Branch:
 
     @property
     def compile7(self):
-        return compile7_branch(self)
+        if self._compile7 is None:
+            self._compile7 = compile7_branch(self).render7()
+        return self._compile7
+
+    def render7(self, block_id=None):
+        if self.has_block_ref:
+            return compile7_branch(self).render7(block_id)
+        return self.compile7
 
     def opt(self, context):
         pass
@@ -86,100 +153,142 @@ Env = Dict[Reg, Any]
 
 class Block:
     count = 0
-
-    def __init__(self, instr_list, pred, yes_block, no_block):
-        self.instr_list = instr_list
-        self.pred = pred
-        self.yes_block = yes_block
-        self.no_block = no_block
-
-        self.block_id = Block.count
+    # blocks are hash-consed: constructing a block with the same instructions, condition
+    # and successors (by identity) as an existing one returns the existing block
+    # so the common suffix of both sides of a split is kept once, the "tree" of blocks is
+    # actually a DAG, and the transformations below handle every distinct block once
+    # blocks must never be modified after construction
+    table: MutableMapping[Tuple[int, ...], Block] = WeakValueDictionary()
+
+    def __new__(cls, instr_list, pred, yes_block, no_block):
+        # the block keeps all the objects alive, so their ids are not reused before the
+        # entry is dropped
+        key = (id(pred), id(yes_block), id(no_block), *map(id, instr_list))
+        block = Block.table.get(key)
+        if block is not None:
+            return block
+        block = super().__new__(cls)
+        block.instr_list = list(instr_list)
+        block.pred = pred
+        block.yes_block = yes_block
+        block.no_block = no_block
+        block._read_regs = None
+
+        block.block_id = Block.count
         Block.count += 1
+        Block.table[key] = block
+        return block
+
+    # unpickled blocks are hash-consed as well, and shared blocks stay shared since pickle
+    # memoizes the objects
+    def __reduce__(self):
+        return Block, (self.instr_list, self.pred, self.yes_block, self.no_block)
 
+    # every distinct block reachable from this one, starting from itself
     def recursive(self):
-        yield self
-        if self.pred is not None:
-            yield from self.yes_block.recursive()
-            yield from self.no_block.recursive()
+        visited = set()
+        pending = [self]
+        while pending:
+            block = pending.pop()
+            if block in visited:
+                continue
+            visited.add(block)
+            yield block
+            if block.pred is not None:
+                pending += [block.no_block, block.yes_block]
+
+    # dependency DAG of the instructions, i.e. for every instruction the bitmask of the
+    # positions of the instructions it depends on, together with the bitmask of the ones
+    # that the registers in `cond_mask` depend on
+    # block ids depend on how many blocks have been created before, e.g. by the other
+    # layers or in the other processes, so the final blocks are numbered again in the
+    # order they are visited, which makes the generated code deterministic
+    @staticmethod
+    def renumber(entries: Iterable[Block]) -> None:
+        block_count = 0
+        visited: Set[Block] = set()
+        for entry in entries:
+            for block in entry.recursive():
+                if block in visited:
+                    continue
+                visited.add(block)
+                block.block_id = block_count
+                block_count += 1
+        Block.count = max(Block.count, block_count)
 
     @staticmethod
     def build_dep_graph(
-        codes: List[UpdateReg], cond: Expr = None
-    ) -> Dict[Union[UpdateReg, Expr], Set[UpdateReg]]:
-        dep_graph: Dict[Union[UpdateReg, Expr], Set[UpdateReg]] = {}
+        codes: List[UpdateReg], cond_mask: int = 0
+    ) -> Tuple[List[int], int]:
+        dep_graph = [0] * len(codes)
         # all instructions that (possibly) processes the last writing to a register,
         # and all instructions that read the register after the last writing
-        reg_graph: Dict[Reg, Tuple[List[UpdateReg], List[UpdateReg]]] = {}
-        for instr in cast(List[UpdateReg], codes):
-            dep_graph[instr] = set()
+        all_write: Dict[Reg, int] = {}
+        all_read: Dict[Reg, int] = {}
+        for i, instr in enumerate(codes):
+            # the writing must be after all the readings which expect the old value
+            # the writing also must be after the previous writing to prevent to store wrong value eventually
             for write_reg in instr.write_regs:
-                # the writing must be after all the readings which expect the old value
-                # the writing also must be after the previous writing to prevent to store wrong value eventually
-                if write_reg in reg_graph:
-                    all_write, all_read = reg_graph[write_reg]
-                    dep_graph[instr].update(all_write)
-                    dep_graph[instr].update(all_read)
+                dep_graph[i] |= all_write.get(write_reg, 0) | all_read.get(write_reg, 0)
             # the reading must be after any writing
             for read_reg in instr.read_regs:
-                if read_reg in reg_graph and reg_graph[read_reg][0] is not None:
-                    dep_graph[instr].update(reg_graph[read_reg][0])
+                dep_graph[i] |= all_write.get(read_reg, 0)
 
             # update register graph with current instruction
             # the readings are appended
             for read_reg in instr.read_regs:
-                if read_reg not in reg_graph:
-                    reg_graph[read_reg] = [], []
-                reg_graph[read_reg][1].append(instr)
+                all_read[read_reg] = all_read.get(read_reg, 0) | 1 << i
             for write_reg in instr.write_regs:
                 if isinstance(instr, Branch):
                     # if the writing happens, the instruction becomes the one performs the last writing
                     # otherwise `write_reg` is untouched
-                    if write_reg not in reg_graph:
-                        reg_graph[write_reg] = [], []
-                    reg_graph[write_reg][0].append(instr)
+                    all_write[write_reg] = all_write.get(write_reg, 0) | 1 << i
                 else:
                     # the writing clears all reading if exist
-                    reg_graph[write_reg] = [instr], []
+                    all_write[write_reg] = 1 << i
+                    all_read[write_reg] = 0
 
-        if cond is not None:
-            dep_graph[cond] = set()
-            for read_reg in cond.read_regs:
-                if read_reg in reg_graph and reg_graph[read_reg][0] is not None:
-                    dep_graph[cond].update(reg_graph[read_reg][0])
-        return dep_graph
+        cond_dep = 0
+        for write_reg, write_mask in all_write.items():
+            if cond_mask >> write_reg & 1:
+                cond_dep |= write_mask
+        return dep_graph, cond_dep
 
     @staticmethod
     def scan_codes(
-        codes: List[UpdateReg], agg_choice: Expr = None
+        codes: List[UpdateReg], agg_choice: int = 0
     ) -> Tuple[List[UpdateReg], bool]:
+        # `agg_choice` is the bitmask of registers read by later choices
         choice = False
-        agg_choice = agg_choice or Expr(set(), None, None)
-        dep_graph = Block.build_dep_graph(codes, agg_choice)
+        dep_graph, choice_instr = Block.build_dep_graph(codes, agg_choice)
         scanned: List[Optional[UpdateReg]] = [None] * len(codes)
-        choice_instr = {instr: instr in dep_graph[agg_choice] for instr in codes}
         for i in (j - 1 for j in range(len(codes), 0, -1)):
             instr = codes[i]
             if instr.is_command:
                 choice = True
-                agg_choice = Expr(agg_choice.read_regs | instr.read_regs, None, None)
+                agg_choice |= instr.read_mask
             if isinstance(instr, Branch):
                 scanned_yes, choice_yes = Block.scan_codes(instr.yes_list, agg_choice)
                 scanned_no, choice_no = Block.scan_codes(instr.no_list, agg_choice)
                 if choice_yes or choice_no:
                     choice = True
-                    agg_choice = Expr(
-                        agg_choice.read_regs | instr.read_regs, None, None
-                    )
-                if choice_yes or choice_no or choice_instr[instr]:
-                    for dep_instr in dep_graph[instr]:
-                        choice_instr[dep_instr] = True
-                    scanned[i] = Branch(instr.pred, scanned_yes, scanned_no, True)
+                    agg_choice |= instr.read_mask
+                if choice_yes or choice_no or choice_instr >> i & 1:
+                    choice_instr |= dep_graph[i]
+                    if (
+                        instr.is_choice
+                        and scanned_yes == instr.yes_list
+                        and scanned_no == instr.no_list
+                    ):
+                        # keep the instruction, so the blocks containing it are shared
+                        scanned[i] = instr
+                    else:
+                        scanned[i] = Branch(instr.pred, scanned_yes, scanned_no, True)
                 else:
                     scanned[i] = instr
             else:
-                if choice_instr[instr]:
-                    for dep_instr in dep_graph[instr]:
-                        choice_instr[dep_instr] = True
+                if choice_instr >> i & 1:
+                    choice_instr |= dep_graph[i]
                 scanned[i] = instr
         assert all(instr is not None for instr in scanned)
         return cast(List[UpdateReg], scanned), choice
@@ -192,29 +301,57 @@ class Block:
         scanned, _ = Block.scan_codes(codes)
         return Block(scanned, None, None, None)
 
-    def eval_reduce(self, consts: Env = None) -> Block:
+    # every register that is read by the block or its successors
+    @property
+    def read_regs(self) -> Set[Reg]:
+        if self._read_regs is None:
+            read_regs: Set[Reg] = set()
+            for instr in self.instr_list:
+                read_regs |= instr.read_regs
+            if self.pred is not None:
+                read_regs |= self.pred.read_regs
+                read_regs |= self.yes_block.read_regs
+                read_regs |= self.no_block.read_regs
+            self._read_regs = read_regs
+        return self._read_regs
+
+    def eval_reduce(self, consts: Env = None, memo: Dict[Any, Block] = None) -> Block:
         consts = cast(Env, consts or {})
-        affected_consts = dict(consts)
-        for i, instr in enumerate(self.instr_list):
+        memo = memo if memo is not None else {}
+        # the result only depends on the constants that are read, so a block that is shared
+        # by several paths is reduced once, unless the paths disagree on these constants
+        try:
+            key = (
+                self,
+                frozenset(
+                    (reg, value) for reg, value in consts.items() if reg in self.read_regs
+                ),
+            )
+        except TypeError:
+            return self.eval_reduce1(dict(consts), memo)
+        if key not in memo:
+            memo[key] = self.eval_reduce1(dict(consts), memo)
+        return memo[key]
+
+    # the instructions are evaluated once: a constant branch is replaced by its taken side
+    # in place, and on a choice branch the evaluated prefix stays in this block, while the
+    # successors continue from the constants after it
+    def eval_reduce1(self, affected_consts: Env, memo: Dict[Any, Block]) -> Block:
+        codes = list(self.instr_list)
+        i = 0
+        while i < len(codes):
+            instr = codes[i]
             if isinstance(instr, Branch):
-                prev_codes = self.instr_list[:i]
-                after_codes = self.instr_list[i + 1 :]
                 try:
                     choice_cond = instr.pred.eval1(affected_consts)
                 except NotConstant:
                     choice_cond = None
                 if choice_cond is not None:
-                    if choice_cond:
-                        codes = prev_codes + instr.yes_list + after_codes
-                    else:
-                        codes = prev_codes + instr.no_list + after_codes
-                    return Block(
-                        codes, self.pred, self.yes_block, self.no_block
-                    ).eval_reduce(consts)
+                    codes[i : i + 1] = instr.yes_list if choice_cond else instr.no_list
+                    continue
                 elif instr.is_choice:
                     # beg for this not too heavy
-                    codes = prev_codes
-                    cond = instr.pred
+                    after_codes = codes[i + 1 :]
                     yes_block = Block(
                         instr.yes_list + after_codes,
                         self.pred,
@@ -227,10 +364,13 @@ class Block:
                         self.yes_block,
                         self.no_block,
                     )
-                    return Block(codes, cond, yes_block, no_block).eval_reduce(consts)
+                    return Block(codes[:i], instr.pred, yes_block, no_block).reduce_succ(
+                        affected_consts, memo
+                    )
             instr.eval2(affected_consts)
+            i += 1
         if self.pred is None:
-            return self
+            return Block(codes, None, None, None)
         assert self.yes_block is not None and self.no_block is not None
         try:
             cond_value = self.pred.eval1(affected_consts)
@@ -238,23 +378,27 @@ class Block:
             cond_value = None
         if cond_value is not None:
             if cond_value:
-                selected_block = self.no_block.eval_reduce(affected_consts)
+                selected_block = self.yes_block.eval_reduce(affected_consts, memo)
             else:
-                selected_block = self.yes_block.eval_reduce(affected_consts)
+                selected_block = self.no_block.eval_reduce(affected_consts, memo)
             return Block(
-                self.instr_list + selected_block.instr_list,
+                codes + selected_block.instr_list,
                 selected_block.pred,
                 selected_block.yes_block,
                 selected_block.no_block,
             )
-        else:
-            yes_consts = dict(affected_consts)
-            self.pred.eval3(yes_consts)
-            yes_block = self.yes_block.eval_reduce(yes_consts)
-            no_block = self.no_block.eval_reduce(affected_consts)
-            if yes_block is self.yes_block and no_block is self.no_block:
-                return self
-            return Block(self.instr_list, self.pred, yes_block, no_block)
+        return Block(codes, self.pred, self.yes_block, self.no_block).reduce_succ(
+            affected_consts, memo
+        )
+
+    # reduce the successors of the block whose condition is not constant, with the
+    # constants after evaluating its instructions
+    def reduce_succ(self, affected_consts: Env, memo: Dict[Any, Block]) -> Block:
+        yes_consts = dict(affected_consts)
+        self.pred.eval3(yes_consts)
+        yes_block = self.yes_block.eval_reduce(yes_consts, memo)
+        no_block = self.no_block.eval_reduce(affected_consts, memo)
+        return Block(self.instr_list, self.pred, yes_block, no_block)
 
     def __str__(self):
         label_line = f"L{self.block_id}:\n"
@@ -268,22 +412,21 @@ class Block:
         return label_line + "\n".join(code_lines)
 
     def recurse(self) -> Generator[Block, None, None]:
-        yield self
-        if self.pred is not None:
-            assert self.yes_block is not None and self.no_block is not None
-            yield from self.yes_block.recurse()
-            yield from self.no_block.recurse()
+        return self.recursive()
 
-    def proc_exit(self, proc) -> Block:
-        if self.pred is None:
-            return Block.from_codes(proc(self.instr_list))
-        else:
-            return Block(
-                self.instr_list,
-                self.pred,
-                self.yes_block.proc_exit(proc),
-                self.no_block.proc_exit(proc),
-            )
+    def proc_exit(self, proc, memo: Dict[Block, Block] = None) -> Block:
+        memo = memo if memo is not None else {}
+        if self not in memo:
+            if self.pred is None:
+                memo[self] = Block.from_codes(proc(self.instr_list))
+            else:
+                memo[self] = Block(
+                    self.instr_list,
+                    self.pred,
+                    self.yes_block.proc_exit(proc, memo),
+                    self.no_block.proc_exit(proc, memo),
+                )
+        return memo[self]
 
     class IfDep(Exception):
         def __init__(self, i, instr):
@@ -294,33 +437,32 @@ class Block:
     def build_fixed(self) -> List[bool]:
         fixed = [False] * len(self.instr_list)
         assert self.pred is not None
-        read_regs = set(self.pred.read_regs)
-        write_regs: Set[Reg] = set()
-        command_write: Set[Reg] = set()
+        read_mask = self.pred.read_mask
+        write_mask = 0
+        command_write = 0
         for i in (j - 1 for j in range(len(self.instr_list), 0, -1)):
             instr = self.instr_list[i]
-            instr_read = set(instr.read_regs)
-            instr_write = set(instr.write_regs)
             if (
-                instr_write & read_regs
-                or instr_read & write_regs
-                or instr_write & write_regs
+                instr.write_mask & read_mask
+                or instr.read_mask & write_mask
+                or instr.write_mask & write_mask
             ):
-                if not instr_read & command_write and isinstance(instr, Branch):
+                if not instr.read_mask & command_write and isinstance(instr, Branch):
                     raise Block.IfDep(i, instr)
                 fixed[i] = True
-                read_regs.update(instr.read_regs)
-                write_regs.update(instr.write_regs)
-                # if isinstance(instr, UpdateReg):
-                #     read_regs.discard(instr.reg)
+                read_mask |= instr.read_mask
+                write_mask |= instr.write_mask
                 if instr.is_command:
-                    command_write.update(instr.write_regs)
-            # else:
-            #     if isinstance(instr, UpdateReg):
-            #         write_regs.discard(instr.reg)
+                    command_write |= instr.write_mask
         return fixed
 
-    def relocate_cond(self) -> Block:
+    def relocate_cond(self, memo: Dict[Block, Block] = None) -> Block:
+        memo = memo if memo is not None else {}
+        if self not in memo:
+            memo[self] = self.relocate_cond1(memo)
+        return memo[self]
+
+    def relocate_cond1(self, memo: Dict[Block, Block]) -> Block:
         if self.pred is None:
             return self
         assert self.yes_block is not None and self.no_block is not None
@@ -341,7 +483,7 @@ class Block:
             no_block = Block(
                 instr.no_list + rest_codes, self.pred, self.yes_block, self.no_block
             )
-            return Block(codes, cond, yes_block, no_block).relocate_cond()
+            return Block(codes, cond, yes_block, no_block).relocate_cond(memo)
 
         # except Block.IfDep:
         #     # after preprocess in scan_codes, there should be no dependent Branch exists
@@ -357,27 +499,150 @@ class Block:
                 self.yes_block.pred,
                 self.yes_block.yes_block,
                 self.yes_block.no_block,
-            ).relocate_cond()
+            ).relocate_cond(memo)
             no_block = Block(
                 shifted_codes + self.no_block.instr_list,
                 self.no_block.pred,
                 self.no_block.yes_block,
                 self.no_block.no_block,
-            ).relocate_cond()
+            ).relocate_cond(memo)
         else:
-            yes_block = self.yes_block.relocate_cond()
-            no_block = self.no_block.relocate_cond()
+            yes_block = self.yes_block.relocate_cond(memo)
+            no_block = self.no_block.relocate_cond(memo)
         if yes_block is self.yes_block and no_block is self.no_block:
             return self
         return Block(fixed_codes, self.pred, yes_block, no_block)
 
+    def sink_lazy(
+        self,
+        live_regs: Set[Reg],
+        pending: List[UpdateReg] = None,
+        memo: Dict[Any, Block] = None,
+    ) -> Block:
+        # dead-value analysis for lazy instructions: they are postponed right before the first
+        # instruction (or condition) reading their results, or overwriting their operands, and
+        # dropped from paths that never read them
+        # registers in `live_regs` are read out of this block, so they are never postponed
+        pending = list(pending or [])
+        memo = memo if memo is not None else {}
+        key = (self, tuple(pending))
+        if key in memo:
+            return memo[key]
+        instr_list: List[Any] = []
+
+        def flush(regs: Set[Reg]) -> None:
+            nonlocal pending
+            needed: Set[Reg] = set()
+            for instr in reversed(pending):
+                if instr.reg in regs or instr.reg in needed:
+                    needed.add(instr.reg)
+                    needed.update(instr.read_regs)
+            instr_list.extend(instr for instr in pending if instr.reg in needed)
+            pending = [instr for instr in pending if instr.reg not in needed]
+
+        for instr in self.instr_list:
+            if getattr(instr, "is_lazy", False) and instr.reg not in live_regs:
+                flush(instr.read_regs)
+                pending = [
+                    pending_instr
+                    for pending_instr in pending
+                    if pending_instr.reg != instr.reg
+                ]
+                pending.append(instr)
+                continue
+            flush(instr.read_regs)
+            flush(
+                {
+                    pending_instr.reg
+                    for pending_instr in pending
+                    if pending_instr.read_regs & instr.write_regs
+                }
+            )
+            pending = [
+                pending_instr
+                for pending_instr in pending
+                if pending_instr.reg not in instr.write_regs
+            ]
+            instr_list.append(instr)
+        if self.pred is None:
+            memo[key] = Block(instr_list, None, None, None)
+            return memo[key]
+        assert self.yes_block is not None and self.no_block is not None
+        flush(self.pred.read_regs)
+        memo[key] = Block(
+            instr_list,
+            self.pred,
+            self.yes_block.sink_lazy(live_regs, pending, memo),
+            self.no_block.sink_lazy(live_regs, pending, memo),
+        )
+        return memo[key]
+
+    def instructions(self) -> Generator[Any, None, None]:
+        # every instruction in the block tree, including the ones in nested branches
+        def walk(instr_list):
+            for instr in instr_list:
+                yield instr
+                if isinstance(instr, Branch):
+                    yield from walk(instr.yes_list)
+                    yield from walk(instr.no_list)
+
+        for block in self.recurse():
+            yield from walk(block.instr_list)
+
+    def remove_dead(
+        self,
+        dead_regs: Set[Reg],
+        removed: List[UpdateReg],
+        memo: Dict[Block, Block] = None,
+    ) -> Block:
+        # drop assignments (not commands) to dead registers, which are appended to `removed`
+        # once for every distinct block
+        memo = memo if memo is not None else {}
+        if self in memo:
+            return memo[self]
+        def filter_list(instr_list):
+            filtered = []
+            for instr in instr_list:
+                if isinstance(instr, Branch):
+                    filtered.append(
+                        Branch(
+                            instr.pred,
+                            filter_list(instr.yes_list),
+                            filter_list(instr.no_list),
+                            instr.is_choice,
+                        )
+                    )
+                elif not instr.is_command and instr.reg in dead_regs:
+                    removed.append(instr)
+                else:
+                    filtered.append(instr)
+            return filtered
+
+        if self.pred is None:
+            memo[self] = Block(filter_list(self.instr_list), None, None, None)
+            return memo[self]
+        assert self.yes_block is not None and self.no_block is not None
+        memo[self] = Block(
+            filter_list(self.instr_list),
+            self.pred,
+            self.yes_block.remove_dead(dead_regs, removed, memo),
+            self.no_block.remove_dead(dead_regs, removed, memo),
+        )
+        return memo[self]
+
     def optimize(self, proc=None) -> Block:
+        # blocks are immutable, so the results of every pass are kept across the
+        # iterations, and the blocks that are not changed by the last iteration are not
+        # analyzed again
+        reduce_memo: Dict[Any, Block] = {}
+        relocate_memo: Dict[Block, Block] = {}
+        exit_memo: Dict[Block, Block] = {}
         block = self
         while True:
-            opt_block = block.eval_reduce().relocate_cond()
+            opt_block = block.eval_reduce(None, reduce_memo).relocate_cond(relocate_memo)
             if opt_block is block:
                 return block
             if proc is None:
                 block = opt_block
             else:
-                block = opt_block.proc_exit(proc)
+                block = opt_block.proc_exit(proc, exit_memo)
@@ -54,7 +54,8 @@ def ip_parser():
     ip.psm = PSM(DUMP, FRAG)
     ip.psm.dump = (DUMP >> DUMP) + Pred(
         ((ip.header.dont_frag == 1) & (ip.temp.offset == 0))
-        | ((ip.header.more_frag == 0) & (ip.temp.offset == 0))
+        | ((ip.header.more_frag == 0) & (ip.temp.offset == 0)),
+        stateless=True,
     )
     ip.psm.frag = (DUMP >> FRAG) + Pred(
         (ip.header.more_frag == 1) | (ip.temp.offset != 0)